@@ -0,0 +1,69 @@
+"""
+Benchmarks U2FCore verification engines, u2flib and native, side by side on
+SoftU2FDevice registrations and signatures.
+
+    python benchmarks/bench_engines.py --iterations 2000
+"""
+
+import os
+import sys
+import time
+import argparse
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from flask_fido_u2f import U2FCore
+from test.soft_u2f_v2 import SoftU2FDevice
+
+APPID = 'https://example.com'
+
+
+def make_vectors(iterations):
+    """Returns enroll and sign (request, response) pairs, and the signing device"""
+    core  = U2FCore(APPID)
+    token = SoftU2FDevice()
+
+    enrolls = []
+    for i in range(iterations):
+        request = core.start_enroll([])
+        enrolls.append((request.json, token.register(request['registerRequests'][0], facet=APPID)))
+
+    device = core.complete_enroll(enrolls[0][0], enrolls[0][1], [])
+
+    signs = []
+    for i in range(iterations):
+        request = core.start_sign([device])
+        signs.append((request.json, token.getAssertion(request['authenticateRequests'][0], facet=APPID)))
+
+    return enrolls, signs, device
+
+
+def timed(label, func, iterations):
+    start = time.perf_counter()
+    for i in range(iterations):
+        func(i)
+    elapsed = time.perf_counter() - start
+
+    print('  {label:<16} {rate:>10.0f} ops/s  {latency:>8.1f} us/op'.format(
+        label=label, rate=iterations / elapsed, latency=elapsed / iterations * 1e6))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmarks U2F verification engines')
+    parser.add_argument('--iterations', type=int, default=1000)
+    args = parser.parse_args()
+
+    enrolls, signs, device = make_vectors(args.iterations)
+
+    for engine in U2FCore.ENGINES:
+        print(engine)
+
+        # Own core per engine, challenges are consumed once
+        core = U2FCore(APPID, engine=engine)
+        timed('complete_enroll', lambda i: core.complete_enroll(enrolls[i][0], enrolls[i][1], []), args.iterations)
+        timed('complete_sign', lambda i: core.complete_sign(signs[i][0], signs[i][1], [device]), args.iterations)
+
+
+if __name__ == '__main__':
+    main()
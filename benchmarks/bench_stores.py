@@ -0,0 +1,98 @@
+"""
+Benchmarks device stores.
+
+    python benchmarks/bench_stores.py --users 1000 --devices 3
+"""
+
+import os
+import sys
+import time
+import argparse
+import tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from flask_fido_u2f.stores import DeviceStore, SQLiteDeviceStore, SQLAlchemyDeviceStore
+
+
+class ListStore(DeviceStore):
+    """Naive store, as in examples/server.py: whole device list per user"""
+
+    def __init__(self):
+        self.users = {}
+
+    def read(self, user):
+        return [dict(device) for device in self.users.get(user, [])]
+
+    def save(self, user, devices):
+        self.users[user] = [dict(device) for device in devices]
+
+    def save_counters(self, batch):
+        for (user, key_handle), fields in batch.items():
+            for device in self.users.get(user, []):
+                if device['keyHandle'] == key_handle:
+                    device['counter'] = fields['counter']
+
+        return set()
+
+
+def make_devices(user, count):
+    return [{
+        'keyHandle' : '{user}-kh{index}'.format(user=user, index=index),
+        'appId'     : 'https://example.com',
+        'publicKey' : 'B' * 87,
+        'counter'   : 0,
+        'index'     : index
+    } for index in range(count)]
+
+
+def timed(label, func, iterations):
+    start = time.perf_counter()
+    for i in range(iterations):
+        func(i)
+    elapsed = time.perf_counter() - start
+
+    print('  {label:<16} {rate:>10.0f} ops/s  {latency:>8.1f} us/op'.format(
+        label=label, rate=iterations / elapsed, latency=elapsed / iterations * 1e6))
+
+
+def bench(name, store, users, devices):
+    print(name)
+
+    user_ids = ['user{0}'.format(i) for i in range(users)]
+
+    timed('save', lambda i: store.save(user_ids[i], make_devices(user_ids[i], devices)), users)
+    timed('read', lambda i: store.read(user_ids[i % users]), users)
+    timed('save_counters', lambda i: store.save_counters({(user_ids[i % users], user_ids[i % users] + '-kh0'): {'counter': i + 1}}), users)
+
+    # Login without single row update: read, then rewrite whole list
+    def login(i):
+        found = store.read(user_ids[i % users])
+        found[0]['counter'] += 1
+        store.save(user_ids[i % users], found)
+
+    timed('read+save login', login, users)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmarks device stores')
+    parser.add_argument('--users',   type=int, default=1000)
+    parser.add_argument('--devices', type=int, default=3)
+    args = parser.parse_args()
+
+    bench('list', ListStore(), args.users, args.devices)
+
+    with tempfile.TemporaryDirectory() as directory:
+        bench('sqlite', SQLiteDeviceStore(os.path.join(directory, 'u2f.sqlite')), args.users, args.devices)
+
+        try:
+            import sqlalchemy
+        except ImportError:
+            print('sqlalchemy: not installed, skipped')
+        else:
+            url = 'sqlite:///' + os.path.join(directory, 'u2f-sa.sqlite')
+            bench('sqlalchemy', SQLAlchemyDeviceStore(url), args.users, args.devices)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,309 @@
+"""
+Load test of enroll and sign flows, over HTTP against a locally started
+WSGI server.
+
+Each simulated user logs in, enrolls its SoftU2FDevice tokens, then signs
+repeatedly. With --tabs above 1, every user signs from several sessions at
+once, with the same tokens, which makes signatures race each other: those
+rejected because a newer counter was saved first are reported as counter
+races.
+
+    python benchmarks/load_test.py --users 1000 --concurrency 64 --store sqlite --workers 4
+
+--workers above 1 runs Werkzeug's forking server, which handles each request
+in a child process. The memory store is per process, so use sqlite,
+sqlalchemy or redis with it.
+"""
+
+import os
+import sys
+import json
+import time
+import socket
+import logging
+import argparse
+import tempfile
+import threading
+import multiprocessing
+
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from http.cookiejar import CookieJar
+from urllib.error import HTTPError
+from urllib.request import Request, build_opener, HTTPCookieProcessor
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from bench_stores import ListStore
+from test.soft_u2f_v2 import SoftU2FDevice
+
+APPID = 'https://example.com'
+
+
+def make_store(name, directory, redis_url):
+    from flask_fido_u2f.stores import SQLiteDeviceStore, SQLAlchemyDeviceStore, RedisDeviceStore
+
+    if name == 'memory':
+        return ListStore()
+
+    if name == 'sqlite':
+        return SQLiteDeviceStore(os.path.join(directory, 'u2f.sqlite'))
+
+    if name == 'sqlalchemy':
+        return SQLAlchemyDeviceStore('sqlite:///' + os.path.join(directory, 'u2f-sa.sqlite'))
+
+    if name == 'redis':
+        import redis
+        return RedisDeviceStore(redis.Redis.from_url(redis_url), prefix='u2f-load:{0}:'.format(os.getpid()))
+
+    raise ValueError('Unknown store: ' + name)
+
+
+def make_app(store):
+    from flask import Flask, session, jsonify
+    from flask_fido_u2f import U2F
+
+    app = Flask(__name__)
+    app.config['SECRET_KEY'] = os.urandom(32)
+    app.config['U2F_APPID']  = APPID
+
+    u2f = U2F(app)
+    u2f.use_store(store)
+
+    @u2f.identity
+    def identity():
+        return session['user']
+
+    @u2f.enroll_on_success
+    def enroll_on_success():
+        pass
+
+    @u2f.sign_on_success
+    def sign_on_success():
+        pass
+
+    @app.route('/login/<user>', methods=['POST'])
+    def login(user):
+        session['user']                  = user
+        session['u2f_enroll_authorized'] = True
+        session['u2f_sign_required']     = True
+
+        return jsonify({'status': 'ok'})
+
+    return app
+
+
+def serve(port, store, directory, redis_url, workers):
+    from werkzeug.serving import run_simple
+
+    # Request log would dominate the client's output and timings
+    logging.getLogger('werkzeug').setLevel(logging.ERROR)
+
+    app = make_app(make_store(store, directory, redis_url))
+
+    if workers > 1:
+        run_simple('127.0.0.1', port, app, processes=workers)
+    else:
+        run_simple('127.0.0.1', port, app, threaded=True)
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def wait_for(port, timeout=10):
+    deadline = time.time() + timeout
+
+    while time.time() < deadline:
+        try:
+            socket.create_connection(('127.0.0.1', port), timeout=1).close()
+            return
+        except OSError:
+            time.sleep(0.05)
+
+    raise RuntimeError('Server did not start in {0} seconds'.format(timeout))
+
+
+class Results(object):
+    """Latencies and outcomes by operation, shared by client threads"""
+
+    def __init__(self):
+        self.latencies = defaultdict(list)
+        self.outcomes  = defaultdict(lambda: defaultdict(int))
+        self.lock      = threading.Lock()
+
+    def record(self, operation, latency, outcome):
+        with self.lock:
+            self.latencies[operation].append(latency)
+            self.outcomes[operation][outcome] += 1
+
+
+class Client(object):
+    """HTTP client with its own session cookies"""
+
+    def __init__(self, base, results):
+        self.base    = base
+        self.results = results
+        self.opener  = build_opener(HTTPCookieProcessor(CookieJar()))
+
+    def call(self, operation, method, path, payload=None):
+        data    = json.dumps(payload).encode('utf-8') if payload is not None else None
+        request = Request(self.base + path, data=data, method=method, headers={'content-type': 'application/json'})
+
+        start = time.perf_counter()
+        try:
+            with self.opener.open(request, timeout=30) as response:
+                body = response.read()
+        except HTTPError as e:
+            body = e.read()
+        except OSError as e:
+            body = json.dumps({'status': 'failed', 'code': type(e).__name__}).encode('utf-8')
+
+        try:
+            body = json.loads(body.decode('utf-8'))
+        except ValueError:
+            body = {'status': 'failed', 'code': 'invalid_response'}
+
+        outcome = 'ok' if body.get('status') == 'ok' else body.get('code', 'failed')
+        self.results.record(operation, time.perf_counter() - start, outcome)
+
+        return body
+
+
+def simulate(user, base, results, devices, signs, tabs):
+    tokens  = [SoftU2FDevice() for i in range(devices)]
+    clients = [Client(base, results) for i in range(tabs)]
+
+    for client in clients:
+        client.call('login', 'POST', '/login/' + user, {})
+
+    enroller = clients[0]
+    for token in tokens:
+        challenge = enroller.call('enroll.get', 'GET', '/u2f/enroll')
+        if challenge.get('status') != 'ok':
+            return
+
+        response = token.register(challenge['registerRequests'][0], facet=APPID)
+        enroller.call('enroll.post', 'POST', '/u2f/enroll', dict(response))
+
+    def sign(client, i):
+        client.call('login', 'POST', '/login/' + user, {})
+
+        challenge = client.call('sign.get', 'GET', '/u2f/sign')
+        if challenge.get('status') != 'ok':
+            return
+
+        # Tokens take turns, each one is found by its key handle
+        token = tokens[i % len(tokens)]
+        for request in challenge['authenticateRequests']:
+            try:
+                response = token.getAssertion(request, facet=APPID)
+            except ValueError:
+                continue
+
+            client.call('sign.post', 'POST', '/u2f/sign', dict(response))
+            break
+
+    def run_tab(client):
+        for i in range(signs):
+            sign(client, i)
+
+    threads = [threading.Thread(target=run_tab, args=(client,)) for client in clients[1:]]
+    for thread in threads:
+        thread.start()
+
+    run_tab(clients[0])
+
+    for thread in threads:
+        thread.join()
+
+
+def percentile(values, fraction):
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+def report(results, elapsed):
+    total = sum(len(latencies) for latencies in results.latencies.values())
+
+    print('{requests} requests in {elapsed:.1f} s, {rate:.0f} requests/s'.format(
+        requests=total, elapsed=elapsed, rate=total / elapsed))
+    print()
+    print('  {0:<12} {1:>8} {2:>9} {3:>9} {4:>9} {5:>9} {6:>8}'.format(
+        'operation', 'count', 'p50 ms', 'p90 ms', 'p99 ms', 'max ms', 'errors'))
+
+    for operation in sorted(results.latencies):
+        latencies = sorted(results.latencies[operation])
+        outcomes  = results.outcomes[operation]
+        errors    = sum(count for outcome, count in outcomes.items() if outcome != 'ok')
+
+        print('  {0:<12} {1:>8} {2:>9.2f} {3:>9.2f} {4:>9.2f} {5:>9.2f} {6:>7.2f}%'.format(
+            operation, len(latencies),
+            percentile(latencies, 0.50) * 1000,
+            percentile(latencies, 0.90) * 1000,
+            percentile(latencies, 0.99) * 1000,
+            latencies[-1] * 1000,
+            errors * 100.0 / len(latencies)))
+
+    print()
+    for operation in sorted(results.outcomes):
+        for outcome, count in sorted(results.outcomes[operation].items()):
+            if outcome != 'ok':
+                print('  {0:<12} {1:<24} {2:>8}'.format(operation, outcome, count))
+
+    races = results.outcomes['sign.post'].get('counter_regression', 0)
+    print('  counter races: {0}'.format(races))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Load tests enroll and sign flows')
+    parser.add_argument('--users',       type=int, default=200, help='Simulated users')
+    parser.add_argument('--devices',     type=int, default=1,   help='Tokens per user')
+    parser.add_argument('--signs',       type=int, default=5,   help='Sign cycles per user and tab')
+    parser.add_argument('--tabs',        type=int, default=1,   help='Concurrent sessions per user')
+    parser.add_argument('--concurrency', type=int, default=32,  help='Users simulated at once')
+    parser.add_argument('--store',       default='memory', choices=['memory', 'sqlite', 'sqlalchemy', 'redis'])
+    parser.add_argument('--redis-url',   default='redis://localhost:6379/0')
+    parser.add_argument('--workers',     type=int, default=1,   help='Server processes, 1 runs threaded server')
+    parser.add_argument('--url',         default=None, help='Test running server instead of starting one')
+    args = parser.parse_args()
+
+    if args.workers > 1 and args.store == 'memory':
+        parser.error('memory store is not shared between worker processes')
+
+    with tempfile.TemporaryDirectory() as directory:
+        server = None
+        base   = args.url
+
+        if base is None:
+            port   = free_port()
+            base   = 'http://127.0.0.1:{0}'.format(port)
+            server = multiprocessing.Process(target=serve,
+                args=(port, args.store, directory, args.redis_url, args.workers))
+            server.daemon = True
+            server.start()
+            wait_for(port)
+
+        results = Results()
+        start   = time.perf_counter()
+
+        try:
+            with ThreadPoolExecutor(max_workers=args.concurrency) as pool:
+                futures = [pool.submit(simulate, 'user{0}'.format(i), base, results, args.devices, args.signs, args.tabs)
+                           for i in range(args.users)]
+
+            # Raises errors of the harness itself, server errors are counted
+            for future in futures:
+                future.result()
+        finally:
+            if server is not None:
+                server.terminate()
+                server.join()
+
+        report(results, time.perf_counter() - start)
+
+
+if __name__ == '__main__':
+    main()
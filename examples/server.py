@@ -39,16 +39,16 @@ def enroll_on_success():
     print('Successfully enrolled new device!')
 
 @u2f.enroll_on_fail
-def enroll_on_fail():
-    print('Failed to enroll new device!')
+def enroll_on_fail(e):
+    print('Failed to enroll new device! Reason: ' + e.reason.value)
 
 @u2f.sign_on_success
 def sign_on_success():
     print('Successfully verified user!')
 
 @u2f.sign_on_fail
-def sign_on_fail():
-    print('Failed to verified user!')
+def sign_on_fail(e):
+    print('Failed to verified user! Reason: ' + e.reason.value)
 
 
 context = ('domain.crt', 'domain.key')
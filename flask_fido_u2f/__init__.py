@@ -0,0 +1,1333 @@
+import os
+import json
+import time
+import atexit
+import functools
+
+# Flask imports
+from flask import jsonify, session, g, current_app
+from flask import Response, request, has_request_context, copy_current_request_context
+from itsdangerous import URLSafeTimedSerializer, BadSignature
+
+# U2F imports are deferred to the first enroll or sign operation, as u2flib
+# loads cryptography backends. Importing this module stays cheap for code
+# that only uses session helpers.
+
+from .errors import FailureReason, U2FFailure, StorageUnavailable, classify
+from .anomaly import CounterAnomalyDetector
+from .breaker import CircuitBreaker, StaleReads
+from .core import U2FCore, websafe_encode, websafe_decode
+from .counters import CounterWriteBehind
+from .events import U2FEvent, EventBus, FileAuditSink
+from .facets import FacetIndex
+from .invalidation import InvalidationChannel, UnixSocketInvalidationChannel, RedisInvalidationChannel
+from .keycache import SharedKeyCache
+from .metrics import Metrics
+from .pool import ChallengePool
+from .profiling import SamplingProfiler
+from .replay import ReplayCache, MemoryReplayCache, RedisReplayCache
+from .singleflight import SingleFlight
+from .validation import validate_payload, ENROLL_FIELDS, SIGN_FIELDS
+
+# Session keys holding pending challenges
+SESSION_KEYS = {
+    'enroll' : '_u2f_enroll_',
+    'sign'   : '_u2f_challenge_'
+}
+
+# Session key of the nonce under which stores keep challenges of the session
+NONCE_KEY = '_u2f_nonce_'
+
+
+class U2F():
+    def __init__(self, app=None, *args
+        , enroll_route  = '/u2f/enroll'
+        , sign_route    = '/u2f/sign'
+        , devices_route = '/u2f/devices'
+        , facets_route  = '/u2f/facets.json'
+        , replay_cache  = None):
+
+        """
+        Flask-FIDO-U2F 
+        ==============
+
+        Implements easy to use U2F managing plugin
+
+        Arguments:
+            app:
+                (Flask) - A Flask application
+
+            enroll_route:
+                (String) - A route for device enrollment
+
+            sign_route:
+                (String) - A route for device verification(signature)
+
+            devices_route:
+                (String) - A route for device management(View, Deletion)
+
+            facets_route:
+                (String) - A route for FIDO Facets 
+
+            replay_cache:
+                (ReplayCache) - A cache of consumed challenges. Defaults to in-process
+                MemoryReplayCache. Use shared backend when running multiple workers.
+            
+
+        Session variables:
+
+            session['u2f_enroll_authorized']:
+                (Boolean) - A session variable that enables access to Enrollment API.
+
+            session['u2f_sign_required']:
+                (Boolean) - A session variable that enables access to Verification API.
+
+            session['u2f_device_management_authorized']:
+                (Boolean) _ A session variable that enables access to Device management API
+
+
+        Flask application config variables:
+
+            app.config['U2F_APPID']
+                (String) - A configuration key that holds application ID. 
+
+                MAKE SURE NO TRAILING SLASHES IN THE APPID!!!!!
+
+                Additional info.
+
+                "The AppIDis a URL carried as part of the protocol message sent by the server and indicates the target for this credential.
+
+                For more information, refer to page 3 of https://fidoalliance.org/specs/fido-appid-and-facets-ps-20150514.pdf
+
+            app.config['U2F_FACETS_ENABLED']
+                (Boolean) - A configuration key that enables FIDO U2F support. If enabled, U2F_FACETS_LIST must be set.
+
+            app.config['U2F_FACETS_LIST']
+                (List) - Defines a list of FIDO application facets. For example Google facets:
+
+                [
+                  "https://accounts.google.com",
+                  "https://myaccount.google.com",
+                  "https://security.google.com",
+                  "android:apk-key-hash:FD18FA800DD00C0D9D7724328B6...",
+                  "android:apk-key-hash:Rj6gA3QDA2ddyQyi21JXly6gw9...",
+                  "ios:bundle-id:com.google.SecurityKey.dogfood"
+                ]
+
+                For more information, refer to page 5 of https://fidoalliance.org/specs/fido-appid-and-facets-ps-20150514.pdf
+
+                Facets are indexed for constant time origin checks, and can be updated without
+                restart through u2f.core.facets, a FacetIndex.
+
+            app.config['U2F_CHALLENGE_TTL']
+                (Integer) - Number of seconds enroll and sign challenges stay valid. Defaults to 300.
+
+            app.config['U2F_LEGACY_CHALLENGE_CUTOFF']
+                (Float) - Unix time after which challenges kept in session by earlier versions,
+                which have no expiration time, are rejected. Defaults to U2F_CHALLENGE_TTL seconds
+                after init_app. Set it to deploy time plus U2F_CHALLENGE_TTL, so that restarts do
+                not reopen the window, or to 0 to reject them right away.
+
+            app.config['U2F_MAX_PAYLOAD_SIZE']
+                (Integer) - Maximum size of enroll and sign POST body in bytes. Defaults to 16384.
+
+            app.config['U2F_STATELESS_CHALLENGES']
+                (Boolean) - Enables stateless challenges. Instead of the session, challenge state is
+                returned to the client as challengeToken, signed with SECRET_KEY and bound to the user
+                and the set of user devices. Client posts it back along with the U2F response.
+                Requires @u2f.identity.
+
+            app.config['U2F_COMPACT_CHALLENGES']
+                (Boolean) - Sends enroll and sign challenges in compact format: appId, version and
+                challenge once, followed by keyHandles of users devices. Defaults to False.
+
+            app.config['U2F_CHALLENGE_POOL_SIZE']
+                (Integer) - Number of random challenges pre-generated in background. Defaults to 0,
+                which generates challenges on demand.
+
+            app.config['U2F_CHALLENGE_POOL_REFILL']
+                (Integer) - Pool is refilled once it holds fewer challenges. Defaults to a quarter of pool size.
+
+            app.config['U2F_ANOMALY_DETECTION']
+                (Boolean) - Enables signature counter anomaly detection. Counter jumps and bursts of
+                signatures are counted in metrics and passed to @u2f.sign_on_anomaly. Defaults to False.
+                Requires @u2f.identity.
+
+            app.config['U2F_ANOMALY_WINDOW']
+                (Integer) - Number of signatures kept per device. Defaults to 10.
+
+            app.config['U2F_ANOMALY_MAX_JUMP']
+                (Integer) - Smallest counter delta flagged as a jump. Defaults to 1000.
+
+            app.config['U2F_ANOMALY_BURST_INTERVAL']
+                (Float) - Seconds of the burst window. Defaults to 60.
+
+            app.config['U2F_ANOMALY_MAX_KEYS']
+                (Integer) - Number of devices tracked. Defaults to 100000.
+
+            app.config['U2F_PROFILE_DIR']
+                (String) - Enables sampling profiler of enroll, sign and devices views, writing
+                collapsed stacks of slow or sampled requests to this directory. Defaults to None.
+
+            app.config['U2F_PROFILE_THRESHOLD']
+                (Float) - Profiles of requests slower than this many seconds are written. Defaults to 0.5.
+
+            app.config['U2F_PROFILE_SAMPLE_RATE']
+                (Float) - Fraction of faster requests whose profiles are written too. Defaults to 0.0.
+
+            app.config['U2F_PROFILE_INTERVAL']
+                (Float) - Seconds between stack samples. Defaults to 0.005.
+
+            app.config['U2F_PROFILE_MAX_DUMPS']
+                (Integer) - Profiles written per U2F_PROFILE_DUMP_INTERVAL by a process, or None for
+                no limit. Defaults to 10.
+
+            app.config['U2F_PROFILE_DUMP_INTERVAL']
+                (Float) - Seconds of the U2F_PROFILE_MAX_DUMPS window. Defaults to 60.
+
+            app.config['U2F_ENGINE']
+                (String) - Engine verifying enroll and sign responses: 'u2flib' or 'native', which
+                verifies raw messages directly with cryptography. Defaults to 'u2flib'.
+
+            app.config['U2F_READ_COALESCING']
+                (Boolean) - Enables coalescing of concurrent device reads of a user. Requests of the same
+                user in a process share one in-flight @u2f.read call. Writes always read on their own.
+                Requires @u2f.identity.
+
+            app.config['U2F_READ_FRESHNESS']
+                (Float) - Seconds a coalesced read is shared after it finishes. Defaults to 0.0,
+                which shares in-flight reads only.
+
+            app.config['U2F_KEY_CACHE_SIZE']
+                (Integer) - Number of devices kept in memory mapped cache of public keys and counters,
+                shared by workers forked after init_app. Hits spare the fresh device read before
+                counters are saved, signatures are still verified against read devices. Defaults to 0,
+                which disables it.
+                Requires @u2f.save_counters and @u2f.identity.
+
+            app.config['U2F_KEY_CACHE_PATH']
+                (String) - File backing the key cache, to share it between processes that are not forked.
+
+            app.config['U2F_EVENT_WORKERS']
+                (Integer) - Number of threads delivering events to @u2f.subscribe handlers. Defaults to 1.
+                0 delivers them synchronously.
+
+            app.config['U2F_EVENT_QUEUE_SIZE']
+                (Integer) - Number of queued events. Defaults to 10000.
+
+            app.config['U2F_EVENT_OVERFLOW']
+                (String) - When the queue is full: 'sync' delivers the event in the request, 'block' waits,
+                'drop_newest' and 'drop_oldest' drop an event. Defaults to 'sync'.
+
+            app.config['U2F_EVENT_BATCH_SIZE']
+                (Integer) - Number of events delivered together to batch subscribers. Defaults to 100.
+
+            app.config['U2F_READ_TIMEOUT']
+                (Float) - Seconds requests wait for @u2f.read. Defaults to None, which waits for it to finish.
+
+            app.config['U2F_SAVE_TIMEOUT']
+                (Float) - Seconds requests wait for @u2f.save and @u2f.save_counters. Defaults to None.
+
+            app.config['U2F_BREAKER_FAILURES']
+                (Integer) - Consecutive storage timeouts or errors that open the storage circuit breaker,
+                failing requests fast with 503 until a trial call succeeds. Defaults to 0, which never opens it.
+
+            app.config['U2F_BREAKER_RESET']
+                (Float) - Seconds the circuit stays open before a trial call. Defaults to 30.
+
+            app.config['U2F_STALE_READ_MAX_AGE']
+                (Float) - Seconds device lists last read for a user may be served for challenge
+                generation while storage is unavailable. Defaults to 0, which disables it.
+                Requires @u2f.identity.
+
+            app.config['U2F_INVALIDATION_SOCKET_DIR']
+                (String) - Directory of UNIX sockets broadcasting device invalidations between
+                processes of a host. See use_invalidation() for clusters. Requires @u2f.identity.
+
+            app.config['U2F_COUNTER_WRITE_BEHIND']
+                (Boolean) - Enables write-behind counter persistence. Counters are kept in process
+                and flushed in batches through @u2f.save_counters, instead of @u2f.save on every login.
+
+            app.config['U2F_COUNTER_FLUSH_INTERVAL']
+                (Float) - Seconds between write-behind flushes. Defaults to 1.0.
+
+            app.config['U2F_COUNTER_FLUSH_SIZE']
+                (Integer) - Number of pending counters that triggers early flush. Defaults to 100.
+
+            
+        """
+
+        self.app                = app
+
+        # Routes
+        self.__enroll_route     = enroll_route
+        self.__sign_route       = sign_route
+        self.__devices_route    = devices_route
+        self.__facets_route     = facets_route
+
+        # Wrapped once, as Flask refuses a different function for an existing endpoint
+        self.__views = {
+            'enroll'  : self.profiled(self.guarded(self.enroll)),
+            'sign'    : self.profiled(self.guarded(self.sign)),
+            'devices' : self.profiled(self.guarded(self.devices))
+        }
+
+        # Injections
+        self.__get_u2f_devices     = None
+        self.__save_u2f_devices    = None
+        self.__save_u2f_counters   = None
+        self.__get_identity        = None
+        self.__store               = None
+
+        self.__call_success_enroll = None
+        self.__call_fail_enroll    = None
+        self.__call_success_sign   = None
+        self.__call_fail_sign      = None
+        self.__call_anomaly_sign   = None
+
+        # U2F Variables
+        self.__appid           = None
+        self.__facets_enabled  = False
+        self.__facets_list     = None
+        self.__challenge_ttl   = 300
+        self.__max_payload     = 16384
+        self.__stateless       = False
+        self.__compact         = False
+
+        self.__replay_cache    = MemoryReplayCache() if replay_cache is None else replay_cache
+
+        self.metrics           = Metrics()
+        self.core              = None
+        self.events            = EventBus(metrics=self.metrics)
+        self.breaker           = None
+        self.invalidation      = None
+        self.key_cache         = None
+
+        self.__counter_writer  = None
+        self.__challenge_pool  = None
+        self.__anomaly_detector = None
+        self.__profiler        = None
+        self.__read_flight     = None
+        self.__stale_reads     = None
+        self.__read_timeout    = None
+        self.__save_timeout    = None
+
+        self.__integrity_check = False 
+
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.add_url_rule(self.__enroll_route,  view_func = self.__views['enroll'],  methods=['GET', 'POST'])
+        app.add_url_rule(self.__sign_route,    view_func = self.__views['sign'],    methods=['GET', 'POST'])
+        app.add_url_rule(self.__devices_route, view_func = self.__views['devices'], methods=['GET', 'DELETE'])
+        app.add_url_rule(self.__facets_route,  view_func = self.facets,  methods=['GET'])
+
+        self.__appid            = self.app.config.get('U2F_APPID', None)
+        self.__facets_enabled   = self.app.config.get('U2F_FACETS_ENABLED', False)
+        self.__facets_list      = self.app.config.get('U2F_FACETS_LIST', [])
+        self.__challenge_ttl    = self.app.config.get('U2F_CHALLENGE_TTL', 300)
+        self.__legacy_cutoff    = self.app.config.get('U2F_LEGACY_CHALLENGE_CUTOFF',
+                                                      time.time() + self.__challenge_ttl)
+        self.__max_payload      = self.app.config.get('U2F_MAX_PAYLOAD_SIZE', 16384)
+        self.__stateless        = self.app.config.get('U2F_STATELESS_CHALLENGES', False)
+        self.__compact          = self.app.config.get('U2F_COMPACT_CHALLENGES', False)
+
+        pool_size = self.app.config.get('U2F_CHALLENGE_POOL_SIZE', 0)
+        if pool_size:
+            self.__challenge_pool = ChallengePool(pool_size
+                , refill_threshold = self.app.config.get('U2F_CHALLENGE_POOL_REFILL', None)
+                , metrics          = self.metrics)
+        else:
+            self.__challenge_pool = None
+
+        if self.app.config.get('U2F_ANOMALY_DETECTION', False):
+            self.__anomaly_detector = CounterAnomalyDetector(
+                  window         = self.app.config.get('U2F_ANOMALY_WINDOW', 10)
+                , max_jump       = self.app.config.get('U2F_ANOMALY_MAX_JUMP', 1000)
+                , burst_interval = self.app.config.get('U2F_ANOMALY_BURST_INTERVAL', 60)
+                , max_entries    = self.app.config.get('U2F_ANOMALY_MAX_KEYS', 100000))
+        else:
+            self.__anomaly_detector = None
+
+        profile_dir = self.app.config.get('U2F_PROFILE_DIR', None)
+        if profile_dir:
+            self.__profiler = SamplingProfiler(profile_dir
+                , threshold   = self.app.config.get('U2F_PROFILE_THRESHOLD', 0.5)
+                , sample_rate = self.app.config.get('U2F_PROFILE_SAMPLE_RATE', 0.0)
+                , interval      = self.app.config.get('U2F_PROFILE_INTERVAL', 0.005)
+                , max_dumps     = self.app.config.get('U2F_PROFILE_MAX_DUMPS', 10)
+                , dump_interval = self.app.config.get('U2F_PROFILE_DUMP_INTERVAL', 60.0)
+                , metrics       = self.metrics)
+        else:
+            self.__profiler = None
+
+        if self.app.config.get('U2F_READ_COALESCING', False):
+            self.__read_flight = SingleFlight(
+                  window  = self.app.config.get('U2F_READ_FRESHNESS', 0.0)
+                , copy    = lambda devices: [dict(device) for device in devices]
+                , metrics = self.metrics)
+        else:
+            self.__read_flight = None
+
+        self.__read_timeout = self.app.config.get('U2F_READ_TIMEOUT', None)
+        self.__save_timeout = self.app.config.get('U2F_SAVE_TIMEOUT', None)
+        breaker_failures    = self.app.config.get('U2F_BREAKER_FAILURES', 0)
+
+        if self.__read_timeout is not None or self.__save_timeout is not None or breaker_failures:
+            self.breaker = CircuitBreaker(breaker_failures
+                , reset_timeout = self.app.config.get('U2F_BREAKER_RESET', 30.0)
+                , metrics       = self.metrics)
+        else:
+            self.breaker = None
+
+        stale_max_age = self.app.config.get('U2F_STALE_READ_MAX_AGE', 0)
+        if stale_max_age:
+            self.__stale_reads = StaleReads(stale_max_age)
+        else:
+            self.__stale_reads = None
+
+        socket_dir = self.app.config.get('U2F_INVALIDATION_SOCKET_DIR', None)
+        if socket_dir:
+            self.use_invalidation(UnixSocketInvalidationChannel(socket_dir))
+
+        # Subscribers are kept across init_app
+        events      = self.events
+        self.events = EventBus(
+              workers   = self.app.config.get('U2F_EVENT_WORKERS', 1)
+            , max_queue = self.app.config.get('U2F_EVENT_QUEUE_SIZE', 10000)
+            , overflow  = self.app.config.get('U2F_EVENT_OVERFLOW', 'sync')
+            , max_batch = self.app.config.get('U2F_EVENT_BATCH_SIZE', 100)
+            , metrics   = self.metrics)
+
+        for subscriber in events.subscribers():
+            self.events.subscribe(*subscriber)
+
+        events.stop()
+        atexit.register(self.events.stop)
+
+        if self.__counter_writer:
+            self.__counter_writer.stop()
+            self.__counter_writer = None
+
+        if self.app.config.get('U2F_COUNTER_WRITE_BEHIND', False):
+            self.__counter_writer = CounterWriteBehind(lambda batch: self.__save_counters_hook(batch)
+                , interval  = self.app.config.get('U2F_COUNTER_FLUSH_INTERVAL', 1.0)
+                , max_batch = self.app.config.get('U2F_COUNTER_FLUSH_SIZE', 100)
+                , metrics   = self.metrics)
+
+            atexit.register(self.__counter_writer.stop)
+
+        key_cache_size = self.app.config.get('U2F_KEY_CACHE_SIZE', 0)
+        if key_cache_size:
+            self.key_cache = SharedKeyCache(key_cache_size
+                , path    = self.app.config.get('U2F_KEY_CACHE_PATH', None)
+                , metrics = self.metrics)
+        else:
+            self.key_cache = None
+
+        # Set appid to appid + /facets.json if U2F_FACETS_ENABLED
+        # or U2F_APP becomes U2F_FACETS_LIST
+        if self.__facets_enabled:
+            self.__appid += self.__facets_route
+        else:
+            self.__facets_list = [self.__appid]
+
+        self.core = U2FCore(self.__appid
+            , facets         = self.__facets_list
+            , challenge_ttl  = self.__challenge_ttl
+            , replay_cache   = self.__replay_cache
+            , challenge_pool = self.__challenge_pool
+            , engine         = self.app.config.get('U2F_ENGINE', 'u2flib'))
+
+
+    def verify_integrity(self):
+        """Verifies that all required functions been injected."""
+        if not self.__integrity_check:
+            if not self.__appid:
+                raise Exception('U2F_APPID was not defined! Please define it in configuration file.')
+
+            if self.__facets_enabled and not len(self.__facets_list):
+                raise Exception("""U2F facets been enabled, but U2F facet list is empty.
+                                   Please either disable facets by setting U2F_FACETS_ENABLED to False.
+                                   Or add facets list using, by assigning it to U2F_FACETS_LIST.
+                                """)
+
+            # Injection
+            
+            undefined_message = 'U2F {name} handler is not defined! Please import {name} through {method}!'
+
+            if not self.__get_u2f_devices:
+                raise Exception(undefined_message.format(name='Read', method='@u2f.read'))
+
+            if not self.__save_u2f_devices:
+                raise Exception(undefined_message.format(name='Save', method='@u2f.save'))
+
+            if (self.__stateless or self.__store or self.__read_flight or self.__stale_reads or self.invalidation
+                    or self.__save_u2f_counters or self.__anomaly_detector) and not self.__get_identity:
+                raise Exception(undefined_message.format(name='Identity', method='@u2f.identity'))
+
+            # Key cache entries are kept by user, for counters saved by user and key handle
+            if (self.__counter_writer or self.key_cache is not None) and not self.__save_u2f_counters:
+                raise Exception(undefined_message.format(name='Save counters', method='@u2f.save_counters'))
+
+
+            if not self.__call_success_enroll:
+                raise Exception(undefined_message.format(name='enroll onSuccess', method='@u2f.enroll_on_success'))
+
+            if not self.__call_success_sign:
+                raise Exception(undefined_message.format(name='sign onSuccess', method='@u2f.sign_on_success'))
+
+            self.__integrity_check = True
+
+        return True
+
+# ---- ----- #
+    def profiled(self, view):
+        """Wraps view, so that its slow or sampled requests are profiled when U2F_PROFILE_DIR is set"""
+
+        @functools.wraps(view)
+        def wrapper(*args, **kwargs):
+            if self.__profiler is None:
+                return view(*args, **kwargs)
+
+            with self.__profiler.profile(view.__name__ + '.' + request.method.lower()):
+                return view(*args, **kwargs)
+
+        return wrapper
+
+    def guarded(self, view):
+        """Wraps view, so that it responds with 503 when storage is unavailable"""
+
+        @functools.wraps(view)
+        def wrapper(*args, **kwargs):
+            try:
+                return view(*args, **kwargs)
+            except StorageUnavailable:
+                self.metrics.incr('storage.unavailable')
+                return jsonify({'status': 'failed', 'error': 'Storage unavailable!'}), 503
+
+        return wrapper
+
+    def enroll(self):
+        """Enrollment function"""
+        self.verify_integrity()
+
+        if session.get('u2f_enroll_authorized', False):
+            if request.method == 'GET':
+                return jsonify(self.get_enroll()), 200
+
+            elif request.method == 'POST':
+                try:
+                    payload = self.read_payload()
+                except U2FFailure as e:
+                    return jsonify(self.failed('enroll', e, 'Payload too large!')), 413
+
+                response = self.verify_enroll(payload)
+
+                if response['status'] == 'ok':
+                    return jsonify(response), 201
+                else:
+                    return jsonify(response), 400
+
+        return jsonify({'status': 'failed', 'error': 'Unauthorized!'}), 401
+
+    def sign(self):
+        """Signature function"""
+        self.verify_integrity()
+        
+        if session.get('u2f_sign_required', False):
+            if request.method == 'GET':
+                response = self.get_signature_challenge()
+
+                if response['status'] == 'ok':
+                    return jsonify(response), 200
+                else:
+                    return jsonify(response), 404
+
+            elif request.method == 'POST':
+                try:
+                    payload = self.read_payload()
+                except U2FFailure as e:
+                    return jsonify(self.failed('sign', e, 'Payload too large!')), 413
+
+                response = self.verify_signature(payload)
+
+                if response['status'] == 'ok':
+                    return jsonify(response), 201
+                else:
+                    return jsonify(response), 400
+
+        return jsonify({'status': 'failed', 'error': 'Unauthorized!'}), 401
+
+
+    def devices(self):
+        """Manages users enrolled u2f devices"""
+        self.verify_integrity()
+
+        if session.get('u2f_device_management_authorized', False):
+            if request.method == 'GET':
+                return jsonify(self.get_devices()), 200
+
+            elif request.method == 'DELETE':
+                response = self.remove_device(request.json)
+
+                if response['status'] == 'ok':
+                    return jsonify(response), 200
+                else:
+                    return jsonify(response), 404
+
+        return jsonify({'status': 'failed', 'error': 'Unauthorized!'}), 401
+
+    def facets(self):
+        """Provides facets support. REQUIRES VALID HTTPS!"""
+        self.verify_integrity()
+
+        if self.__facets_enabled:
+            data = json.dumps({
+                'trustedFacets' : [{
+                    'version': { 'major': 1, 'minor' : 0 },
+                    'ids': list(self.core.facets)
+                }]
+            }, sort_keys=True, indent=2, separators=(',', ': '))
+
+            mime = 'application/fido.trusted-apps+json'
+            resp = Response(data, mimetype=mime)
+
+            return resp, 200
+        else:
+            return jsonify({}), 404
+
+# ----- Methods -----#
+
+    def get_enroll(self):
+        """Returns new enroll seed"""
+
+        challenge = self.core.new_challenge()
+        devices   = self.read_for_challenge('enroll', challenge)
+
+        if self.__compact:
+            enroll = self.core.compact_challenge(devices, challenge)
+        else:
+            enroll = self.core.start_enroll(devices, challenge)
+
+        enroll['status'] = 'ok'
+
+        self.issue_challenge('enroll', enroll, websafe_encode(challenge), devices)
+        return enroll
+
+    def verify_enroll(self, response):
+        """Verifies and saves U2F enroll"""
+
+        state, expires, devices = self.pop_challenge('enroll', response)
+        if state is None:
+            failure = U2FFailure(FailureReason.MISSING_CHALLENGE, 'No pending challenge!')
+            return self.failed('enroll', failure, 'No pending challenge!')
+
+        try:
+            # Checked before reading devices, so malformed payloads cost no I/O
+            validate_payload(response, ENROLL_FIELDS)
+        except Exception as e:
+            return self.failed('enroll', classify(e), 'Invalid key handle!')
+
+        # Storage errors are not U2F failures, and are raised as they are
+        if devices is None:
+            devices = self.read_devices(fresh=True)
+
+        try:
+            seed       = self.load_challenge('enroll', state, devices)
+            new_device = self.core.complete_enroll(seed, response, devices, expires)
+        except Exception as e:
+            return self.failed('enroll', classify(e), 'Invalid key handle!')
+
+        devices.append(new_device)
+
+        self.__save_hook(devices)
+        self.devices_changed(added=[new_device['keyHandle']])
+        
+        self.__call_success_enroll()
+        self.publish('enroll.success', key_handle=new_device['keyHandle'])
+
+        return {'status': 'ok', 'message': 'Successfully enrolled new U2F device!'}
+
+
+    def get_signature_challenge(self):
+        """Returns new signature challenge"""
+
+        seed    = self.core.new_challenge()
+        devices = self.read_for_challenge('sign', seed)
+
+        if devices == []:
+            return {
+                'status' : 'failed', 
+                'error'  : 'No devices been associated with the account!'
+            }
+
+        if self.__compact:
+            challenge = self.core.compact_challenge(devices, seed)
+        else:
+            challenge = self.core.start_sign(devices, seed)
+
+        challenge['status'] = 'ok'
+
+        self.issue_challenge('sign', challenge, websafe_encode(seed), devices)
+
+        return challenge
+
+    def verify_signature(self, signature):
+        """Verifies signature"""
+
+        state, expires, devices = self.pop_challenge('sign', signature)
+        if state is None:
+            failure = U2FFailure(FailureReason.MISSING_CHALLENGE, 'No pending challenge!')
+            return self.failed('sign', failure, 'No pending challenge!')
+
+        try:
+            # Checked before reading devices, so malformed payloads cost no I/O
+            validate_payload(signature, SIGN_FIELDS)
+        except Exception as e:
+            return self.failed('sign', classify(e), 'Invalid signature!')
+
+        # Devices of stores keeping challenges are read along with the challenge
+        fresh = devices is not None
+
+        # Storage errors are not U2F failures, and are raised as they are
+        if devices is None:
+            devices = self.read_devices()
+
+        try:
+            challenge = self.load_challenge('sign', state, devices)
+            device, counter, touch = self.core.complete_sign(challenge, signature, devices, expires)
+        except Exception as e:
+            return self.failed('sign', classify(e), 'Invalid signature!')
+
+        verified = self.verify_counter(signature, counter, device, fresh)
+
+        if verified:
+            self.check_anomalies(signature['keyHandle'], counter)
+
+            self.__call_success_sign()
+            self.publish('sign.success', key_handle=signature['keyHandle'], counter=counter)
+            self.disable_sign()
+            
+            return {
+                'status'  : 'ok',
+                'counter' : counter,
+                'message': 'Successfully verified your second factor!'
+            }
+
+        elif verified is None:
+            failure = U2FFailure(FailureReason.UNKNOWN_KEY_HANDLE, 'Device was removed!')
+            return self.failed('sign', failure, 'Invalid signature!')
+
+        else:
+            failure = U2FFailure(FailureReason.COUNTER_REGRESSION, 'Device clone detected!')
+            return self.failed('sign', failure, 'Device clone detected!')
+
+
+    def get_devices(self):
+        """Returns list of enrolled U2F devices"""
+
+        return {
+            'status'  : 'ok',
+            'devices' : [
+                {
+                    'id'        : device['keyHandle'],
+                    'index'     : device['index'],
+                    'last_used' : device.get('last_used'),
+                    'use_count' : device.get('use_count', 0)
+                } for device in self.read_devices()
+            ]
+        }
+
+    def remove_device(self, request):
+        """Removes device specified by id.
+
+        Also accepts a list of ids as request['ids'], or request['all_except']
+        to remove every device except the given one. Bulk removals are done
+        in one pass with a single save, and report a result per id.
+        """
+
+        devices = self.read_devices(fresh=True)
+
+        if 'ids' not in request and 'all_except' not in request:
+            for i in range(len(devices)):
+                if devices[i]['keyHandle'] == request['id']:
+                    del devices[i]
+                    self.__save_hook(devices)
+                    self.devices_changed(removed=[request['id']])
+
+                    return {
+                        'status'  : 'ok',
+                        'message' : 'Successfully deleted your device!'
+                    }
+
+            return {
+                'status' : 'failed',
+                'error'  : 'No device with such an id been found!'
+            }
+
+        if 'all_except' in request:
+            keep = request['all_except']
+
+            if not any(device['keyHandle'] == keep for device in devices):
+                return {
+                    'status' : 'failed',
+                    'error'  : 'No device with such an id been found!'
+                }
+
+            ids = [device['keyHandle'] for device in devices if device['keyHandle'] != keep]
+        else:
+            ids = list(request['ids'])
+
+        to_remove = set(ids)
+        remaining = [device for device in devices if device['keyHandle'] not in to_remove]
+        removed   = set(device['keyHandle'] for device in devices) & to_remove
+
+        results = []
+        for key_handle in ids:
+            if key_handle in removed:
+                results.append({'id': key_handle, 'status': 'ok'})
+            else:
+                results.append({
+                    'id'     : key_handle,
+                    'status' : 'failed',
+                    'error'  : 'No device with such an id been found!'
+                })
+
+        if not removed:
+            return {
+                'status'  : 'failed',
+                'error'   : 'No device with such an id been found!',
+                'results' : results
+            }
+
+        self.__save_hook(remaining)
+        self.devices_changed(removed=removed)
+
+        return {
+            'status'  : 'ok',
+            'message' : 'Successfully deleted {count} device(s)!'.format(count=len(removed)),
+            'results' : results
+        }
+
+
+# ----- Challenges ----- #
+    def keeps_challenges(self):
+        """Returns True if pending challenges are kept by the injected store"""
+        return self.__store is not None and self.__store.keeps_challenges
+
+    def read_for_challenge(self, kind, challenge):
+        """
+        Returns users devices. If the store keeps challenges, it also keeps
+        the new challenge in the same round trip.
+        """
+
+        if self.keeps_challenges():
+            if NONCE_KEY not in session:
+                session[NONCE_KEY] = websafe_encode(os.urandom(12))
+
+            return self.call_storage(self.__store.issue_challenge, self.__read_timeout, self.__get_identity(), kind,
+                                     websafe_encode(challenge), self.__challenge_ttl, session[NONCE_KEY])
+
+        return self.read_devices(stale=True)
+
+    def issue_challenge(self, kind, data, challenge, devices):
+        """
+        Keeps challenge state in session, or in stateless mode adds it to data
+        as challengeToken, signed and bound to the user and device set.
+        Store kept challenges were already saved by read_for_challenge().
+
+        Session keeps the challenge and device set hash only, so that its
+        size does not grow with the number of devices.
+        """
+
+        if self.keeps_challenges():
+            return
+
+        state = {
+            'kind'      : kind,
+            'devices'   : self.core.device_set_hash(devices),
+            'challenge' : challenge
+        }
+
+        if self.__stateless:
+            state['user'] = self.__get_identity()
+            data['challengeToken'] = self.challenge_serializer().dumps(state)
+        else:
+            session[SESSION_KEYS[kind]] = state
+            session[SESSION_KEYS[kind] + 'expires_'] = time.time() + self.__challenge_ttl
+
+    def pop_challenge(self, kind, payload):
+        """
+        Returns pending challenge state, its expiration time, or None if it
+        is checked otherwise, and users devices.
+        Devices are None unless the store keeps challenges, in which case they
+        are fetched in the same round trip. Otherwise there is no I/O.
+        """
+
+        if self.keeps_challenges():
+            # Logins of a user in several browsers each consume their own challenge
+            challenge, devices = self.call_storage(self.__store.consume_challenge, self.__read_timeout,
+                                                   self.__get_identity(), kind, session.get(NONCE_KEY))
+            return challenge, None, devices
+
+        if self.__stateless:
+            # Expiration is checked by token max_age
+            token = payload.get('challengeToken') if isinstance(payload, dict) else None
+            return (token if isinstance(token, str) else None), None, None
+
+        key     = SESSION_KEYS[kind]
+        state   = session.pop(key, None)
+        expires = session.pop(key + 'expires_', None)
+
+        # Request JSON kept by earlier versions has no expiration time. It was
+        # issued before the upgrade, so it expires at the legacy cutoff rather
+        # than relying on the replay cache, which forgets it. Challenge states
+        # always have one
+        if expires is None:
+            expires = 0 if isinstance(state, dict) else self.__legacy_cutoff
+
+        return state, expires, None
+
+    def load_challenge(self, kind, state, devices):
+        """Returns challenge request JSON of pending challenge state"""
+
+        if self.keeps_challenges():
+            # Store expires and removes challenge on first use
+            return self.core.build_challenge(kind, state, devices)
+
+        if self.__stateless:
+            try:
+                token = self.challenge_serializer().loads(state, max_age=self.__challenge_ttl)
+            except BadSignature as e:
+                raise U2FFailure(FailureReason.BAD_CHALLENGE, 'Invalid or expired challenge token!', e)
+
+            if token.get('user') != self.__get_identity():
+                raise U2FFailure(FailureReason.BAD_CHALLENGE, 'Challenge token was issued for another request!')
+
+        elif isinstance(state, dict):
+            token = state
+
+        else:
+            # Whole request JSON, as kept in session by earlier versions
+            return state
+
+        if token.get('kind') != kind:
+            raise U2FFailure(FailureReason.BAD_CHALLENGE, 'Challenge token was issued for another request!')
+
+        if token.get('devices') != self.core.device_set_hash(devices):
+            raise U2FFailure(FailureReason.BAD_CHALLENGE, 'Devices have changed since challenge was issued!')
+
+        return self.core.build_challenge(kind, token['challenge'], devices)
+
+    def challenge_serializer(self):
+        """Returns serializer of stateless challenge tokens"""
+        return URLSafeTimedSerializer(self.app.secret_key, salt='flask-fido-u2f-challenge')
+
+# ----- Utilities ----- #
+    def read_payload(self):
+        """Reads JSON request body. Raises U2FFailure if it exceeds U2F_MAX_PAYLOAD_SIZE"""
+
+        if (request.content_length or 0) > self.__max_payload:
+            raise U2FFailure(FailureReason.MALFORMED_PAYLOAD, 'Payload too large!')
+
+        if request.content_length is not None:
+            # Bounded by the length checked above. Cached, so bodies read
+            # before, e.g. by get_json() in a before_request, are still seen
+            data = request.get_data(cache=True)
+        else:
+            data = request.stream.read(self.__max_payload + 1)
+
+        if len(data) > self.__max_payload:
+            raise U2FFailure(FailureReason.MALFORMED_PAYLOAD, 'Payload too large!')
+
+        try:
+            return json.loads(data.decode('utf-8'))
+        except ValueError:
+            return None
+
+    def failed(self, operation, failure, error):
+        """Counts failure by reason, passes it to fail callback and returns failure response"""
+
+        self.metrics.incr(operation + '.' + failure.reason.value)
+
+        if operation == 'enroll':
+            on_fail = self.__call_fail_enroll
+        else:
+            on_fail = self.__call_fail_sign
+
+        if on_fail:
+            on_fail(failure)
+
+        self.publish(operation + '.fail', failure=failure)
+
+        return {
+            'status' : 'failed',
+            'error'  : error,
+            'code'   : failure.reason.value
+        }
+
+    def verify_certificate(self, signature):
+        """FUTURE: if enforced by policy, verify certificate in public directory"""
+        pass
+
+    def verify_counter(self, signature, counter, device=None, fresh=False):
+        """
+        Verifies that counter value is greater than previous signature.
+        Usage statistics, last_used and use_count, are updated along with the counter.
+
+        With a warm U2F_KEY_CACHE, counters saved through @u2f.save_counters
+        are compared with the cached one, without reading devices again: the
+        store still rejects counters it already has. Cached entries are only
+        used for the signing device, as read for the user, if their public
+        key is the one of that device.
+
+        A fresh device, read in the same round trip as its challenge, is not
+        read again when counters are saved through @u2f.save_counters.
+        """ 
+
+        key_handle = signature['keyHandle']
+        last_used  = int(time.time())
+        key_cache  = self.key_cache
+
+        # Counters are saved by user and key handle, as key handles of different users may collide
+        key = (self.__get_identity(), key_handle) if self.__save_u2f_counters else None
+
+        cached = None
+        if key_cache is not None and self.__save_u2f_counters and device is not None:
+            cached = key_cache.get(key)
+
+            if cached is not None and cached[0] != websafe_decode(device['publicKey']):
+                cached = None
+
+        if cached is not None:
+            public_key, stored = cached[0], max(cached[1], device['counter'])
+
+        # Store rejects counters it already has, in the same update
+        elif fresh and device is not None and self.__save_u2f_counters:
+            public_key, stored = device['publicKey'], device['counter']
+
+        else:
+            devices = self.read_devices(fresh=True)
+            device  = next((device for device in devices if device['keyHandle'] == key_handle), None)
+
+            # Device was removed
+            if device is None:
+                return None
+
+            public_key, stored = device['publicKey'], device['counter']
+
+        if self.__counter_writer:
+            verified = self.__counter_writer.advance(key, stored, counter, last_used=last_used)
+
+        elif counter <= stored:
+            verified = False
+
+        # Single row update, if available. Key handles rejected
+        # by the store were advanced concurrently
+        elif self.__save_u2f_counters:
+            rejected = self.__save_counters_hook({key: {
+                'counter'   : counter,
+                'last_used' : last_used,
+                'uses'      : 1
+            }})
+            self.devices_changed()
+
+            verified = not rejected or key not in rejected
+
+        # Updating counter record
+        else:
+            device['counter']   = counter
+            device['last_used'] = last_used
+            device['use_count'] = device.get('use_count', 0) + 1
+            self.__save_hook(devices)
+            self.devices_changed()
+
+            verified = True
+
+        if verified and key_cache is not None:
+            if isinstance(public_key, str):
+                public_key = websafe_decode(public_key)
+
+            key_cache.put(key, public_key, counter)
+
+        return verified
+
+    def read_devices(self, fresh=False, stale=False):
+        """
+        Returns users devices. With U2F_READ_COALESCING, concurrent reads of
+        a user share one @u2f.read call, unless fresh is set, as by writes.
+
+        With U2F_STALE_READ_MAX_AGE and stale set, as for challenges, the
+        devices last read for the user are returned while storage is unavailable.
+        """
+
+        # Listening before anything is kept, so that no invalidation is missed
+        if self.invalidation is not None:
+            self.invalidation.ensure_started()
+
+        try:
+            if self.__read_flight is None:
+                devices = self.__read_hook()
+
+            elif fresh:
+                self.__read_flight.forget(self.__get_identity())
+                devices = self.__read_hook()
+
+            else:
+                devices = self.__read_flight.do(self.__get_identity(), self.__read_hook)
+        except StorageUnavailable:
+            if not stale or self.__stale_reads is None:
+                raise
+
+            devices = self.__stale_reads.get(self.__get_identity())
+            if devices is None:
+                raise
+
+            self.metrics.incr('storage.stale_read')
+            return devices
+
+        if self.__stale_reads is not None:
+            self.__stale_reads.put(self.__get_identity(), devices)
+
+        return devices
+
+    def call_storage(self, hook, timeout, *args):
+        """
+        Calls storage hook through the circuit breaker, waiting timeout seconds
+        at most, if enabled. Raises StorageUnavailable.
+        """
+
+        if self.breaker is None:
+            return hook(*args)
+
+        if timeout is not None and has_request_context():
+            hook = self.request_bound(hook)
+
+        return self.breaker.call(hook, *args, timeout=timeout)
+
+    def request_bound(self, hook):
+        """
+        Returns hook bound to the current request, to be run on another
+        thread. Hooks see the same request, session and flask.g, e.g. the
+        user loaded by a before_request handler.
+        """
+
+        hook    = copy_current_request_context(hook)
+        context = current_app._get_current_object().app_context()
+
+        # The app context of the request carries g, the copied request context
+        # would otherwise push a new one with an empty g
+        context.g = g._get_current_object()
+
+        @functools.wraps(hook)
+        def wrapper(*args):
+            with context:
+                return hook(*args)
+
+        return wrapper
+
+    def __read_hook(self):
+        return self.call_storage(self.__get_u2f_devices, self.__read_timeout)
+
+    def __save_hook(self, devices):
+        return self.call_storage(self.__save_u2f_devices, self.__save_timeout, devices)
+
+    def __save_counters_hook(self, batch):
+        return self.call_storage(self.__save_u2f_counters, self.__save_timeout, batch)
+
+    def devices_changed(self, removed=(), added=()):
+        """
+        Drops users devices shared by coalesced reads or kept for stale reads,
+        and removed key handles from key cache, after a write. Added or
+        removed key handles are broadcast to other processes through the
+        invalidation channel. Counter updates are not, as counters are
+        compared with fresh reads or by the store.
+        """
+
+        user = self.__get_identity() if self.__get_identity else None
+        self.invalidate(user, removed)
+
+        if self.invalidation is not None and (removed or added):
+            self.invalidation.publish(user, list(removed) + list(added))
+
+    def invalidate(self, user, key_handles=()):
+        """Drops devices kept of user, and key handles from key cache. Called on invalidations of other processes"""
+        if self.__read_flight is not None:
+            self.__read_flight.forget(user)
+
+        if self.__stale_reads is not None:
+            self.__stale_reads.forget(user)
+
+        if self.key_cache is not None:
+            for key_handle in key_handles:
+                self.key_cache.discard((user, key_handle))
+
+    def check_anomalies(self, key_handle, counter):
+        """Passes counter to anomaly detector, and anomalies to sign_on_anomaly callback"""
+        if self.__anomaly_detector is None:
+            return []
+
+        # Key handles may collide across users, so windows are kept per user
+        anomalies = self.__anomaly_detector.observe(key_handle, counter, user=self.__get_identity())
+
+        for anomaly in anomalies:
+            self.metrics.incr('sign.anomaly.' + anomaly.kind)
+
+            if self.__call_anomaly_sign:
+                self.__call_anomaly_sign(anomaly)
+
+            self.publish('sign.anomaly', key_handle=key_handle, counter=counter, anomaly=anomaly)
+
+        return anomalies
+
+    def publish(self, kind, **fields):
+        """Publishes U2FEvent of kind, for the current request, to event subscribers"""
+
+        user = None
+        if self.__get_identity:
+            try:
+                user = self.__get_identity()
+            except Exception:
+                pass
+
+        self.events.publish(U2FEvent(kind, user=user, remote_addr=request.remote_addr, **fields))
+
+    def flush_counters(self):
+        """Writes pending write-behind counters to storage"""
+        if self.__counter_writer:
+            return self.__counter_writer.flush()
+
+        return 0
+
+    def has_registered_devices(self):
+        """Returns if user has devices"""
+        return len(self.read_devices()) > 0
+
+# ----- Session ----- #
+    def reset_session(self):
+        """ Removes
+                session['u2f_sign_required']
+                session['u2f_enroll_authorized']
+                session['u2f_device_management_authorized']
+            session variables.
+        """
+        self.disable_sign()
+        self.disable_enroll()
+        self.disable_device_management()
+
+    def enable_sign(self):
+        """ Sets session['u2f_sign_required'] to True """
+        session['u2f_sign_required'] = True
+
+    def enable_enroll(self):
+        """ Sets session['u2f_enroll_authorized'] to True """
+        session['u2f_enroll_authorized'] = True
+
+    def enable_device_management(self):
+        """ Sets session['u2f_device_management_authorized'] to True """
+        session['u2f_device_management_authorized'] = True
+
+
+    def disable_sign(self):
+        """ Sets session['u2f_sign_required'] to None """
+        session.pop('u2f_sign_required', True)
+        
+    def disable_enroll(self):
+        """ Sets session['u2f_enroll_authorized'] to None """
+        session.pop('u2f_enroll_authorized', True)
+        
+    def disable_device_management(self):
+        """ Sets session['u2f_device_management_authorized'] to None """
+        session.pop('u2f_device_management_authorized', True)
+
+
+# ----- Injectors ----- #
+    def read(self, func):
+        """Injects read function that reads and returns U2F object"""
+        self.__get_u2f_devices = func
+
+    def save(self, func):
+        """Injects save function that takes U2F object and saves it"""
+        self.__save_u2f_devices = func
+
+    def save_counters(self, func):
+        """
+        Injects function that takes dict of (user, keyHandle) -> updated fields, e.g.
+        { ('alice', 'kh1'): {'counter': 12, 'last_used': 1500000000, 'uses': 1} }, and saves it.
+        Users are those returned by @u2f.identity, which is required.
+        'uses' is the number of signatures to add to the device use_count.
+        Used by U2F_COUNTER_WRITE_BEHIND. If injected, counters are also saved
+        through it instead of @u2f.save. It may return set of (user, keyHandle)
+        whose stored counter was already ahead.
+        """
+        self.__save_u2f_counters = func
+
+    def use_store(self, store):
+        """Injects read, save and save_counters of DeviceStore, for the user returned by @u2f.identity"""
+        self.__store = store
+
+        self.read(lambda: store.read(self.__get_identity()))
+        self.save(lambda devices: store.save(self.__get_identity(), devices))
+        self.save_counters(store.save_counters)
+
+    def use_invalidation(self, channel):
+        """
+        Injects InvalidationChannel, broadcasting device mutations to other
+        processes, e.g. RedisInvalidationChannel for clusters. Devices kept by
+        U2F_READ_COALESCING, U2F_STALE_READ_MAX_AGE and U2F_KEY_CACHE_SIZE
+        are dropped on invalidations of other processes. Requires @u2f.identity.
+        """
+
+        if channel is self.invalidation:
+            return
+
+        if self.invalidation is not None:
+            self.invalidation.close()
+
+        if channel.metrics is None:
+            channel.metrics = self.metrics
+
+        channel.subscribe(self.invalidate)
+        atexit.register(channel.close)
+
+        self.invalidation = channel
+
+    def identity(self, func):
+        """Injects function that returns identifier of the current user. Required by U2F_STATELESS_CHALLENGES and use_store()"""
+        self.__get_identity = func
+
+    def enroll_on_success(self, func):
+        """Injects function that would be called on successfull enrollment"""
+        self.__call_success_enroll = func
+
+    def enroll_on_fail(self, func):
+        """Injects function that would be called on enrollment failure"""
+        self.__call_fail_enroll = func
+
+    def sign_on_success(self, func):
+        """Injects function that would be called on successfull U2F authentication"""
+        self.__call_success_sign = func
+
+    def sign_on_fail(self, func):
+        """Injects function that would be called on U2F authentication failure"""
+        self.__call_fail_sign = func
+
+    def subscribe(self, *kinds, **options):
+        """
+        Subscribes function to U2F events of given kinds, all by default.
+        It takes U2FEvent, or a list of them with batch=True, and is called by
+        background workers, after the response. Callbacks that must affect
+        the response are injected with enroll_on_success and the like.
+        """
+
+        def decorator(func):
+            self.events.subscribe(func, kinds or None, batch=options.get('batch', False))
+            return func
+
+        return decorator
+
+    def sign_on_anomaly(self, func):
+        """Injects function that would be called with CounterAnomaly, when U2F_ANOMALY_DETECTION flags a verified signature"""
+        self.__call_anomaly_sign = func
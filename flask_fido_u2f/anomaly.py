@@ -0,0 +1,141 @@
+import time
+import threading
+
+from collections import deque, OrderedDict
+
+
+class CounterAnomaly(object):
+    """
+    Passed to sign_on_anomaly callbacks.
+
+    Attributes:
+        kind:
+            (String) - 'jump' for a counter jump, 'burst' for too many signatures in a short time.
+
+        key_handle:
+            (String) - Key handle of the device.
+
+        counter:
+            (Integer) - Counter of the signature.
+
+        delta:
+            (Integer) - Difference from the previous signature counter.
+
+        user:
+            (String) - User of the device, as returned by @u2f.identity.
+    """
+
+    def __init__(self, kind, key_handle, counter, delta, user=None):
+        self.kind       = kind
+        self.key_handle = key_handle
+        self.counter    = counter
+        self.delta      = delta
+        self.user       = user
+
+    def __repr__(self):
+        return 'CounterAnomaly({kind!r}, {key_handle!r}, counter={counter}, delta={delta}, user={user!r})'.format(
+            **self.__dict__)
+
+
+class CounterWindow(object):
+    """Last counter, with deltas and timestamps of the last signatures of a device"""
+
+    __slots__ = ('counter', 'deltas', 'times', 'total')
+
+    def __init__(self, counter, size):
+        self.counter = counter
+        self.deltas  = deque(maxlen=size)
+        self.times   = deque(maxlen=size)
+        self.total   = 0
+
+
+class CounterAnomalyDetector(object):
+    """
+    Sliding window tracker of signature counters.
+
+    Keeps deltas and timestamps of the last `window` signatures of each
+    device, and flags:
+
+        jump:  delta above `max_jump`, and `jump_factor` times the average
+               delta of the window, so that keys shared with busy sites
+               do not raise alarms on every login.
+        burst: more than `window` signatures within `burst_interval` seconds.
+
+    Each observation is O(1). At most `max_entries` devices are tracked,
+    least recently used are evicted. Devices are kept by (user, keyHandle),
+    as key handles are chosen by devices and may collide across users.
+
+    Arguments:
+        window:
+            (Integer) - Number of signatures kept per device.
+
+        max_jump:
+            (Integer) - Smallest counter delta flagged as a jump.
+
+        jump_factor:
+            (Float) - Delta must also exceed the average delta times this factor.
+
+        burst_interval:
+            (Float) - Seconds in which more than `window` signatures are flagged as a burst.
+
+        max_entries:
+            (Integer) - Number of tracked devices.
+    """
+
+    def __init__(self, window=10, max_jump=1000, jump_factor=10, burst_interval=60, max_entries=100000):
+        self.window         = window
+        self.max_jump       = max_jump
+        self.jump_factor    = jump_factor
+        self.burst_interval = burst_interval
+        self.max_entries    = max_entries
+
+        self.__windows = OrderedDict()
+        self.__lock    = threading.Lock()
+
+    def __len__(self):
+        return len(self.__windows)
+
+    def observe(self, key_handle, counter, now=None, user=None):
+        """Records signature counter of users device. Returns list of CounterAnomaly"""
+
+        now = time.time() if now is None else now
+        key = (user, key_handle)
+
+        with self.__lock:
+            window = self.__windows.get(key)
+
+            if window is None:
+                # Nothing to compare the first signature with
+                self.__windows[key] = window = CounterWindow(counter, self.window)
+                window.times.append(now)
+
+                if len(self.__windows) > self.max_entries:
+                    self.__windows.popitem(last=False)
+
+                return []
+
+            self.__windows.move_to_end(key)
+
+            delta     = counter - window.counter
+            anomalies = []
+
+            if window.deltas:
+                average = window.total / len(window.deltas)
+            else:
+                average = 0
+
+            if delta > self.max_jump and delta > average * self.jump_factor:
+                anomalies.append(CounterAnomaly('jump', key_handle, counter, delta, user))
+
+            if len(window.times) == window.times.maxlen and now - window.times[0] < self.burst_interval:
+                anomalies.append(CounterAnomaly('burst', key_handle, counter, delta, user))
+
+            if len(window.deltas) == window.deltas.maxlen:
+                window.total -= window.deltas[0]
+
+            window.deltas.append(delta)
+            window.times.append(now)
+            window.total  += delta
+            window.counter = counter
+
+        return anomalies
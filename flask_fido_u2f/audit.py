@@ -0,0 +1,268 @@
+"""
+Offline audit of device stores.
+
+Streams every stored device, sharded by user across a process pool, and
+reports:
+
+    duplicate_key_handle  - Key handle stored more than once, e.g. for two users
+    counter_regression    - Counter below use_count, or negative, which
+                            counters that only move forward never are
+    appid_mismatch        - appId not among --app-id, e.g. after an appid change
+    bad_index             - Index not an integer, or shared with another device
+                            of the user, e.g. rows inserted with the default 0.
+                            Gaps are left by removals, and are not reported
+
+    python -m flask_fido_u2f.audit --store sqlite:///u2f.sqlite --app-id https://example.com
+    python -m flask_fido_u2f.audit --store postgresql://db/u2f --workers 8 --json
+    python -m flask_fido_u2f.audit --store redis://localhost:6379/0 --prefix u2f:
+    python -m flask_fido_u2f.audit --adapter myapp.stores:open_store --store postgresql://db/app
+
+Custom DeviceStores are audited through --adapter, an importable factory
+returning the store. Workers import and call it themselves, with --store
+URL if given, so that the store itself is never pickled.
+
+Workers keep an 8 byte digest per key handle, returned sorted, and merged
+by the parent to find duplicates. Only duplicated digests are scanned for
+again, to name the users of the duplicated key handles.
+"""
+
+import sys
+import json
+import time
+import heapq
+import hashlib
+import argparse
+
+from collections import Counter, defaultdict
+from concurrent.futures import ProcessPoolExecutor
+
+DIGEST_SIZE = 8
+
+ISSUES = ('duplicate_key_handle', 'counter_regression', 'appid_mismatch', 'bad_index')
+
+
+def open_store(url=None, prefix='u2f:', table='u2f_devices', adapter=None):
+    """
+    Returns read only device store of URL: sqlite:///path, redis://..., or
+    any SQLAlchemy URL. Tables are neither created nor migrated.
+
+    adapter, 'module:callable', names a factory of custom DeviceStore. It is
+    called with URL, or without arguments if there is none.
+    """
+    from .stores import SQLiteDeviceStore, SQLAlchemyDeviceStore, RedisDeviceStore
+
+    if adapter is not None:
+        from werkzeug.utils import import_string
+
+        factory = import_string(adapter)
+        return factory() if url is None else factory(url)
+
+    if url.startswith('sqlite:///') and table == 'u2f_devices':
+        return SQLiteDeviceStore(url[len('sqlite:///'):], read_only=True)
+
+    if url.startswith(('redis://', 'rediss://', 'unix://')):
+        import redis
+        return RedisDeviceStore(redis.Redis.from_url(url), prefix=prefix)
+
+    return SQLAlchemyDeviceStore(url, table_name=table, read_only=True)
+
+
+def digest(key_handle):
+    return hashlib.sha256(key_handle.encode('utf-8')).digest()[:DIGEST_SIZE]
+
+
+def check_device(device, app_ids, indexes=None):
+    """
+    Returns list of issues of a single device. indexes is the set of indexes
+    of users devices checked so far, and is updated.
+    """
+    issues  = []
+    counter = device.get('counter', 0)
+    index   = device.get('index')
+
+    if not isinstance(counter, int) or counter < 0 or counter < device.get('use_count', 0):
+        issues.append('counter_regression')
+
+    if app_ids and device.get('appId') not in app_ids:
+        issues.append('appid_mismatch')
+
+    if not isinstance(index, int) or (indexes is not None and index in indexes):
+        issues.append('bad_index')
+
+    if indexes is not None and isinstance(index, int):
+        indexes.add(index)
+
+    return issues
+
+
+def scan_shard(store_args, shard, app_ids, examples, batch_size):
+    """
+    Audits one shard. Returns stats, issue counts, examples by issue, and
+    sorted digests of key handles as bytes.
+    """
+    store   = open_store(*store_args)
+    start   = time.perf_counter()
+    counts  = Counter()
+    found   = defaultdict(list)
+    digests = []
+    users   = 0
+    last    = object()
+    indexes = set()
+
+    for user, device in store.iter_devices(shard, batch_size=batch_size):
+        if user != last:
+            users  += 1
+            last    = user
+            indexes = set()
+
+        digests.append(digest(device['keyHandle']))
+
+        for issue in check_device(device, app_ids, indexes):
+            counts[issue] += 1
+
+            if len(found[issue]) < examples:
+                found[issue].append({'user': user, 'keyHandle': device['keyHandle'],
+                                     'appId': device.get('appId'), 'counter': device.get('counter'),
+                                     'use_count': device.get('use_count', 0), 'index': device.get('index')})
+
+    digests.sort()
+
+    return {
+        'records'  : len(digests),
+        'users'    : users,
+        'elapsed'  : time.perf_counter() - start,
+        'counts'   : dict(counts),
+        'examples' : dict(found),
+        'digests'  : b''.join(digests)
+    }
+
+
+def find_key_handles(store_args, shard, wanted, batch_size):
+    """Returns [(key_handle, user)] of shard devices whose key handle digest is wanted"""
+    store = open_store(*store_args)
+
+    return [(device['keyHandle'], user) for user, device in store.iter_devices(shard, batch_size=batch_size)
+            if digest(device['keyHandle']) in wanted]
+
+
+def split(digests):
+    view = memoryview(digests)
+    for offset in range(0, len(view), DIGEST_SIZE):
+        yield bytes(view[offset:offset + DIGEST_SIZE])
+
+
+def duplicates(shard_digests):
+    """Returns set of digests found more than once across sorted shard digests"""
+    found    = set()
+    previous = None
+
+    for value in heapq.merge(*[split(digests) for digests in shard_digests]):
+        if value == previous:
+            found.add(value)
+
+        previous = value
+
+    return found
+
+
+def audit(store_args, workers=4, shards=None, app_ids=(), examples=10, batch_size=1000):
+    """Audits store opened by open_store(*store_args). Returns report dict"""
+    start  = time.perf_counter()
+    shards = open_store(*store_args).shards(shards or workers * 4)
+
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        results = list(pool.map(scan_shard, [store_args] * len(shards), shards,
+                                [set(app_ids)] * len(shards), [examples] * len(shards), [batch_size] * len(shards)))
+
+        wanted = duplicates(result.pop('digests') for result in results)
+
+        owners = defaultdict(list)
+        if wanted:
+            for matches in pool.map(find_key_handles, [store_args] * len(shards), shards,
+                                    [wanted] * len(shards), [batch_size] * len(shards)):
+                for key_handle, user in matches:
+                    owners[key_handle].append(user)
+
+    elapsed = time.perf_counter() - start
+    counts  = Counter()
+    found   = defaultdict(list)
+
+    for result in results:
+        counts.update(result['counts'])
+
+        for issue, records in result['examples'].items():
+            found[issue].extend(records[:examples - len(found[issue])])
+
+    # Digests only point at candidates, owners confirm them. A key seen
+    # twice by SCAN does not make a duplicate
+    owners     = dict((key_handle, sorted(set(users))) for key_handle, users in owners.items())
+    duplicated = [(key_handle, users) for key_handle, users in sorted(owners.items()) if len(users) > 1]
+    counts['duplicate_key_handle'] = len(duplicated)
+    found['duplicate_key_handle']  = [{'keyHandle': key_handle, 'users': users}
+                                      for key_handle, users in duplicated[:examples]]
+
+    records = sum(result['records'] for result in results)
+
+    return {
+        'records'  : records,
+        'users'    : sum(result['users'] for result in results),
+        'elapsed'  : elapsed,
+        'rate'     : records / elapsed if elapsed else 0.0,
+        'shards'   : [{'records': result['records'], 'elapsed': result['elapsed'],
+                       'rate': result['records'] / result['elapsed'] if result['elapsed'] else 0.0}
+                      for result in results],
+        'issues'   : dict((issue, counts.get(issue, 0)) for issue in ISSUES),
+        'examples' : dict((issue, found.get(issue, [])) for issue in ISSUES)
+    }
+
+
+def print_report(report, output=sys.stdout):
+    rates = sorted(shard['rate'] for shard in report['shards']) or [0.0]
+
+    output.write('{records} devices of {users} users in {elapsed:.1f} s, {rate:.0f} devices/s\n'.format(**report))
+    output.write('{count} shards, {low:.0f} to {high:.0f} devices/s per shard\n\n'.format(
+        count=len(report['shards']), low=rates[0], high=rates[-1]))
+
+    for issue in ISSUES:
+        output.write('  {issue:<22} {count:>10}\n'.format(issue=issue, count=report['issues'][issue]))
+
+        for example in report['examples'][issue]:
+            output.write('      {0}\n'.format(json.dumps(example, sort_keys=True)))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Audits stored U2F devices')
+    parser.add_argument('--store',      default=None, help='sqlite:///path, redis://... or SQLAlchemy URL')
+    parser.add_argument('--adapter',    default=None, help='module:callable returning custom DeviceStore')
+    parser.add_argument('--prefix',     default='u2f:', help='Key prefix of Redis store')
+    parser.add_argument('--table',      default='u2f_devices', help='Table of SQLAlchemy store')
+    parser.add_argument('--app-id',     action='append', default=[], help='Expected appId, may be repeated')
+    parser.add_argument('--workers',    type=int, default=4)
+    parser.add_argument('--shards',     type=int, default=None, help='Defaults to 4 per worker')
+    parser.add_argument('--examples',   type=int, default=10, help='Records listed per issue')
+    parser.add_argument('--batch-size', type=int, default=1000)
+    parser.add_argument('--json',       action='store_true', help='Print report as JSON')
+    args = parser.parse_args(argv)
+
+    if args.store is None and args.adapter is None:
+        parser.error('one of --store or --adapter is required')
+
+    report = audit((args.store, args.prefix, args.table, args.adapter)
+        , workers    = args.workers
+        , shards     = args.shards
+        , app_ids    = args.app_id
+        , examples   = args.examples
+        , batch_size = args.batch_size)
+
+    if args.json:
+        json.dump(report, sys.stdout, indent=2, sort_keys=True)
+        sys.stdout.write('\n')
+    else:
+        print_report(report)
+
+    # Non-zero exit status on issues, for cron jobs and CI
+    return 1 if any(report['issues'].values()) else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
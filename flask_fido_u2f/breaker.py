@@ -0,0 +1,209 @@
+import time
+import threading
+
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, TimeoutError
+
+from .errors import StorageUnavailable
+from .forksafe import PerProcess
+
+
+class CircuitBreaker(object):
+    """
+    Timeouts and circuit breaker around storage hooks.
+
+    Calls given a timeout are run on a thread pool, and the caller stops
+    waiting after `timeout` seconds: calls still queued are cancelled, but
+    a hook already running cannot be interrupted and may still complete,
+    e.g. a save after its request failed. The request is no longer held by
+    it. Timeouts and errors raise StorageUnavailable.
+
+    After `failures` consecutive timeouts or errors the circuit opens, and
+    calls fail fast with StorageUnavailable, without calling the hook. After
+    `reset_timeout` seconds a single trial call is let through: if it
+    succeeds the circuit closes, otherwise it stays open for another
+    `reset_timeout`.
+
+    Counted in metrics: 'storage.timeout', 'storage.error',
+    'breaker.rejected', 'breaker.opened' on every trip, and 'breaker.open',
+    which is 1 while the circuit is open or half open, and 0 when closed.
+
+    Arguments:
+        failures:
+            (Integer) - Consecutive failures that open the circuit. 0 never opens it.
+
+        reset_timeout:
+            (Float) - Seconds the circuit stays open before a trial call.
+
+        max_workers:
+            (Integer) - Number of threads running calls with timeout, per process.
+
+        metrics:
+            (Metrics) - Optional counters.
+    """
+
+    CLOSED    = 'closed'
+    OPEN      = 'open'
+    HALF_OPEN = 'half_open'
+
+    def __init__(self, failures=5, reset_timeout=30.0, max_workers=16, metrics=None):
+        self.failures      = failures
+        self.reset_timeout = reset_timeout
+        self.max_workers   = max_workers
+
+        self.__metrics   = metrics
+        self.__lock      = threading.Lock()
+        self.__state     = self.CLOSED
+        self.__count     = 0
+        self.__opened_at = None
+        self.__trial     = False
+        self.__executor  = None
+        self.__started   = PerProcess(self.__start)
+
+    @property
+    def state(self):
+        """Returns CLOSED, OPEN or HALF_OPEN"""
+        return self.__state
+
+    def call(self, func, *args, **kwargs):
+        """
+        Returns func(*args) result. Takes timeout keyword, in seconds, None
+        waits for the call to finish. Raises StorageUnavailable.
+        """
+
+        timeout = kwargs.get('timeout', None)
+
+        trial = self.__allow()
+
+        try:
+            if timeout is None:
+                result = func(*args)
+            else:
+                future = self.__submit(func, args)
+                result = future.result(timeout)
+        except TimeoutError as e:
+            # Queued calls must not run once their caller gave up
+            future.cancel()
+            self.__failed(trial, 'storage.timeout')
+            raise StorageUnavailable('Storage timed out!', e)
+        except Exception as e:
+            self.__failed(trial, 'storage.error')
+            raise StorageUnavailable('Storage failed!', e)
+
+        self.__succeeded(trial)
+        return result
+
+    def reset(self):
+        """Closes the circuit"""
+        with self.__lock:
+            self.__close()
+
+    def __allow(self):
+        # Returns True for the trial call of a half open circuit
+        with self.__lock:
+            if self.__state == self.CLOSED:
+                return False
+
+            if not self.__trial and time.time() - self.__opened_at >= self.reset_timeout:
+                self.__state = self.HALF_OPEN
+                self.__trial = True
+                return True
+
+        self.__incr('breaker.rejected')
+        raise StorageUnavailable('Storage circuit is open!')
+
+    def __succeeded(self, trial):
+        with self.__lock:
+            if trial or self.__state == self.CLOSED:
+                self.__close()
+
+    def __failed(self, trial, metric):
+        self.__incr(metric)
+
+        with self.__lock:
+            if trial:
+                self.__trial     = False
+                self.__opened_at = time.time()
+                self.__state     = self.OPEN
+                return
+
+            if self.__state != self.CLOSED:
+                return
+
+            self.__count += 1
+            if self.failures and self.__count >= self.failures:
+                self.__state     = self.OPEN
+                self.__opened_at = time.time()
+
+                self.__incr('breaker.opened')
+                self.__incr('breaker.open')
+
+    def __close(self):
+        # Called with lock held
+        if self.__state != self.CLOSED:
+            self.__incr('breaker.open', -1)
+
+        self.__state = self.CLOSED
+        self.__count = 0
+        self.__trial = False
+
+    def __submit(self, func, args):
+        self.__started.ensure()
+        return self.__executor.submit(func, *args)
+
+    def __start(self):
+        self.__executor = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix='u2f-storage')
+
+    def __incr(self, name, value=1):
+        if self.__metrics:
+            self.__metrics.incr(name, value)
+
+
+class StaleReads(object):
+    """
+    Last device lists read per user, served for challenge generation while
+    storage is unavailable, if not older than `max_age` seconds. Entries are
+    dropped on writes of the user.
+
+    Arguments:
+        max_age:
+            (Float) - Seconds a device list may be served after it was read.
+
+        max_entries:
+            (Integer) - Number of kept users, least recently read are dropped.
+    """
+
+    def __init__(self, max_age, max_entries=10000):
+        self.max_age     = max_age
+        self.max_entries = max_entries
+
+        self.__entries = OrderedDict()
+        self.__lock    = threading.Lock()
+
+    def __len__(self):
+        return len(self.__entries)
+
+    def put(self, user, devices):
+        """Keeps copy of devices read for user"""
+        entry = (time.time(), [dict(device) for device in devices])
+
+        with self.__lock:
+            self.__entries[user] = entry
+            self.__entries.move_to_end(user)
+
+            while len(self.__entries) > self.max_entries:
+                self.__entries.popitem(last=False)
+
+    def get(self, user):
+        """Returns copy of devices of user, or None if unknown or too old"""
+        entry = self.__entries.get(user)
+
+        if entry is None or time.time() - entry[0] > self.max_age:
+            return None
+
+        return [dict(device) for device in entry[1]]
+
+    def forget(self, user):
+        """Drops devices of user"""
+        with self.__lock:
+            self.__entries.pop(user, None)
@@ -0,0 +1,248 @@
+import os
+import json
+import time
+import base64
+import hashlib
+
+from .errors import FailureReason, U2FFailure, classify
+from .facets import FacetIndex
+from .replay import MemoryReplayCache
+from .validation import validate_payload, ENROLL_FIELDS, SIGN_FIELDS
+
+
+def websafe_encode(data):
+    """Returns websafe base64 of bytes, without padding"""
+    return base64.urlsafe_b64encode(data).rstrip(b'=').decode('ascii')
+
+
+def websafe_decode(data):
+    """Returns bytes of websafe base64 string, with or without padding"""
+    if isinstance(data, str):
+        data = data.encode('ascii')
+
+    return base64.urlsafe_b64decode(data + b'=' * (-len(data) % 4))
+
+
+class U2FCore(object):
+    """
+    Framework independent U2F engine.
+
+    Takes explicit inputs: challenge requests, client responses and device
+    lists, and returns explicit results or raises U2FFailure. It never
+    touches requests, sessions or storage, so it can be driven from
+    background workers, batch jobs and benchmarks without Flask. The Flask
+    U2F extension keeps challenge state and devices, and delegates to it.
+
+    Arguments:
+        app_id:
+            (String) - U2F application ID.
+
+        facets:
+            (List) - Trusted facets, or FacetIndex. Defaults to [app_id].
+            Kept as FacetIndex, updatable at runtime through core.facets.
+
+        challenge_ttl:
+            (Integer) - Seconds consumed challenges are remembered by replay_cache.
+
+        replay_cache:
+            (ReplayCache) - Cache of consumed challenges. Defaults to MemoryReplayCache.
+
+        challenge_pool:
+            (ChallengePool) - Optional pool of pre-generated challenges.
+
+        engine:
+            (String) - 'u2flib' verifies responses with u2flib, 'native' with the
+            built-in memoryview parser and cryptography, see flask_fido_u2f.native.
+    """
+
+    ENGINES = ('u2flib', 'native')
+
+    def __init__(self, app_id, facets=None, challenge_ttl=300, replay_cache=None, challenge_pool=None, engine='u2flib'):
+        if engine not in self.ENGINES:
+            raise ValueError('Unknown U2F engine {engine!r}, expected one of {engines}'.format(
+                engine=engine, engines=', '.join(self.ENGINES)))
+
+        self.engine         = engine
+        self.app_id         = app_id
+        self.facets         = facets if isinstance(facets, FacetIndex) else \
+                              FacetIndex([app_id] if facets is None else facets)
+        self.challenge_ttl  = challenge_ttl
+        self.replay_cache   = MemoryReplayCache() if replay_cache is None else replay_cache
+        self.challenge_pool = challenge_pool
+
+# ----- Challenges ----- #
+    def new_challenge(self):
+        """Returns random challenge bytes, from the pool if enabled"""
+        if self.challenge_pool is not None:
+            return self.challenge_pool.take()
+
+        return os.urandom(32)
+
+    def start_enroll(self, devices, challenge=None):
+        """Returns enroll request, as RegisterRequestData, for user with given devices"""
+        from u2flib_server.jsapi import DeviceRegistration
+        from u2flib_server.u2f import start_register
+
+        devices = [DeviceRegistration.wrap(device) for device in devices]
+        return start_register(self.app_id, devices, challenge or self.new_challenge())
+
+    def start_sign(self, devices, challenge=None):
+        """
+        Returns sign request, as SignRequestData, for given devices. Single
+        challenge is shared by all devices, as used by u2f.sign(appId, challenge, ...)
+        """
+        from u2flib_server.jsapi import DeviceRegistration
+        from u2flib_server.u2f import start_authenticate
+
+        devices = [DeviceRegistration.wrap(device) for device in devices]
+        return start_authenticate(devices, challenge or self.new_challenge())
+
+    def compact_challenge(self, devices, challenge=None):
+        """
+        Returns enroll or sign request in compact format: appId, version and
+        challenge are sent once, followed by key handles of the given devices.
+        Devices registered under another appId are sent as {keyHandle, appId}.
+        Same data as the registeredKeys of u2f.register() and u2f.sign().
+        """
+
+        return {
+            'appId'      : self.app_id,
+            'version'    : 'U2F_V2',
+            'challenge'  : websafe_encode(challenge or self.new_challenge()),
+            'keyHandles' : [device['keyHandle'] if device['appId'] == self.app_id else {
+                'keyHandle' : device['keyHandle'],
+                'appId'     : device['appId']
+            } for device in devices]
+        }
+
+    def build_challenge(self, kind, challenge, devices):
+        """Rebuilds request JSON of kind 'enroll' or 'sign' from websafe encoded challenge and users devices"""
+
+        if kind == 'enroll':
+            return json.dumps({
+                'registerRequests'     : [{
+                    'version'   : 'U2F_V2',
+                    'appId'     : self.app_id,
+                    'challenge' : challenge
+                }],
+                'authenticateRequests' : []
+            })
+
+        return json.dumps({
+            'authenticateRequests' : [{
+                'version'   : 'U2F_V2',
+                'appId'     : device['appId'],
+                'keyHandle' : device['keyHandle'],
+                'challenge' : challenge
+            } for device in devices]
+        })
+
+    def device_set_hash(self, devices):
+        """Returns short hash of users key handles"""
+        key_handles = sorted(device['keyHandle'] for device in devices)
+        return hashlib.sha256('\n'.join(key_handles).encode('utf-8')).hexdigest()[:32]
+
+# ----- Verification ----- #
+    def complete_enroll(self, request, response, devices, expires=None):
+        """
+        Verifies enroll response against request JSON issued by start_enroll().
+
+        Returns new device, with counter 0 and the next free index. It is
+        not added to devices. Raises U2FFailure.
+        """
+        try:
+            validate_payload(response, ENROLL_FIELDS)
+
+            register_request = json.loads(request)['registerRequests'][0]
+
+            self.verify_challenge(register_request['challenge'], expires)
+            client_data = self.verify_client_data(response, register_request, 'navigator.id.finishEnrollment')
+
+            if self.engine == 'native':
+                from .native import complete_register
+                new_device, cert = complete_register(register_request, response, client_data)
+            else:
+                from u2flib_server.u2f import complete_register
+                new_device, cert = complete_register(request, response, self.facets)
+        except Exception as e:
+            raise classify(e)
+
+        new_device['counter'] = 0
+        new_device['index']   = 0
+
+        for device in devices:
+            if new_device['index'] <= device['index']:
+                new_device['index'] = device['index'] + 1
+
+        return new_device
+
+    def complete_sign(self, request, response, devices, expires=None):
+        """
+        Verifies sign response against request JSON issued by start_sign().
+
+        Returns (device, counter, touch), device being the one that signed.
+        Counter is not compared with the stored one. Raises U2FFailure.
+        """
+        try:
+            validate_payload(response, SIGN_FIELDS)
+
+            key_handle   = response['keyHandle']
+            sign_request = next((r for r in json.loads(request)['authenticateRequests']
+                                 if r['keyHandle'] == key_handle), None)
+
+            device = next((device for device in devices if device['keyHandle'] == key_handle), None)
+
+            if sign_request is None or device is None:
+                raise U2FFailure(FailureReason.UNKNOWN_KEY_HANDLE, 'Key handle was not challenged!')
+
+            self.verify_challenge(sign_request['challenge'], expires)
+            client_data = self.verify_client_data(response, sign_request, 'navigator.id.getAssertion')
+
+            if self.engine == 'native':
+                from .native import verify_authenticate
+                counter, touch = verify_authenticate(device, response, client_data)
+            else:
+                from u2flib_server.jsapi import DeviceRegistration
+                from u2flib_server.u2f import verify_authenticate
+                counter, touch = verify_authenticate([DeviceRegistration.wrap(device)], request, response, self.facets)
+        except Exception as e:
+            raise classify(e)
+
+        return device, counter, touch
+
+    def verify_client_data(self, response, request, typ):
+        """Checks clientData against issued request, to classify failures before crypto. Returns clientData bytes"""
+
+        if not isinstance(response, dict):
+            raise U2FFailure(FailureReason.MALFORMED_PAYLOAD, 'Response must be an object!')
+
+        try:
+            raw         = websafe_decode(response['clientData'])
+            client_data = json.loads(raw.decode('utf-8'))
+            if not isinstance(client_data, dict):
+                raise ValueError('clientData must be an object!')
+        except Exception as e:
+            raise U2FFailure(FailureReason.MALFORMED_PAYLOAD, 'Invalid clientData!', e)
+
+        if client_data.get('typ') != typ:
+            raise U2FFailure(FailureReason.MALFORMED_PAYLOAD, 'Wrong clientData type!')
+
+        if response.get('appId', request['appId']) != request['appId']:
+            raise U2FFailure(FailureReason.APPID_MISMATCH, 'Wrong appId!')
+
+        if client_data.get('challenge') != request['challenge']:
+            raise U2FFailure(FailureReason.BAD_CHALLENGE, 'Wrong challenge!')
+
+        if client_data.get('origin') not in self.facets:
+            raise U2FFailure(FailureReason.FACET_MISMATCH, 'Invalid facet!')
+
+        return raw
+
+    def verify_challenge(self, challenge, expires=None):
+        """Verifies that challenge has not expired, and marks it as consumed"""
+
+        if expires is not None and time.time() > expires:
+            raise U2FFailure(FailureReason.BAD_CHALLENGE, 'Challenge expired!')
+
+        if not self.replay_cache.consume(challenge, self.challenge_ttl):
+            raise U2FFailure(FailureReason.BAD_CHALLENGE, 'Challenge has already been used!')
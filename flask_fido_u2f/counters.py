@@ -0,0 +1,159 @@
+import threading
+
+from collections import OrderedDict
+
+from .forksafe import PerProcess, start_daemon
+
+
+class CounterWriteBehind(object):
+    """
+    Write-behind persistence of signature counters.
+
+    Counter advances are applied to an in-process authoritative cache right
+    away, and flushed to storage in coalesced batches, either every
+    `interval` seconds or as soon as `max_batch` devices are pending.
+    Devices are keyed by (user, keyHandle).
+
+    Arguments:
+        flush:
+            (Function) - Takes dict of (user, keyHandle) -> fields to update, e.g.
+            { ('alice', 'kh1'): {'counter': 12, 'uses': 2} }, and writes it to storage.
+            'uses' is the number of advances coalesced into the update.
+
+        interval:
+            (Float) - Seconds between flushes.
+
+        max_batch:
+            (Integer) - Number of pending devices that triggers early flush.
+
+        max_entries:
+            (Integer) - Number of flushed counters kept in cache.
+
+        metrics:
+            (Metrics) - Optional counters for flushes and flush errors.
+    """
+
+    def __init__(self, flush, interval=1.0, max_batch=100, max_entries=100000, metrics=None):
+        self.interval    = interval
+        self.max_batch   = max_batch
+        self.max_entries = max_entries
+
+        self.__flush     = flush
+        self.__metrics   = metrics
+
+        self.__counters  = OrderedDict()
+        self.__pending   = {}
+        self.__lock      = threading.Lock()
+        self.__flushing  = threading.Lock()
+        self.__wakeup    = threading.Event()
+        self.__stopped   = False
+        self.__thread    = None
+        self.__started   = PerProcess(self.__start)
+
+    def advance(self, key_handle, stored, counter, **fields):
+        """
+        Records counter if it is greater than both stored and cached value.
+        Returns False on counter regression. Extra fields are flushed along
+        with the counter.
+        """
+
+        with self.__lock:
+            current = max(stored, self.__counters.get(key_handle, stored))
+            if counter <= current:
+                return False
+
+            self.__counters[key_handle] = counter
+            self.__counters.move_to_end(key_handle)
+
+            update = self.__pending.setdefault(key_handle, {})
+            update.update(fields)
+            update['counter'] = counter
+            update['uses']    = update.get('uses', 0) + 1
+
+            pending = len(self.__pending)
+
+        self.__ensure_started()
+
+        if pending >= self.max_batch:
+            self.__wakeup.set()
+
+        return True
+
+    def pending(self):
+        """Returns number of key handles waiting to be flushed"""
+        return len(self.__pending)
+
+    def flush(self):
+        """Writes pending counters to storage. On failure they are kept for next flush"""
+
+        with self.__flushing:
+            with self.__lock:
+                batch, self.__pending = self.__pending, {}
+
+            if not batch:
+                return 0
+
+            try:
+                self.__flush(batch)
+            except Exception:
+                with self.__lock:
+                    for key_handle, update in batch.items():
+                        # Advances made during the flush are newer, only their uses add up
+                        newer = self.__pending.get(key_handle)
+                        if newer is None:
+                            self.__pending[key_handle] = update
+                        else:
+                            newer['uses'] = newer.get('uses', 0) + update.get('uses', 0)
+
+                if self.__metrics:
+                    self.__metrics.incr('counters.flush_errors')
+                raise
+
+            with self.__lock:
+                self.__evict()
+
+            if self.__metrics:
+                self.__metrics.incr('counters.flushes')
+                self.__metrics.incr('counters.flushed', len(batch))
+
+            return len(batch)
+
+    def stop(self):
+        """Stops background flushing and drains pending counters"""
+
+        self.__stopped = True
+        self.__wakeup.set()
+
+        if self.__thread is not None and self.__started.started():
+            self.__thread.join()
+
+        self.flush()
+
+    def __evict(self):
+        """Drops oldest counters that are not pending, above max_entries"""
+        excess = len(self.__counters) - self.max_entries
+
+        for key_handle in list(self.__counters):
+            if excess <= 0:
+                break
+
+            if key_handle not in self.__pending:
+                del self.__counters[key_handle]
+                excess -= 1
+
+    def __ensure_started(self):
+        if not self.__stopped:
+            self.__started.ensure()
+
+    def __start(self):
+        self.__thread = start_daemon(self.__run, 'u2f-counter-flush')
+
+    def __run(self):
+        while not self.__stopped:
+            self.__wakeup.wait(self.interval)
+            self.__wakeup.clear()
+
+            try:
+                self.flush()
+            except Exception:
+                pass
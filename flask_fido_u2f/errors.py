@@ -0,0 +1,72 @@
+from enum import Enum
+
+
+class FailureReason(Enum):
+    """Reasons U2F enrollment or signature verification can fail"""
+
+    MISSING_CHALLENGE  = 'missing_challenge'
+    BAD_CHALLENGE      = 'bad_challenge'
+    APPID_MISMATCH     = 'appid_mismatch'
+    FACET_MISMATCH     = 'facet_mismatch'
+    BAD_SIGNATURE      = 'bad_signature'
+    UNKNOWN_KEY_HANDLE = 'unknown_key_handle'
+    COUNTER_REGRESSION = 'counter_regression'
+    MALFORMED_PAYLOAD  = 'malformed_payload'
+
+
+class U2FFailure(Exception):
+    """
+    Passed to enroll_on_fail and sign_on_fail callbacks.
+
+    Attributes:
+        reason:
+            (FailureReason) - Why the operation failed.
+
+        cause:
+            (Exception) - Original exception, if any.
+    """
+
+    def __init__(self, reason, message, cause=None):
+        super(U2FFailure, self).__init__(message)
+
+        self.reason = reason
+        self.cause  = cause
+
+
+class StorageUnavailable(Exception):
+    """
+    Raised when a storage hook timed out or failed, or the storage circuit
+    breaker is open. Enroll, sign and devices views respond with 503.
+
+    Attributes:
+        cause:
+            (Exception) - Original exception, if any.
+    """
+
+    def __init__(self, message, cause=None):
+        super(StorageUnavailable, self).__init__(message)
+
+        self.cause = cause
+
+
+def classify(exception):
+    """Wraps exception raised while verifying U2F response into U2FFailure"""
+
+    # Imported here to keep cryptography out of module import
+    from cryptography.exceptions import InvalidSignature
+
+    if isinstance(exception, U2FFailure):
+        return exception
+
+    if isinstance(exception, InvalidSignature):
+        reason = FailureReason.BAD_SIGNATURE
+
+    elif isinstance(exception, StopIteration):
+        # u2flib looks up key handle with next()
+        reason = FailureReason.UNKNOWN_KEY_HANDLE
+
+    else:
+        # Decoding and parsing errors: ValueError, KeyError, TypeError, binascii.Error
+        reason = FailureReason.MALFORMED_PAYLOAD
+
+    return U2FFailure(reason, str(exception) or type(exception).__name__, exception)
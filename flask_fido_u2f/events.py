@@ -0,0 +1,277 @@
+import json
+import time
+import queue
+import threading
+
+from .forksafe import PerProcess, start_daemon
+
+
+class U2FEvent(object):
+    """
+    Published to EventBus subscribers.
+
+    Attributes:
+        kind:
+            (String) - One of EventBus.KINDS, e.g. 'sign.success'.
+
+        user:
+            (String) - Identity of the user, if @u2f.identity is injected.
+
+        time:
+            (Float) - UNIX time of the event.
+
+        remote_addr:
+            (String) - Client address of the request.
+
+        key_handle:
+            (String) - Key handle of the device, when known.
+
+        counter:
+            (Integer) - Signature counter, on 'sign.success' and 'sign.anomaly'.
+
+        failure:
+            (U2FFailure) - Failure, on 'enroll.fail' and 'sign.fail'.
+
+        anomaly:
+            (CounterAnomaly) - Anomaly, on 'sign.anomaly'.
+    """
+
+    __slots__ = ('kind', 'user', 'time', 'remote_addr', 'key_handle', 'counter', 'failure', 'anomaly')
+
+    def __init__(self, kind, user=None, remote_addr=None, key_handle=None, counter=None, failure=None,
+                 anomaly=None, time=None):
+        self.kind        = kind
+        self.user        = user
+        self.time        = time
+        self.remote_addr = remote_addr
+        self.key_handle  = key_handle
+        self.counter     = counter
+        self.failure     = failure
+        self.anomaly     = anomaly
+
+    def to_dict(self):
+        """Returns JSON serialisable dict of the event"""
+        data = {
+            'kind'        : self.kind,
+            'user'        : self.user,
+            'time'        : self.time,
+            'remote_addr' : self.remote_addr,
+            'key_handle'  : self.key_handle,
+            'counter'     : self.counter
+        }
+
+        if self.failure is not None:
+            data['reason'] = self.failure.reason.value
+
+        if self.anomaly is not None:
+            data['anomaly'] = self.anomaly.kind
+            data['delta']   = self.anomaly.delta
+
+        return data
+
+    def __repr__(self):
+        return 'U2FEvent({kind!r}, user={user!r})'.format(kind=self.kind, user=self.user)
+
+
+class EventBus(object):
+    """
+    Delivers U2F events to subscribers, off the request.
+
+    Events are put into a bounded queue, drained by `workers` background
+    threads in batches of up to `max_batch`. Subscribers with batch=True get
+    a list per batch, so that sinks write a batch at a time, others get
+    events one by one. With 0 workers, events are delivered synchronously by
+    publish().
+
+    When the queue is full, `overflow` decides:
+
+        sync:        the event is delivered synchronously, by the publisher
+        block:       publisher waits for room
+        drop_newest: the event is dropped
+        drop_oldest: the oldest queued event is dropped
+
+    Dropped events are counted in metrics as 'events.dropped', subscriber
+    errors as 'events.errors'.
+
+    Arguments:
+        workers:
+            (Integer) - Number of delivering threads.
+
+        max_queue:
+            (Integer) - Number of queued events.
+
+        overflow:
+            (String) - One of OVERFLOW.
+
+        max_batch:
+            (Integer) - Number of events delivered together.
+
+        metrics:
+            (Metrics) - Optional counters.
+    """
+
+    KINDS    = ('enroll.success', 'enroll.fail', 'sign.success', 'sign.fail', 'sign.anomaly')
+    OVERFLOW = ('sync', 'block', 'drop_newest', 'drop_oldest')
+
+    def __init__(self, workers=1, max_queue=10000, overflow='sync', max_batch=100, metrics=None):
+        if overflow not in self.OVERFLOW:
+            raise ValueError('Unknown overflow policy {overflow!r}, expected one of {policies}'.format(
+                overflow=overflow, policies=', '.join(self.OVERFLOW)))
+
+        self.workers   = workers
+        self.overflow  = overflow
+        self.max_batch = max_batch
+
+        self.__metrics     = metrics
+        self.__subscribers = []
+        self.__queue       = queue.Queue(maxsize=max_queue)
+        self.__threads     = []
+        self.__stopped     = False
+        self.__started     = PerProcess(self.__start)
+
+    def subscribe(self, handler, kinds=None, batch=False):
+        """Subscribes handler to events of given kinds, all by default. With batch, handler takes a list"""
+        self.__subscribers = self.__subscribers + [(handler, None if kinds is None else frozenset(kinds), batch)]
+
+    def subscribers(self):
+        """Returns list of (handler, kinds, batch)"""
+        return list(self.__subscribers)
+
+    def pending(self):
+        """Returns number of queued events"""
+        return self.__queue.qsize()
+
+    def publish(self, event):
+        """Queues event for subscribers"""
+
+        if event.time is None:
+            event.time = time.time()
+
+        if not self.__subscribers:
+            return
+
+        if self.workers <= 0 or self.__stopped:
+            return self.deliver([event])
+
+        self.__started.ensure()
+
+        if self.overflow == 'block':
+            return self.__queue.put(event)
+
+        try:
+            self.__queue.put_nowait(event)
+            return
+        except queue.Full:
+            pass
+
+        if self.overflow == 'sync':
+            self.__count('events.sync')
+            return self.deliver([event])
+
+        if self.overflow == 'drop_oldest':
+            try:
+                self.__queue.get_nowait()
+                self.__queue.put_nowait(event)
+            except (queue.Empty, queue.Full):
+                pass
+
+        self.__count('events.dropped')
+
+    def deliver(self, events):
+        """Delivers events to subscribers. Errors of a subscriber do not affect others"""
+
+        for handler, kinds, batch in self.__subscribers:
+            selected = events if kinds is None else [event for event in events if event.kind in kinds]
+            if not selected:
+                continue
+
+            try:
+                if batch:
+                    handler(selected)
+                else:
+                    for event in selected:
+                        handler(event)
+            except Exception:
+                self.__count('events.errors')
+
+        self.__count('events.delivered', len(events))
+
+    def stop(self, timeout=5.0):
+        """Delivers queued events and stops workers"""
+
+        self.__stopped = True
+
+        if self.__started.started():
+            for thread in self.__threads:
+                self.__queue.put(None)
+
+            for thread in self.__threads:
+                thread.join(timeout)
+
+        # Left over by workers of another process, or never started
+        events = []
+        while True:
+            try:
+                event = self.__queue.get_nowait()
+            except queue.Empty:
+                break
+
+            if event is not None:
+                events.append(event)
+
+        if events:
+            self.deliver(events)
+
+    def __count(self, name, value=1):
+        if self.__metrics:
+            self.__metrics.incr(name, value)
+
+    def __start(self):
+        self.__threads = [start_daemon(self.__run, 'u2f-events-{0}'.format(i)) for i in range(self.workers)]
+
+    def __run(self):
+        while True:
+            event = self.__queue.get()
+            if event is None:
+                return
+
+            events = [event]
+            while len(events) < self.max_batch:
+                try:
+                    event = self.__queue.get_nowait()
+                except queue.Empty:
+                    break
+
+                # Stop marker, put back for this worker's next get()
+                if event is None:
+                    self.__queue.put(None)
+                    break
+
+                events.append(event)
+
+            self.deliver(events)
+
+
+class FileAuditSink(object):
+    """
+    Audit sink writing events as JSON lines, one write per batch.
+    Subscribed with batch=True:
+
+        u2f.events.subscribe(FileAuditSink('/var/log/u2f-audit.jsonl'), batch=True)
+
+    Arguments:
+        path:
+            (String) - File events are appended to.
+    """
+
+    def __init__(self, path):
+        self.path = path
+
+        self.__lock = threading.Lock()
+
+    def __call__(self, events):
+        data = ''.join(json.dumps(event.to_dict(), sort_keys=True) + '\n' for event in events)
+
+        with self.__lock:
+            with open(self.path, 'a') as output:
+                output.write(data)
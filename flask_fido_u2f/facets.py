@@ -0,0 +1,121 @@
+import threading
+
+from urllib.parse import urlsplit
+
+DEFAULT_PORTS = {
+    'https' : 443,
+    'http'  : 80
+}
+
+
+def web_origin(facet, strict=False):
+    """
+    Returns (scheme, host, port) of web facet, or None if it is not a URL.
+    If strict, as for origins, URLs with credentials, path, query or
+    fragment are not web origins either.
+    """
+
+    if not isinstance(facet, str) or '://' not in facet:
+        return None
+
+    try:
+        parts = urlsplit(facet)
+        port  = parts.port
+    except ValueError:
+        return None
+
+    if not parts.hostname:
+        return None
+
+    if strict and (parts.username is not None or parts.path not in ('', '/') or parts.query or parts.fragment):
+        return None
+
+    scheme = parts.scheme.lower()
+    return scheme, parts.hostname.lower(), port or DEFAULT_PORTS.get(scheme)
+
+
+class FacetIndex(object):
+    """
+    Trusted facets, indexed for origin checks.
+
+    Web facets are kept by normalised (scheme, host, port): scheme and host
+    are lowercased, default ports are implied, and paths are ignored, as
+    origins have none. Platform facets, e.g. android:apk-key-hash:... and
+    ios:bundle-id:..., are kept as they are, and matched exactly.
+    Membership is checked with `origin in index`, in constant time whatever
+    the number of facets, as done by U2FCore and u2flib.
+
+    Facets can be added, removed or replaced while requests are being
+    served. Updates are serialised, lookups take no lock.
+
+    Iterating yields facets as they were given, in order.
+
+    Arguments:
+        facets:
+            (List) - Trusted facets.
+    """
+
+    def __init__(self, facets=()):
+        self.__lock = threading.Lock()
+        self.replace(facets)
+
+    def __contains__(self, origin):
+        if not isinstance(origin, str):
+            return False
+
+        key = web_origin(origin, strict=True)
+        if key is None:
+            return origin in self.__platform
+
+        return key in self.__web
+
+    def __iter__(self):
+        return iter(list(self.__facets))
+
+    def __len__(self):
+        return len(self.__facets)
+
+    def __repr__(self):
+        return 'FacetIndex({count} facets)'.format(count=len(self))
+
+    def add(self, facet):
+        """Adds trusted facet"""
+        with self.__lock:
+            if facet in self.__facets:
+                return
+
+            key = web_origin(facet)
+            if key is None:
+                self.__platform = self.__platform | {facet}
+            else:
+                self.__web = self.__web | {key}
+
+            self.__facets = self.__facets + [facet]
+
+    def remove(self, facet):
+        """Removes trusted facet. Raises KeyError if it was not trusted"""
+        with self.__lock:
+            if facet not in self.__facets:
+                raise KeyError(facet)
+
+            self.__build([existing for existing in self.__facets if existing != facet])
+
+    def replace(self, facets):
+        """Replaces all trusted facets"""
+        with self.__lock:
+            self.__build(list(facets))
+
+    def __build(self, facets):
+        web, platform = set(), set()
+
+        for facet in facets:
+            key = web_origin(facet)
+            if key is None:
+                platform.add(facet)
+            else:
+                web.add(key)
+
+        # New sets are swapped in, lookups see either the old or the new ones
+        self.__web      = frozenset(web)
+        self.__platform = frozenset(platform)
+        self.__facets   = facets
@@ -0,0 +1,51 @@
+import os
+import threading
+
+
+class PerProcess(object):
+    """
+    Runs `start` once per process, on first use in it.
+
+    Threads do not survive fork, and sockets or buffers inherited from the
+    parent are shared with it, so background workers are started lazily by
+    each process rather than at import or init_app time. Preforked servers,
+    e.g. gunicorn --preload, then get their own workers in every child.
+
+    Arguments:
+        start:
+            (Function) - Takes no arguments, starts workers of the calling process.
+    """
+
+    def __init__(self, start):
+        self.__start = start
+        self.__lock  = threading.Lock()
+        self.__pid   = None
+
+    def ensure(self):
+        """Calls start, unless it already ran in this process. Returns True if it was called"""
+        pid = os.getpid()
+
+        if self.__pid == pid:
+            return False
+
+        with self.__lock:
+            if self.__pid == pid:
+                return False
+
+            self.__start()
+            self.__pid = pid
+
+        return True
+
+    def started(self):
+        """Returns True if start ran in this process"""
+        return self.__pid == os.getpid()
+
+
+def start_daemon(target, name):
+    """Starts and returns daemon thread running target"""
+    thread = threading.Thread(target=target, name=name)
+    thread.daemon = True
+    thread.start()
+
+    return thread
@@ -0,0 +1,268 @@
+import os
+import abc
+import json
+import time
+import uuid
+import socket
+
+from .forksafe import PerProcess, start_daemon
+
+
+class InvalidationChannel(abc.ABC):
+    """
+    Broadcasts device invalidations between processes.
+
+    Every device mutation of a process is published as the user, and key
+    handles that were added or removed. Other processes subscribed to the
+    channel drop devices they keep of the user, and the key handles from
+    their key caches. Messages of a process are not delivered back to it.
+
+    Subclasses implement the transport:
+
+        connect() - Called once per process, before listen() is started.
+        listen()  - Runs in a background thread, passing every received
+                    message to receive(data), until the channel is closed.
+        send(data) - Sends message bytes to other processes.
+        close()   - Stops listening.
+
+    Users are sent as JSON, so @u2f.identity must return strings or numbers.
+    Other users are not sent, and are counted as errors.
+
+    Arguments:
+        metrics:
+            (Metrics) - Optional counters.
+    """
+
+    def __init__(self, metrics=None):
+        self.metrics = metrics
+
+        self.__node        = uuid.uuid4().hex[:12]
+        self.__subscribers = []
+        self.__started     = PerProcess(self.__start)
+        self.__thread      = None
+
+    @property
+    def origin(self):
+        """Returns identifier of this process on the channel"""
+        return '{node}:{pid}'.format(node=self.__node, pid=os.getpid())
+
+    def subscribe(self, callback):
+        """Subscribes callback, taking user and list of key handles, to invalidations of other processes"""
+        self.__subscribers = self.__subscribers + [callback]
+
+    def publish(self, user, key_handles=()):
+        """Broadcasts invalidation of users devices. Failures are counted, not raised"""
+        self.ensure_started()
+
+        # Users that are not JSON serializable fail here rather than in the
+        # view that mutated devices
+        try:
+            data = json.dumps({
+                'origin'     : self.origin,
+                'user'       : user,
+                'keyHandles' : list(key_handles)
+            }).encode('utf-8')
+
+            self.send(data)
+        except Exception:
+            self.incr('invalidation.errors')
+            return
+
+        self.incr('invalidation.sent')
+
+    def receive(self, data):
+        """Passes received message to subscribers"""
+        try:
+            message = json.loads(data.decode('utf-8'))
+        except ValueError:
+            self.incr('invalidation.errors')
+            return
+
+        if message.get('origin') == self.origin:
+            return
+
+        self.incr('invalidation.received')
+
+        for callback in self.__subscribers:
+            try:
+                callback(message['user'], message['keyHandles'])
+            except Exception:
+                self.incr('invalidation.errors')
+
+    def ensure_started(self):
+        """Connects and starts listening, once per process"""
+        self.__started.ensure()
+
+    def __start(self):
+        self.connect()
+        self.__thread = start_daemon(self.listen, 'u2f-invalidation')
+
+    def incr(self, name, value=1):
+        if self.metrics:
+            self.metrics.incr(name, value)
+
+    def connect(self):
+        pass
+
+    @abc.abstractmethod
+    def listen(self):
+        """Passes received messages to receive() until the channel is closed"""
+
+    @abc.abstractmethod
+    def send(self, data):
+        """Sends message bytes to other processes"""
+
+    def close(self):
+        pass
+
+
+class UnixSocketInvalidationChannel(InvalidationChannel):
+    """
+    Invalidation channel of processes on one host, e.g. preforked workers.
+
+    Every process binds a datagram socket in `directory`, and sends
+    invalidations to the sockets of all others. Sockets of processes that
+    are gone are removed by the next sender. Invalidations to a process
+    whose socket buffer is full are dropped, and counted as
+    'invalidation.dropped'.
+
+    Arguments:
+        directory:
+            (String) - Directory of the sockets, writable by all workers. Kept short,
+            as socket paths are limited to about 100 characters.
+
+        metrics:
+            (Metrics) - Optional counters.
+    """
+
+    PREFIX = 'u2f-'
+    SUFFIX = '.sock'
+
+    def __init__(self, directory, metrics=None):
+        super(UnixSocketInvalidationChannel, self).__init__(metrics)
+
+        self.directory = directory
+
+        self.__socket = None
+        self.__path   = None
+
+    def connect(self):
+        os.makedirs(self.directory, exist_ok=True)
+
+        # Sockets inherited through fork belong to the parent
+        self.__path   = os.path.join(self.directory, '{prefix}{origin}{suffix}'.format(
+            prefix=self.PREFIX, origin=self.origin.replace(':', '-'), suffix=self.SUFFIX))
+        self.__socket = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+
+        if os.path.exists(self.__path):
+            os.unlink(self.__path)
+
+        self.__socket.bind(self.__path)
+
+    def listen(self):
+        sock = self.__socket
+
+        while True:
+            try:
+                data = sock.recv(65536)
+            except OSError:
+                return
+
+            # Shut down by close()
+            if not data:
+                return
+
+            self.receive(data)
+
+    def send(self, data):
+        sender = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        sender.setblocking(False)
+
+        try:
+            for name in os.listdir(self.directory):
+                path = os.path.join(self.directory, name)
+
+                if not name.startswith(self.PREFIX) or not name.endswith(self.SUFFIX) or path == self.__path:
+                    continue
+
+                try:
+                    sender.sendto(data, path)
+                except BlockingIOError:
+                    self.incr('invalidation.dropped')
+                except (ConnectionRefusedError, FileNotFoundError):
+                    self.__remove(path)
+        finally:
+            sender.close()
+
+    def close(self):
+        if self.__socket is not None and self.__path is not None:
+            self.__remove(self.__path)
+
+            try:
+                self.__socket.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+
+            self.__socket.close()
+            self.__socket = None
+
+    def __remove(self, path):
+        try:
+            os.unlink(path)
+        except OSError:
+            pass
+
+
+class RedisInvalidationChannel(InvalidationChannel):
+    """
+    Invalidation channel of a cluster, over Redis pub/sub.
+
+        u2f.use_invalidation(RedisInvalidationChannel(redis.Redis(), channel='u2f:invalidate'))
+
+    Arguments:
+        client:
+            (redis.Redis) - Redis client.
+
+        channel:
+            (String) - Pub/sub channel.
+
+        metrics:
+            (Metrics) - Optional counters.
+    """
+
+    RETRY_INTERVAL = 1.0
+
+    def __init__(self, client, channel='u2f:invalidate', metrics=None):
+        super(RedisInvalidationChannel, self).__init__(metrics)
+
+        self.client  = client
+        self.channel = channel
+
+        self.__pubsub = None
+
+    def connect(self):
+        self.__pubsub = self.client.pubsub(ignore_subscribe_messages=True)
+        self.__pubsub.subscribe(self.channel)
+
+    def listen(self):
+        while self.__pubsub is not None:
+            try:
+                for message in self.__pubsub.listen():
+                    if message['type'] == 'message':
+                        self.receive(message['data'])
+            except Exception:
+                if self.__pubsub is None:
+                    return
+
+                # Connection lost, redis-py subscribes again on reconnect
+                self.incr('invalidation.errors')
+                time.sleep(self.RETRY_INTERVAL)
+
+    def send(self, data):
+        self.client.publish(self.channel, data)
+
+    def close(self):
+        pubsub, self.__pubsub = self.__pubsub, None
+
+        if pubsub is not None:
+            pubsub.close()
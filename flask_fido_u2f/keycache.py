@@ -0,0 +1,136 @@
+import mmap
+import struct
+import hashlib
+
+# Key handle digest (16), uncompressed EC point (65), counter (4), padding
+ENTRY = struct.Struct('>16s65sI')
+CHECK = 8
+SLOT  = 96
+PROBE = 4
+
+
+class SharedKeyCache(object):
+    """
+    Public keys and counters of devices, shared by worker processes.
+
+    Entries are kept by (user, keyHandle) in fixed size slots of a memory
+    mapped region, so memory does not grow with the number of workers or devices.
+    Created before workers are forked, e.g. with gunicorn --preload, the
+    anonymous region is shared by all of them. With `path`, the region is
+    backed by that file, and shared by every process that maps it.
+
+    Neither reads nor writes take locks. Each slot carries a checksum of
+    its entry: a slot read while another process writes it fails the check
+    and is a miss, and of two concurrent writes of a slot the last one
+    wins. Counters are therefore a best-effort early check, the store
+    remains the reference.
+
+    Key handles are chosen by devices, and several users may store the same
+    one, so entries are keyed by user too. Cached public keys are only
+    trusted by callers after comparing them with the device record.
+
+    Arguments:
+        slots:
+            (Integer) - Number of entries. A device is kept in one of
+            PROBE slots, and evicts the first of them when all are taken.
+
+        path:
+            (String) - Optional file backing the region.
+
+        metrics:
+            (Metrics) - Optional counter of hits and misses.
+    """
+
+    def __init__(self, slots=65536, path=None, metrics=None):
+        self.slots = slots
+
+        self.__metrics = metrics
+
+        if path is None:
+            self.__map = mmap.mmap(-1, slots * SLOT)
+        else:
+            with open(path, 'a+b') as backing:
+                if backing.seek(0, 2) < slots * SLOT:
+                    backing.truncate(slots * SLOT)
+
+                self.__map = mmap.mmap(backing.fileno(), slots * SLOT)
+
+    def digest(self, key):
+        """Returns 128 bit digest of key, a (user, keyHandle) tuple or a string"""
+        if isinstance(key, tuple):
+            key = '\0'.join(str(part) for part in key)
+
+        return hashlib.sha256(key.encode('utf-8')).digest()[:16]
+
+    def get(self, key):
+        """Returns (public_key, counter) of key, or None"""
+        digest = self.digest(key)
+
+        for offset in self.__offsets(digest):
+            entry = self.__read(offset)
+
+            if entry is not None and entry[0] == digest:
+                if self.__metrics:
+                    self.__metrics.incr('keycache.hit')
+
+                return entry[1], entry[2]
+
+        if self.__metrics:
+            self.__metrics.incr('keycache.miss')
+
+        return None
+
+    def put(self, key, public_key, counter):
+        """Keeps raw public key and counter of key"""
+        digest  = self.digest(key)
+        offsets = self.__offsets(digest)
+        target  = offsets[0]
+
+        for offset in offsets:
+            entry = self.__read(offset)
+
+            if entry is None or entry[0] == digest:
+                target = offset
+                break
+
+        data = ENTRY.pack(digest, bytes(public_key), counter)
+        self.__map[target:target + ENTRY.size + CHECK] = data + self.__check(data)
+
+    def advance(self, key, counter):
+        """Raises cached counter of key to counter. Returns False if it was not below"""
+        entry = self.get(key)
+
+        if entry is None:
+            return True
+
+        if entry[1] >= counter:
+            return False
+
+        self.put(key, entry[0], counter)
+        return True
+
+    def discard(self, key):
+        """Removes key"""
+        digest = self.digest(key)
+
+        for offset in self.__offsets(digest):
+            entry = self.__read(offset)
+
+            if entry is not None and entry[0] == digest:
+                self.__map[offset:offset + SLOT] = bytes(SLOT)
+
+    def __offsets(self, digest):
+        index = int.from_bytes(digest[:8], 'big')
+        return [((index + i) % self.slots) * SLOT for i in range(min(PROBE, self.slots))]
+
+    def __check(self, data):
+        return hashlib.blake2b(data, digest_size=CHECK).digest()
+
+    def __read(self, offset):
+        # Single copy, checked afterwards, so torn entries are dropped
+        data = self.__map[offset:offset + ENTRY.size + CHECK]
+
+        if data[ENTRY.size:] != self.__check(data[:ENTRY.size]):
+            return None
+
+        return ENTRY.unpack_from(data)
@@ -0,0 +1,23 @@
+import threading
+
+
+class Metrics(object):
+    """Thread safe named counters, exposed as U2F.metrics"""
+
+    def __init__(self):
+        self.__counters = {}
+        self.__lock     = threading.Lock()
+
+    def incr(self, name, value=1):
+        """Increments counter by value"""
+        with self.__lock:
+            self.__counters[name] = self.__counters.get(name, 0) + value
+
+    def get(self, name):
+        """Returns current value of the counter"""
+        return self.__counters.get(name, 0)
+
+    def snapshot(self):
+        """Returns copy of all counters"""
+        with self.__lock:
+            return dict(self.__counters)
@@ -0,0 +1,156 @@
+"""
+Native U2F message parsing and verification.
+
+Raw registration and authentication messages are parsed on memoryview,
+without intermediate copies, and verified directly with cryptography
+primitives. Selected with U2F_ENGINE = 'native'; results are the same as of
+u2flib's complete_register and verify_authenticate.
+
+    registrationData   = 0x05, public key (65), key handle length (1), key handle, certificate, signature
+    signatureData      = user presence (1), counter (4), signature
+"""
+
+import struct
+import hashlib
+import functools
+
+from .core import websafe_encode, websafe_decode
+
+PUBLIC_KEY_LENGTH = 65
+
+# Prefix of SubjectPublicKeyInfo DER of a P-256 public key
+PUBLIC_KEY_DER_PREFIX = b'\x30\x59\x30\x13\x06\x07\x2a\x86\x48\xce\x3d\x02\x01' \
+                        b'\x06\x08\x2a\x86\x48\xce\x3d\x03\x01\x07\x03\x42\x00'
+
+COUNTER = struct.Struct('>BI')
+
+
+def der_length(view, offset):
+    """Returns length of DER element starting at offset, header included"""
+    length = view[offset + 1]
+
+    if length < 0x80:
+        return 2 + length
+
+    size = length & 0x7f
+    if size == 0 or size > 4:
+        raise ValueError('Invalid DER length!')
+
+    return 2 + size + int.from_bytes(view[offset + 2:offset + 2 + size], 'big')
+
+
+def parse_registration(data):
+    """
+    Splits raw registration message into memoryviews of
+    (public_key, key_handle, certificate, signature). Raises ValueError.
+    """
+    view = memoryview(data)
+
+    if len(view) < 2 + PUBLIC_KEY_LENGTH or view[0] != 0x05:
+        raise ValueError('Invalid registration data!')
+
+    offset     = 1 + PUBLIC_KEY_LENGTH
+    public_key = view[1:offset]
+
+    key_handle_end = offset + 1 + view[offset]
+    key_handle     = view[offset + 1:key_handle_end]
+
+    if key_handle_end + 2 > len(view) or view[key_handle_end] != 0x30:
+        raise ValueError('Invalid attestation certificate!')
+
+    certificate_end = key_handle_end + der_length(view, key_handle_end)
+    if certificate_end >= len(view):
+        raise ValueError('Missing registration signature!')
+
+    return public_key, key_handle, view[key_handle_end:certificate_end], view[certificate_end:]
+
+
+def parse_authentication(data):
+    """Returns (user_presence, counter, signature) of raw authentication message. Raises ValueError"""
+    view = memoryview(data)
+
+    if len(view) <= COUNTER.size:
+        raise ValueError('Invalid signature data!')
+
+    user_presence, counter = COUNTER.unpack_from(view)
+    return user_presence, counter, view[COUNTER.size:]
+
+
+def load_certificate(der):
+    """Loads attestation certificate, fixing unused bits of signature some early Yubico certificates have"""
+    from cryptography import x509
+    from cryptography.hazmat.backends import default_backend
+
+    der = bytes(der)
+
+    try:
+        return x509.load_der_x509_certificate(der, default_backend())
+    except ValueError:
+        return x509.load_der_x509_certificate(der[:-257] + b'\x00' + der[-256:], default_backend())
+
+
+@functools.lru_cache(maxsize=4096)
+def load_public_key(point):
+    """Loads raw P-256 public key, an uncompressed EC point"""
+    from cryptography.hazmat.backends import default_backend
+    from cryptography.hazmat.primitives.serialization import load_der_public_key
+
+    return load_der_public_key(PUBLIC_KEY_DER_PREFIX + point, default_backend())
+
+
+def verify_ecdsa(public_key, signature, data):
+    """Verifies ECDSA SHA-256 signature. Raises InvalidSignature"""
+    from cryptography.hazmat.primitives import hashes
+    from cryptography.hazmat.primitives.asymmetric import ec
+
+    public_key.verify(bytes(signature), data, ec.ECDSA(hashes.SHA256()))
+
+
+def complete_register(request, response, client_data):
+    """
+    Verifies registration response to request, clientData bytes being
+    already checked against it. Returns (device, certificate).
+    """
+    public_key, key_handle, certificate, signature = parse_registration(websafe_decode(response['registrationData']))
+
+    certificate = load_certificate(certificate)
+
+    data = b''.join((
+        b'\x00',
+        hashlib.sha256(request['appId'].encode('utf-8')).digest(),
+        hashlib.sha256(client_data).digest(),
+        key_handle,
+        public_key
+    ))
+
+    verify_ecdsa(certificate.public_key(), signature, data)
+
+    return {
+        'appId'     : request['appId'],
+        'keyHandle' : websafe_encode(key_handle),
+        'publicKey' : websafe_encode(public_key)
+    }, certificate
+
+
+def verify_authenticate(device, response, client_data, public_key=None):
+    """
+    Verifies authentication response of device, clientData bytes being
+    already checked against the request. Raw public_key, if given, is used
+    instead of decoding the one of device. Returns (counter, user_presence).
+    """
+    data = websafe_decode(response['signatureData'])
+    user_presence, counter, signature = parse_authentication(data)
+
+    signed = b''.join((
+        hashlib.sha256(device['appId'].encode('utf-8')).digest(),
+        memoryview(data)[:COUNTER.size],
+        hashlib.sha256(client_data).digest()
+    ))
+
+    if public_key is None:
+        public_key = websafe_decode(device['publicKey'])
+
+    verify_ecdsa(load_public_key(bytes(public_key)), signature, signed)
+
+    # Same type as returned by u2flib
+    return counter, bytes((user_presence,))
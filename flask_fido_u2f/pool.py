@@ -0,0 +1,95 @@
+import os
+import threading
+
+from collections import deque
+
+from .forksafe import PerProcess, start_daemon
+
+
+class ChallengePool(object):
+    """
+    Pool of pre-generated random challenges.
+
+    A background thread refills the pool in bulk whenever it drops below
+    `refill_threshold`, so that login storms do not turn into bursts of
+    entropy calls. When the pool is empty, challenges are generated on
+    demand and the exhaustion is counted in metrics as 'pool.exhausted'.
+
+    Arguments:
+        size:
+            (Integer) - Number of challenges kept in the pool.
+
+        refill_threshold:
+            (Integer) - Pool is refilled once it holds fewer challenges.
+
+        challenge_size:
+            (Integer) - Challenge length in bytes.
+
+        metrics:
+            (Metrics) - Optional counters for exhaustion and refills.
+    """
+
+    def __init__(self, size=1024, refill_threshold=None, challenge_size=32, metrics=None):
+        self.size             = size
+        self.refill_threshold = size // 4 if refill_threshold is None else refill_threshold
+        self.challenge_size   = challenge_size
+
+        self.__metrics  = metrics
+        self.__pool     = deque()
+        self.__wakeup   = threading.Event()
+        self.__started  = PerProcess(self.__start)
+
+    def __len__(self):
+        return len(self.__pool)
+
+    def take(self):
+        """Returns random challenge bytes"""
+
+        self.__started.ensure()
+
+        try:
+            challenge = self.__pool.popleft()
+        except IndexError:
+            challenge = None
+
+        if len(self.__pool) < self.refill_threshold:
+            self.__wakeup.set()
+
+        if challenge is None:
+            if self.__metrics:
+                self.__metrics.incr('pool.exhausted')
+
+            return os.urandom(self.challenge_size)
+
+        return challenge
+
+    def refill(self):
+        """Tops pool up to its size with one bulk entropy call"""
+
+        missing = self.size - len(self.__pool)
+        if missing <= 0:
+            return 0
+
+        n    = self.challenge_size
+        data = os.urandom(missing * n)
+
+        self.__pool.extend(data[i:i + n] for i in range(0, len(data), n))
+
+        if self.__metrics:
+            self.__metrics.incr('pool.refills')
+
+        return missing
+
+    def __start(self):
+        # Challenges inherited over fork are shared with the parent and siblings
+        self.__pool.clear()
+        self.refill()
+
+        start_daemon(self.__run, 'u2f-challenge-pool')
+
+    def __run(self):
+        while True:
+            self.refill()
+
+            self.__wakeup.wait()
+            self.__wakeup.clear()
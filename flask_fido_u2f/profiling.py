@@ -0,0 +1,179 @@
+import os
+import sys
+import time
+import random
+import itertools
+import threading
+
+from collections import Counter
+from contextlib import contextmanager
+
+from .forksafe import PerProcess, start_daemon
+
+
+def collapse(frame, max_depth=64):
+    """Returns stack of frame in collapsed format: root;...;caller;callee"""
+    names = []
+
+    while frame is not None and len(names) < max_depth:
+        code = frame.f_code
+        names.append('{file}:{function}'.format(file=os.path.basename(code.co_filename), function=code.co_name))
+        frame = frame.f_back
+
+    return ';'.join(reversed(names))
+
+
+class SamplingProfiler(object):
+    """
+    Sampling profiler of requests.
+
+    While at least one request is profiled, a single background thread takes
+    the stacks of profiled threads every `interval` seconds. Profiled code is
+    not instrumented, so overhead is bounded by the sampling rate, whatever
+    the number of requests. Idle, the thread waits without polling.
+
+    Stacks of requests that took longer than `threshold` seconds, or fall
+    into the `sample_rate` fraction, are written to `directory` as
+    {name}-{time}-{pid}-{seq}.folded, one 'stack count' line per stack, the
+    format taken by flamegraph.pl and speedscope. Other requests are
+    discarded. At most `max_dumps` profiles are written every `dump_interval`
+    seconds by a process, so that an outage making every request slow does
+    not fill the disk. Profiles over the limit are counted as dropped.
+
+    Arguments:
+        directory:
+            (String) - Directory of profiles.
+
+        threshold:
+            (Float) - Requests slower than this many seconds are written.
+
+        sample_rate:
+            (Float) - Fraction of other requests that are written.
+
+        interval:
+            (Float) - Seconds between samples.
+
+        max_dumps:
+            (Integer) - Profiles written per dump_interval, or None for no limit.
+
+        dump_interval:
+            (Float) - Seconds of the max_dumps window.
+
+        metrics:
+            (Metrics) - Optional counters of written and dropped profiles.
+    """
+
+    def __init__(self, directory, threshold=0.5, sample_rate=0.0, interval=0.005,
+                 max_dumps=10, dump_interval=60.0, metrics=None):
+        self.directory     = directory
+        self.threshold     = threshold
+        self.sample_rate   = sample_rate
+        self.interval      = interval
+        self.max_dumps     = max_dumps
+        self.dump_interval = dump_interval
+
+        self.__metrics  = metrics
+        self.__window   = None
+        self.__dumps    = 0
+        self.__active   = {}
+        self.__lock     = threading.Lock()
+        self.__wakeup   = threading.Event()
+        self.__sequence = itertools.count()
+        self.__started  = PerProcess(self.__start)
+
+        os.makedirs(directory, exist_ok=True)
+
+    @contextmanager
+    def profile(self, name):
+        """Profiles the body of the with statement under name"""
+
+        ident  = threading.get_ident()
+        stacks = Counter()
+
+        with self.__lock:
+            self.__active[ident] = stacks
+
+        self.__started.ensure()
+        self.__wakeup.set()
+
+        start = time.perf_counter()
+        try:
+            yield stacks
+        finally:
+            elapsed = time.perf_counter() - start
+
+            with self.__lock:
+                del self.__active[ident]
+
+            if elapsed >= self.threshold or random.random() < self.sample_rate:
+                self.dump(name, stacks)
+
+    def sample(self):
+        """Takes one sample of every profiled thread"""
+        frames = sys._current_frames()
+
+        with self.__lock:
+            for ident, stacks in self.__active.items():
+                frame = frames.get(ident)
+                if frame is not None:
+                    stacks[collapse(frame)] += 1
+
+    def dump(self, name, stacks):
+        """
+        Writes collapsed stacks. Returns path of the profile, or None if no
+        sample was taken or max_dumps were already written in this interval.
+        """
+        if not stacks:
+            return None
+
+        if not self.__reserve():
+            if self.__metrics:
+                self.__metrics.incr('profile.dropped')
+
+            return None
+
+        path = os.path.join(self.directory, '{name}-{time}-{pid}-{sequence}.folded'.format(
+            name=name, time=int(time.time()), pid=os.getpid(), sequence=next(self.__sequence)))
+
+        with open(path, 'w') as output:
+            for stack, count in stacks.most_common():
+                output.write('{stack} {count}\n'.format(stack=stack, count=count))
+
+        if self.__metrics:
+            self.__metrics.incr('profile.dumps')
+
+        return path
+
+    def __reserve(self):
+        """Counts a dump against the current window. Returns False if it is full"""
+        if self.max_dumps is None:
+            return True
+
+        now = time.monotonic()
+
+        with self.__lock:
+            if self.__window is None or now - self.__window >= self.dump_interval:
+                self.__window = now
+                self.__dumps  = 0
+
+            if self.__dumps >= self.max_dumps:
+                return False
+
+            self.__dumps += 1
+
+        return True
+
+    def __start(self):
+        start_daemon(self.__run, 'u2f-profiler')
+
+    def __run(self):
+        while True:
+            if not self.__active:
+                self.__wakeup.clear()
+
+                # Re-check, a request may have started before the clear
+                if not self.__active:
+                    self.__wakeup.wait()
+
+            time.sleep(self.interval)
+            self.sample()
@@ -0,0 +1,112 @@
+import abc
+import time
+import hashlib
+import threading
+
+
+class ReplayCache(abc.ABC):
+    """
+    Keeps track of consumed U2F challenges, so that a challenge can only be
+    used once, even when it is replayed from an old session cookie to another
+    worker.
+
+    Challenges are reduced to a short digest before being stored. Backends
+    implement add(): MemoryReplayCache within a process, RedisReplayCache
+    across workers and nodes. Others (memcached, database) subclass
+    ReplayCache.
+    """
+
+    def digest(self, challenge):
+        """Returns compact 64 bit digest of the challenge"""
+        if not isinstance(challenge, bytes):
+            challenge = challenge.encode('utf-8')
+
+        return hashlib.sha256(challenge).digest()[:8]
+
+    def consume(self, challenge, ttl):
+        """Marks challenge as consumed. Returns False if it was already consumed"""
+        return self.add(self.digest(challenge), ttl)
+
+    @abc.abstractmethod
+    def add(self, digest, ttl):
+        """
+        Atomically stores digest for ttl seconds.
+
+        Returns True if digest was not present, False otherwise.
+        """
+
+
+class MemoryReplayCache(ReplayCache):
+    """
+    In-process replay cache.
+
+    Digests are kept as integers in time buckets of `bucket_width` seconds,
+    keyed by expiration time. Expired buckets are dropped as a whole, so
+    eviction never scans individual entries, and a lookup only touches the
+    few live buckets.
+    """
+
+    def __init__(self, bucket_width=30):
+        self.bucket_width = bucket_width
+
+        self.__buckets = {}
+        self.__lock    = threading.Lock()
+
+    def __len__(self):
+        return sum(len(bucket) for bucket in self.__buckets.values())
+
+    def add(self, digest, ttl):
+        now   = time.time()
+        key   = int.from_bytes(digest, 'big')
+        index = int((now + ttl) // self.bucket_width) + 1
+
+        with self.__lock:
+            self.__evict(now)
+
+            for bucket in self.__buckets.values():
+                if key in bucket:
+                    return False
+
+            self.__buckets.setdefault(index, set()).add(key)
+
+        return True
+
+    def evict(self, now=None):
+        """Drops buckets which expired"""
+        with self.__lock:
+            self.__evict(time.time() if now is None else now)
+
+    def __evict(self, now):
+        current = int(now // self.bucket_width)
+
+        for index in [index for index in self.__buckets if index <= current]:
+            del self.__buckets[index]
+
+
+class RedisReplayCache(ReplayCache):
+    """
+    Replay cache shared by workers and nodes, over Redis.
+
+        u2f = U2F(app, replay_cache=RedisReplayCache(redis.Redis(), prefix='u2f:'))
+
+    Each digest is a key set with SET NX EX, so that it is added and expired
+    by Redis in a single round trip.
+
+    Arguments:
+        client:
+            (redis.Redis) - Redis client, e.g. redis.Redis(), or fakeredis in tests.
+
+        prefix:
+            (String) - Prefix of all keys.
+    """
+
+    def __init__(self, client, prefix='u2f:'):
+        self.client = client
+        self.prefix = prefix
+
+    def replay_key(self, digest):
+        return '{prefix}replay:{digest}'.format(prefix=self.prefix, digest=digest.hex())
+
+    def add(self, digest, ttl):
+        # EX takes whole seconds, at least one
+        return bool(self.client.set(self.replay_key(digest), 1, nx=True, ex=max(int(ttl), 1)))
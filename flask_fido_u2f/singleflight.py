@@ -0,0 +1,106 @@
+import time
+import threading
+
+from collections import OrderedDict
+
+
+class Flight(object):
+    """Read of a key, in flight or finished"""
+
+    __slots__ = ('done', 'result', 'error', 'finished')
+
+    def __init__(self):
+        self.done     = threading.Event()
+        self.result   = None
+        self.error    = None
+        self.finished = None
+
+
+class SingleFlight(object):
+    """
+    Per key coalescing of concurrent reads.
+
+    The first caller of a key runs the read, callers arriving while it is in
+    flight wait for it and share its result or exception. A finished result
+    is also shared for `window` seconds, then the next caller reads again.
+    forget() drops the result of a key, and keeps a read that was already in
+    flight from being shared after it finishes, so that it is called after
+    every write.
+
+    Every caller gets its own copy of the result, made by `copy`, so that
+    callers may modify it.
+
+    Arguments:
+        window:
+            (Float) - Seconds a finished result is shared. 0 shares in flight reads only.
+
+        copy:
+            (Function) - Returns copy of a result handed to a caller. Defaults to the result itself.
+
+        max_entries:
+            (Integer) - Number of kept results, least recently read are dropped.
+
+        metrics:
+            (Metrics) - Optional counter of shared reads.
+    """
+
+    def __init__(self, window=0.0, copy=None, max_entries=10000, metrics=None):
+        self.window      = window
+        self.copy        = copy or (lambda result: result)
+        self.max_entries = max_entries
+
+        self.__metrics = metrics
+        self.__flights = OrderedDict()
+        self.__lock    = threading.Lock()
+
+    def __len__(self):
+        return len(self.__flights)
+
+    def do(self, key, read):
+        """Returns copy of read() result for key, shared with concurrent callers"""
+
+        with self.__lock:
+            flight = self.__flights.get(key)
+
+            if flight is not None and flight.finished is not None and \
+                    time.monotonic() - flight.finished > self.window:
+                flight = None
+
+            leader = flight is None
+            if leader:
+                self.__flights[key] = flight = Flight()
+
+                if len(self.__flights) > self.max_entries:
+                    self.__flights.popitem(last=False)
+            else:
+                self.__flights.move_to_end(key)
+
+        if leader:
+            try:
+                flight.result = read()
+            except Exception as e:
+                flight.error = e
+
+            with self.__lock:
+                if self.__flights.get(key) is flight:
+                    if self.window > 0 and flight.error is None:
+                        flight.finished = time.monotonic()
+                    else:
+                        del self.__flights[key]
+
+            flight.done.set()
+        else:
+            flight.done.wait()
+
+            if self.__metrics:
+                self.__metrics.incr('read.coalesced')
+
+        if flight.error is not None:
+            raise flight.error
+
+        return self.copy(flight.result)
+
+    def forget(self, key):
+        """Drops result of key, so that the next caller reads again"""
+        with self.__lock:
+            self.__flights.pop(key, None)
@@ -0,0 +1,827 @@
+"""
+Reference device stores.
+
+Stores keep devices in a table keyed by (user, keyHandle), which is also
+the key of counter updates. They are plugged into U2F with:
+
+    u2f.use_store(SQLiteDeviceStore('u2f.sqlite'))
+    u2f.use_store(RedisDeviceStore(redis.Redis()))
+
+    @u2f.identity
+    def identity():
+        return current_user.id
+"""
+
+import os
+import abc
+import json
+import queue
+import sqlite3
+import threading
+import itertools
+
+from contextlib import contextmanager
+
+# Device fields kept in their own columns, everything else goes to `extra`
+FIELDS = ('keyHandle', 'appId', 'publicKey', 'counter', 'index', 'last_used', 'use_count')
+
+
+def device_to_row(user, device):
+    """Returns (user_id, key_handle, app_id, public_key, counter, idx, last_used, use_count, extra) tuple"""
+    extra = dict((key, value) for key, value in device.items() if key not in FIELDS)
+
+    return (
+        user,
+        device['keyHandle'],
+        device['appId'],
+        device['publicKey'],
+        device.get('counter', 0),
+        device.get('index', 0),
+        device.get('last_used'),
+        device.get('use_count', 0),
+        json.dumps(extra, sort_keys=True) if extra else None
+    )
+
+
+def row_to_device(row):
+    """
+    Returns device dict from (key_handle, app_id, public_key, counter, idx,
+    last_used, use_count, extra) row. Usage statistics are only set on devices
+    which were used.
+    """
+    device = {
+        'keyHandle' : row[0],
+        'appId'     : row[1],
+        'publicKey' : row[2],
+        'counter'   : row[3],
+        'index'     : row[4]
+    }
+
+    if row[5] is not None:
+        device['last_used'] = row[5]
+        device['use_count'] = row[6]
+
+    if row[7]:
+        device.update(json.loads(row[7]))
+
+    return device
+
+
+def user_ranges(bounds):
+    """Returns [(low, high), ...] user id ranges between sorted bounds, None being open"""
+    bounds = [None] + sorted(set(bounds)) + [None]
+    return list(zip(bounds[:-1], bounds[1:]))
+
+
+class DeviceStore(abc.ABC):
+    """
+    Base class of device stores.
+
+    read() and save() back @u2f.read and @u2f.save for the user returned by
+    @u2f.identity. save_counters() backs @u2f.save_counters, and updates
+    single rows by user and key handle.
+
+    Stores with `keeps_challenges` also keep pending challenges, in place of
+    the session, and fetch them together with users devices.
+
+    shards() and iter_devices() stream every stored device, for offline
+    tools such as flask_fido_u2f.audit.
+
+    Subclasses must implement read(), save() and save_counters(). The
+    others are optional, and raise NotImplementedError unless implemented.
+    """
+
+    keeps_challenges = False
+
+    @abc.abstractmethod
+    def read(self, user):
+        """Returns list of users devices"""
+
+    @abc.abstractmethod
+    def save(self, user, devices):
+        """Replaces users devices. Stored counters never go backwards"""
+
+    @abc.abstractmethod
+    def save_counters(self, batch):
+        """
+        Takes dict of (user, keyHandle) -> updated fields, e.g. {'counter': 12,
+        'last_used': 1500000000, 'uses': 1}. Counters are only moved forward,
+        'uses' is added to use_count. Returns set of (user, keyHandle) whose
+        counter was not advanced.
+        """
+
+    def issue_challenge(self, user, kind, challenge, ttl, nonce=None):
+        """
+        Keeps pending challenge of kind 'enroll' or 'sign' for ttl seconds.
+        Challenges are kept per nonce, one for each session of the user.
+        Returns users devices.
+        """
+        raise NotImplementedError('DeviceStore does not keep challenges')
+
+    def shards(self, count):
+        """
+        Splits stored devices into at most count shards. Returns list of
+        picklable shard descriptors for iter_devices(). All devices of a
+        user are in the same shard.
+        """
+        raise NotImplementedError('DeviceStore does not support scans')
+
+    def iter_devices(self, shard=None, batch_size=1000):
+        """
+        Yields (user, device) of every stored device, or of given shard,
+        fetching batch_size at a time. Devices of a user are yielded together.
+        """
+        raise NotImplementedError('DeviceStore does not support scans')
+
+    def consume_challenge(self, user, kind, nonce=None):
+        """Removes pending challenge. Returns (challenge, devices), challenge being None if there is none"""
+        raise NotImplementedError('DeviceStore does not keep challenges')
+
+
+class SQLiteDeviceStore(DeviceStore):
+    """
+    SQLite device store, for local use and tests. Requires SQLite 3.24, which
+    added upserts.
+
+    Arguments:
+        path:
+            (String) - Database file, or ':memory:' for a private in-memory database.
+
+        pool_size:
+            (Integer) - Maximum number of pooled connections.
+
+        timeout:
+            (Float) - Seconds to wait for a connection or a database lock.
+
+        read_only:
+            (Boolean) - Opens the database read only, without creating or
+            migrating the table, e.g. for audits. Tables of older releases
+            are read with empty usage statistics.
+    """
+
+    SCHEMA = (
+        '''CREATE TABLE IF NOT EXISTS u2f_devices (
+            user_id    TEXT    NOT NULL,
+            key_handle TEXT    NOT NULL,
+            app_id     TEXT    NOT NULL,
+            public_key TEXT    NOT NULL,
+            counter    INTEGER NOT NULL DEFAULT 0,
+            idx        INTEGER NOT NULL DEFAULT 0,
+            last_used  INTEGER,
+            use_count  INTEGER NOT NULL DEFAULT 0,
+            extra      TEXT,
+            PRIMARY KEY (user_id, key_handle)
+        ) WITHOUT ROWID''',
+        'CREATE INDEX IF NOT EXISTS u2f_devices_key_handle ON u2f_devices (key_handle)'
+    )
+
+    # Columns added after the first release, added to existing tables on start
+    MIGRATIONS = (
+        ('last_used', 'ALTER TABLE u2f_devices ADD COLUMN last_used INTEGER'),
+        ('use_count', 'ALTER TABLE u2f_devices ADD COLUMN use_count INTEGER NOT NULL DEFAULT 0')
+    )
+
+    # Values of missing columns, read from tables that were not migrated
+    DEFAULTS = (
+        ('last_used', 'NULL'),
+        ('use_count', '0')
+    )
+
+    # Statements are constant strings, so sqlite3 keeps them prepared per connection
+    SELECT = '''SELECT key_handle, app_id, public_key, counter, idx, last_used, use_count, extra
+                FROM u2f_devices WHERE user_id = ? ORDER BY idx'''
+    DELETE = 'DELETE FROM u2f_devices WHERE user_id = ? AND key_handle = ?'
+    UPSERT = '''INSERT INTO u2f_devices (user_id, key_handle, app_id, public_key, counter, idx, last_used, use_count, extra)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+                ON CONFLICT (user_id, key_handle) DO UPDATE SET
+                    app_id     = excluded.app_id,
+                    public_key = excluded.public_key,
+                    counter    = MAX(counter, excluded.counter),
+                    idx        = excluded.idx,
+                    last_used  = MAX(COALESCE(last_used, excluded.last_used), COALESCE(excluded.last_used, last_used)),
+                    use_count  = MAX(use_count, excluded.use_count),
+                    extra      = excluded.extra'''
+    COUNTER = '''UPDATE u2f_devices SET counter = ?, last_used = COALESCE(?, last_used), use_count = use_count + ?
+                 WHERE user_id = ? AND key_handle = ? AND counter < ?'''
+    SCAN    = '''SELECT user_id, key_handle, app_id, public_key, counter, idx, last_used, use_count, extra
+                 FROM u2f_devices {where} ORDER BY user_id, key_handle'''
+    BOUND   = 'SELECT user_id FROM u2f_devices ORDER BY user_id LIMIT 1 OFFSET ?'
+
+    __memory_ids = itertools.count()
+
+    def __init__(self, path, pool_size=4, timeout=5.0, read_only=False):
+        if sqlite3.sqlite_version_info < (3, 24, 0):
+            raise RuntimeError('SQLiteDeviceStore requires SQLite 3.24 or later, found ' + sqlite3.sqlite_version)
+
+        self.pool_size = pool_size
+        self.timeout   = timeout
+        self.read_only = read_only
+
+        if path == ':memory:':
+            # Shared cache lets pooled connections see the same in-memory database
+            self.__database = 'file:u2f-memory-{pid}-{id}?mode=memory&cache=shared'.format(
+                pid=os.getpid(), id=next(self.__memory_ids))
+        else:
+            self.__database = 'file:' + os.path.abspath(path) + ('?mode=ro' if read_only else '')
+
+        self.__memory = path == ':memory:'
+        self.__lock   = threading.Lock()
+        self.__reset()
+
+        with self.connection() as connection:
+            if read_only:
+                columns = set(row[1] for row in connection.execute('PRAGMA table_info(u2f_devices)'))
+
+                for column, default in self.DEFAULTS:
+                    if column not in columns:
+                        self.SELECT = self.SELECT.replace(' {0},'.format(column), ' {0} AS {1},'.format(default, column))
+                        self.SCAN   = self.SCAN.replace(' {0},'.format(column), ' {0} AS {1},'.format(default, column))
+
+                return
+
+            if not self.__memory:
+                connection.execute('PRAGMA journal_mode = WAL')
+
+            for statement in self.SCHEMA:
+                connection.execute(statement)
+
+            columns = set(row[1] for row in connection.execute('PRAGMA table_info(u2f_devices)'))
+            for column, statement in self.MIGRATIONS:
+                if column not in columns:
+                    connection.execute(statement)
+
+    def __reset(self):
+        self.__pid     = os.getpid()
+        self.__pool    = queue.LifoQueue()
+        self.__created = 0
+
+    def __connect(self):
+        connection = sqlite3.connect(self.__database
+            , uri               = True
+            , timeout           = self.timeout
+            , isolation_level   = None
+            , check_same_thread = False
+            , cached_statements = 32)
+
+        connection.execute('PRAGMA synchronous = NORMAL')
+        return connection
+
+    @contextmanager
+    def connection(self):
+        """Borrows pooled connection"""
+
+        with self.__lock:
+            # Connections must not be shared with a forked child
+            if self.__pid != os.getpid():
+                self.__reset()
+
+            pool = self.__pool
+
+            try:
+                connection = pool.get_nowait()
+            except queue.Empty:
+                connection = None
+
+                if self.__created < self.pool_size:
+                    self.__created += 1
+                    connection = self.__connect()
+
+        if connection is None:
+            connection = pool.get(timeout=self.timeout)
+
+        try:
+            yield connection
+        finally:
+            pool.put(connection)
+
+    @contextmanager
+    def transaction(self):
+        """Borrows pooled connection inside write transaction"""
+
+        with self.connection() as connection:
+            connection.execute('BEGIN IMMEDIATE')
+            try:
+                yield connection
+            except BaseException:
+                connection.execute('ROLLBACK')
+                raise
+
+            connection.execute('COMMIT')
+
+    def read(self, user):
+        with self.connection() as connection:
+            return [row_to_device(row) for row in connection.execute(self.SELECT, (user,))]
+
+    def save(self, user, devices):
+        rows = [device_to_row(user, device) for device in devices]
+
+        with self.transaction() as connection:
+            existing = dict((row[0], (user,) + tuple(row)) for row in connection.execute(self.SELECT, (user,)))
+            wanted   = set(row[1] for row in rows)
+
+            for key_handle in existing:
+                if key_handle not in wanted:
+                    connection.execute(self.DELETE, (user, key_handle))
+
+            for row in rows:
+                if existing.get(row[1]) != row:
+                    connection.execute(self.UPSERT, row)
+
+    def save_counters(self, batch):
+        rejected = set()
+
+        with self.transaction() as connection:
+            for (user, key_handle), fields in batch.items():
+                counter = fields['counter']
+                cursor  = connection.execute(self.COUNTER,
+                    (counter, fields.get('last_used'), fields.get('uses', 0), user, key_handle, counter))
+
+                if cursor.rowcount == 0:
+                    rejected.add((user, key_handle))
+
+        return rejected
+
+    def shards(self, count):
+        # Ranges of user ids, split at quantiles walked on the primary key
+        with self.connection() as connection:
+            total  = connection.execute('SELECT COUNT(*) FROM u2f_devices').fetchone()[0]
+            bounds = [connection.execute(self.BOUND, (total * i // count,)).fetchone()[0]
+                      for i in range(1, count) if total * i // count < total]
+
+        return user_ranges(bounds)
+
+    def iter_devices(self, shard=None, batch_size=1000):
+        low, high  = shard or (None, None)
+        conditions = []
+        params     = []
+
+        if low is not None:
+            conditions.append('user_id >= ?')
+            params.append(low)
+
+        if high is not None:
+            conditions.append('user_id < ?')
+            params.append(high)
+
+        where = 'WHERE ' + ' AND '.join(conditions) if conditions else ''
+
+        with self.connection() as connection:
+            cursor = connection.execute(self.SCAN.format(where=where), params)
+            cursor.arraysize = batch_size
+
+            for rows in iter(cursor.fetchmany, []):
+                for row in rows:
+                    yield row[0], row_to_device(row[1:])
+
+
+class SQLAlchemyDeviceStore(DeviceStore):
+    """
+    SQLAlchemy device store. Requires SQLAlchemy 1.4 or newer.
+
+    Arguments:
+        engine:
+            (Engine or String) - SQLAlchemy engine, or database URL. Connection
+            pooling is provided by the engine.
+
+        table_name:
+            (String) - Name of the devices table.
+
+        metadata:
+            (MetaData) - Metadata to attach the table to, e.g. the one used by
+            the application's migrations. Table is created if metadata is not given.
+
+        read_only:
+            (Boolean) - Leaves the table as it is, without creating or
+            migrating it, e.g. for audits. Tables of older releases are read
+            with empty usage statistics.
+    """
+
+    def __init__(self, engine, table_name='u2f_devices', metadata=None, read_only=False):
+        import sqlalchemy as sa
+
+        self.sa     = sa
+        self.engine = sa.create_engine(engine) if isinstance(engine, str) else engine
+
+        create   = metadata is None
+        metadata = sa.MetaData() if metadata is None else metadata
+
+        self.table = sa.Table(table_name, metadata,
+            sa.Column('user_id',    sa.String(255), primary_key=True),
+            sa.Column('key_handle', sa.String(344), primary_key=True),
+            sa.Column('app_id',     sa.String(255), nullable=False),
+            sa.Column('public_key', sa.String(128), nullable=False),
+            sa.Column('counter',    sa.BigInteger,  nullable=False, default=0),
+            sa.Column('idx',        sa.Integer,     nullable=False, default=0),
+            sa.Column('last_used',  sa.BigInteger),
+            sa.Column('use_count',  sa.BigInteger,  nullable=False, default=0),
+            sa.Column('extra',      sa.Text),
+            sa.Index(table_name + '_key_handle', 'key_handle'))
+
+        table = self.table
+        sa    = self.sa
+
+        last_used, use_count = table.c.last_used, table.c.use_count
+
+        if read_only:
+            columns = set(column['name'] for column in sa.inspect(self.engine).get_columns(table_name))
+
+            if 'last_used' not in columns:
+                last_used = sa.null().label('last_used')
+
+            if 'use_count' not in columns:
+                use_count = sa.literal(0).label('use_count')
+
+        elif create:
+            metadata.create_all(self.engine)
+            self.migrate()
+
+        self.__columns = (table.c.key_handle, table.c.app_id, table.c.public_key, table.c.counter,
+                          table.c.idx, last_used, use_count, table.c.extra)
+
+        # Statements are built once and reused, so SQLAlchemy caches their compiled form
+        self.__select  = sa.select(*self.__columns) \
+                           .where(table.c.user_id == sa.bindparam('u')) \
+                           .order_by(table.c.idx)
+
+        self.__delete  = table.delete().where(sa.and_(
+                             table.c.user_id    == sa.bindparam('u'),
+                             table.c.key_handle == sa.bindparam('kh')))
+
+        self.__update  = table.update().where(sa.and_(
+                             table.c.user_id    == sa.bindparam('u'),
+                             table.c.key_handle == sa.bindparam('kh')))
+
+        self.__counter = table.update().where(sa.and_(
+                             table.c.user_id    == sa.bindparam('u'),
+                             table.c.key_handle == sa.bindparam('kh'),
+                             table.c.counter     < sa.bindparam('c'))) \
+                           .values(counter   = sa.bindparam('c'),
+                                   last_used = sa.func.coalesce(sa.bindparam('t', type_=sa.BigInteger), table.c.last_used),
+                                   use_count = table.c.use_count + sa.bindparam('n'))
+
+    def migrate(self):
+        """Adds usage statistics columns to a table created by an older release"""
+        sa      = self.sa
+        columns = set(column['name'] for column in sa.inspect(self.engine).get_columns(self.table.name))
+
+        with self.engine.begin() as connection:
+            if 'last_used' not in columns:
+                connection.execute(sa.text('ALTER TABLE {table} ADD COLUMN last_used BIGINT'.format(table=self.table.name)))
+
+            if 'use_count' not in columns:
+                connection.execute(sa.text('ALTER TABLE {table} ADD COLUMN use_count BIGINT NOT NULL DEFAULT 0'.format(table=self.table.name)))
+
+    def read(self, user):
+        with self.engine.connect() as connection:
+            return [row_to_device(tuple(row)) for row in connection.execute(self.__select, {'u': user})]
+
+    def save(self, user, devices):
+        rows = [device_to_row(user, device) for device in devices]
+
+        with self.engine.begin() as connection:
+            existing = dict((row[0], (user,) + tuple(row)) for row in connection.execute(self.__select, {'u': user}))
+            wanted   = set(row[1] for row in rows)
+
+            for key_handle in existing:
+                if key_handle not in wanted:
+                    connection.execute(self.__delete, {'u': user, 'kh': key_handle})
+
+            for row in rows:
+                old = existing.get(row[1])
+                if old == row:
+                    continue
+
+                last_used = [value for value in (row[6], old[6] if old else None) if value is not None]
+
+                values = {
+                    'app_id'     : row[2],
+                    'public_key' : row[3],
+                    'counter'    : max(row[4], old[4]) if old else row[4],
+                    'idx'        : row[5],
+                    'last_used'  : max(last_used) if last_used else None,
+                    'use_count'  : max(row[7], old[7]) if old else row[7],
+                    'extra'      : row[8]
+                }
+
+                if old:
+                    connection.execute(self.__update.values(**values), {'u': user, 'kh': row[1]})
+                else:
+                    connection.execute(self.table.insert().values(user_id=user, key_handle=row[1], **values))
+
+    def save_counters(self, batch):
+        rejected = set()
+
+        with self.engine.begin() as connection:
+            for (user, key_handle), fields in batch.items():
+                result = connection.execute(self.__counter, {
+                    'u'  : user,
+                    'kh' : key_handle,
+                    'c'  : fields['counter'],
+                    't'  : fields.get('last_used'),
+                    'n'  : fields.get('uses', 0)
+                })
+
+                if result.rowcount == 0:
+                    rejected.add((user, key_handle))
+
+        return rejected
+
+    def shards(self, count):
+        sa    = self.sa
+        table = self.table
+
+        with self.engine.connect() as connection:
+            total  = connection.execute(sa.select(sa.func.count()).select_from(table)).scalar()
+            bounds = [connection.execute(sa.select(table.c.user_id).order_by(table.c.user_id)
+                                           .limit(1).offset(total * i // count)).scalar()
+                      for i in range(1, count) if total * i // count < total]
+
+        return user_ranges(bounds)
+
+    def iter_devices(self, shard=None, batch_size=1000):
+        sa        = self.sa
+        table     = self.table
+        low, high = shard or (None, None)
+
+        query = sa.select(table.c.user_id, *self.__columns) \
+                  .order_by(table.c.user_id, table.c.key_handle)
+
+        if low is not None:
+            query = query.where(table.c.user_id >= low)
+
+        if high is not None:
+            query = query.where(table.c.user_id < high)
+
+        with self.engine.connect() as connection:
+            result = connection.execution_options(stream_results=True, yield_per=batch_size).execute(query)
+
+            for row in result:
+                yield row[0], row_to_device(tuple(row[1:]))
+
+
+class RedisDeviceStore(DeviceStore):
+    """
+    Redis device and challenge store. Takes a redis-py compatible client.
+
+    Keys:
+        {prefix}devices:{user}   - Hash of keyHandle -> device JSON, without counter and statistics
+        {prefix}counters:{user}  - Hash of keyHandle -> counter
+        {prefix}last_used:{user} - Hash of keyHandle -> last_used
+        {prefix}use_count:{user} - Hash of keyHandle -> use_count
+        {prefix}challenge:{kind}:{user}:{nonce}
+                                 - Pending challenge of a session, expiring after its TTL
+
+    Counters and usage statistics are kept apart from device JSON, so that
+    scripts can update them atomically without decoding devices. They are
+    kept per user, as key handles of different users may collide. Every operation is a single
+    round trip: scripts and challenge commands are pipelined together.
+
+    Arguments:
+        client:
+            (Redis) - Redis client, e.g. redis.Redis(), or fakeredis in tests.
+
+        prefix:
+            (String) - Prefix of all keys.
+    """
+
+    keeps_challenges = True
+
+    # Device fields kept in their own hashes
+    STATS = ('counter', 'last_used', 'use_count')
+
+    # Keys walked per SCAN call of shards() and their iter_devices()
+    SCAN_COUNT = 1000
+
+    # KEYS: devices, counters, last_used, use_count.
+    # Returns JSON, counter, last_used or '', use_count of each device
+    READ = '''
+        local devices = redis.call('HGETALL', KEYS[1])
+        local result  = {}
+
+        for i = 1, #devices, 2 do
+            result[#result + 1] = devices[i + 1]
+            result[#result + 1] = redis.call('HGET', KEYS[2], devices[i]) or '0'
+            result[#result + 1] = redis.call('HGET', KEYS[3], devices[i]) or ''
+            result[#result + 1] = redis.call('HGET', KEYS[4], devices[i]) or '0'
+        end
+
+        return result
+    '''
+
+    # KEYS: devices, counters, last_used, use_count.
+    # ARGV: keyHandle, JSON, counter, last_used or '', use_count, ...
+    # Counters and statistics never go backwards
+    SAVE = '''
+        local wanted = {}
+        for i = 1, #ARGV, 5 do
+            wanted[ARGV[i]] = true
+        end
+
+        for _, key_handle in ipairs(redis.call('HKEYS', KEYS[1])) do
+            if not wanted[key_handle] then
+                for k = 1, 4 do
+                    redis.call('HDEL', KEYS[k], key_handle)
+                end
+            end
+        end
+
+        for i = 1, #ARGV, 5 do
+            redis.call('HSET', KEYS[1], ARGV[i], ARGV[i + 1])
+
+            for k = 2, 4 do
+                local value = tonumber(ARGV[i + k])
+                if value and value > tonumber(redis.call('HGET', KEYS[k], ARGV[i]) or '-1') then
+                    redis.call('HSET', KEYS[k], ARGV[i], ARGV[i + k])
+                end
+            end
+        end
+
+        return 1
+    '''
+
+    # KEYS: counters, last_used, use_count. ARGV: keyHandle, counter, last_used or '', uses
+    COUNTER = '''
+        local current = redis.call('HGET', KEYS[1], ARGV[1])
+        if not current or tonumber(current) >= tonumber(ARGV[2]) then
+            return 0
+        end
+
+        redis.call('HSET', KEYS[1], ARGV[1], ARGV[2])
+
+        if ARGV[3] ~= '' then
+            redis.call('HSET', KEYS[2], ARGV[1], ARGV[3])
+        end
+
+        redis.call('HINCRBY', KEYS[3], ARGV[1], ARGV[4])
+        return 1
+    '''
+
+    def __init__(self, client, prefix='u2f:'):
+        self.client = client
+        self.prefix = prefix
+
+        self.__read     = client.register_script(self.READ)
+        self.__save     = client.register_script(self.SAVE)
+        self.__counter  = client.register_script(self.COUNTER)
+
+    def devices_key(self, user):
+        return '{prefix}devices:{user}'.format(prefix=self.prefix, user=user)
+
+    def stats_keys(self, user):
+        """Returns keys of users counters, last_used and use_count hashes"""
+        return ['{prefix}{stat}:{user}'.format(prefix=self.prefix, stat=stat, user=user)
+                for stat in ('counters', 'last_used', 'use_count')]
+
+    def challenge_key(self, user, kind, nonce=None):
+        key = '{prefix}challenge:{kind}:{user}'.format(prefix=self.prefix, kind=kind, user=user)
+        return key if nonce is None else '{key}:{nonce}'.format(key=key, nonce=nonce)
+
+    def __read_devices(self, user, pipe=None):
+        return self.__read(keys=[self.devices_key(user)] + self.stats_keys(user), client=pipe)
+
+    def __to_devices(self, reply):
+        devices = []
+
+        for i in range(0, len(reply), 4):
+            device = json.loads(reply[i])
+            device['counter'] = int(reply[i + 1])
+
+            # Usage statistics are only set on devices which were used
+            if reply[i + 2]:
+                device['last_used'] = int(reply[i + 2])
+                device['use_count'] = int(reply[i + 3])
+
+            devices.append(device)
+
+        devices.sort(key=lambda device: device.get('index', 0))
+        return devices
+
+    def read(self, user):
+        return self.__to_devices(self.__read_devices(user))
+
+    def save(self, user, devices):
+        args = []
+
+        for device in devices:
+            stored    = dict((key, value) for key, value in device.items() if key not in self.STATS)
+            last_used = device.get('last_used')
+
+            args.extend((device['keyHandle'], json.dumps(stored, sort_keys=True), device.get('counter', 0),
+                         '' if last_used is None else last_used, device.get('use_count', 0)))
+
+        self.__save(keys=[self.devices_key(user)] + self.stats_keys(user), args=args)
+
+    def save_counters(self, batch):
+        keys = list(batch)
+        pipe = self.client.pipeline(transaction=False)
+
+        for user, key_handle in keys:
+            fields    = batch[(user, key_handle)]
+            last_used = fields.get('last_used')
+
+            self.__counter(keys=self.stats_keys(user), client=pipe, args=[key_handle, fields['counter'],
+                           '' if last_used is None else last_used, fields.get('uses', 0)])
+
+        return set(key for key, advanced in zip(keys, pipe.execute()) if not advanced)
+
+    def issue_challenge(self, user, kind, challenge, ttl, nonce=None):
+        pipe = self.client.pipeline(transaction=False)
+
+        self.__read_devices(user, pipe)
+        pipe.set(self.challenge_key(user, kind, nonce), challenge, ex=max(int(ttl), 1))
+
+        return self.__to_devices(pipe.execute()[0])
+
+    def consume_challenge(self, user, kind, nonce=None):
+        # MULTI makes GET and DEL atomic, so a challenge is handed out only once
+        key  = self.challenge_key(user, kind, nonce)
+        pipe = self.client.pipeline(transaction=True)
+
+        pipe.get(key)
+        pipe.delete(key)
+        self.__read_devices(user, pipe)
+
+        challenge, _, reply = pipe.execute()
+
+        if isinstance(challenge, bytes):
+            challenge = challenge.decode('utf-8')
+
+        return challenge, self.__to_devices(reply)
+
+    def shards(self, count):
+        # Shards are (start, end, count) SCAN cursor ranges. Cursors are
+        # walked once, keeping one per SCAN call rather than every user id,
+        # and split at quantiles of matched keys. Workers resume SCAN from
+        # start with the same count, and stop at end. As with any SCAN,
+        # keys written or a rehash during the audit may be missed or seen
+        # twice
+        cursors = []
+        matched = 0
+        cursor  = 0
+
+        while True:
+            cursor, keys = self.client.scan(cursor, match=self.devices_key('*'), count=self.SCAN_COUNT)
+            matched += len(keys)
+
+            if cursor == 0:
+                break
+
+            cursors.append((matched, cursor))
+
+        bounds = []
+        for i in range(1, count):
+            bound = next((cursor for seen, cursor in cursors if seen >= matched * i // count), None)
+
+            if bound is not None and bound not in bounds:
+                bounds.append(bound)
+
+        return [(start, end, self.SCAN_COUNT) for start, end in zip([0] + bounds, bounds + [0])]
+
+    def iter_devices(self, shard=None, batch_size=1000):
+        users = self.__scan_users(batch_size) if shard is None else self.__scan_range(*shard)
+        batch = []
+
+        for user in users:
+            batch.append(user)
+
+            if len(batch) >= batch_size:
+                yield from self.__read_batch(batch)
+                batch = []
+
+        if batch:
+            yield from self.__read_batch(batch)
+
+    def __scan_users(self, batch_size=1000):
+        start = len(self.devices_key(''))
+
+        for key in self.client.scan_iter(match=self.devices_key('*'), count=batch_size):
+            if isinstance(key, bytes):
+                key = key.decode('utf-8')
+
+            yield key[start:]
+
+    def __scan_range(self, start, end, count):
+        prefix = len(self.devices_key(''))
+        cursor = start
+
+        while True:
+            cursor, keys = self.client.scan(cursor, match=self.devices_key('*'), count=count)
+
+            for key in keys:
+                if isinstance(key, bytes):
+                    key = key.decode('utf-8')
+
+                yield key[prefix:]
+
+            if cursor == end or cursor == 0:
+                break
+
+    def __read_batch(self, users):
+        pipe = self.client.pipeline(transaction=False)
+
+        for user in users:
+            self.__read_devices(user, pipe)
+
+        for user, reply in zip(users, pipe.execute()):
+            for device in self.__to_devices(reply):
+                yield user, device
@@ -0,0 +1,44 @@
+import re
+
+from .errors import FailureReason, U2FFailure
+
+# Maximum lengths of websafe base64 encoded fields
+#   registrationData: 0x05, 65 bytes public key, key handle, attestation certificate, signature
+#   clientData:       JSON with typ, challenge, origin and optional cid_pubkey
+#   signatureData:    user presence, 4 bytes counter, DER signature of at most 72 bytes
+#   keyHandle:        at most 255 bytes
+FIELD_LIMITS = {
+    'registrationData' : 8192,
+    'clientData'       : 2048,
+    'signatureData'    : 256,
+    'keyHandle'        : 344
+}
+
+ENROLL_FIELDS = ('registrationData', 'clientData')
+SIGN_FIELDS   = ('keyHandle', 'clientData', 'signatureData')
+
+WEBSAFE_BASE64 = re.compile(r'^[A-Za-z0-9_-]*={0,2}$')
+
+
+def validate_payload(payload, fields):
+    """
+    Checks that payload is an object with all required fields being websafe
+    base64 strings within FIELD_LIMITS. Raises U2FFailure otherwise.
+    """
+
+    if not isinstance(payload, dict):
+        raise U2FFailure(FailureReason.MALFORMED_PAYLOAD, 'Payload must be an object!')
+
+    for field in fields:
+        value = payload.get(field)
+
+        if not isinstance(value, str):
+            raise U2FFailure(FailureReason.MALFORMED_PAYLOAD, 'Missing {field}!'.format(field=field))
+
+        if len(value) > FIELD_LIMITS[field]:
+            raise U2FFailure(FailureReason.MALFORMED_PAYLOAD, '{field} is too long!'.format(field=field))
+
+        if not WEBSAFE_BASE64.match(value):
+            raise U2FFailure(FailureReason.MALFORMED_PAYLOAD, '{field} is not websafe base64!'.format(field=field))
+
+    return payload
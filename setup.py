@@ -27,16 +27,22 @@ setup(
     long_description     =  read('README.md'),
     keywords             = 'flask fido u2f 2fa',
 
-    py_modules           = ['flask_fido_u2f'],
+    packages             = ['flask_fido_u2f'],
     zip_safe             = True,
     test_suite           = 'test',
     tests_require        = [],
     include_package_data = True,
     platforms            = 'any',
+    python_requires      = '>=3.7',
     install_requires     = [
         'Flask',
-        'python-u2flib-server'
+        'python-u2flib-server',
+        'cryptography>=1.5'
     ],
+    extras_require       = {
+        'sqlalchemy' : ['SQLAlchemy>=1.4'],
+        'redis'      : ['redis>=4.0']
+    },
     classifiers          = [
         'Environment :: Web Environment',
         'License :: OSI Approved :: MIT License',
@@ -49,9 +55,11 @@ setup(
         # 'Programming Language :: Python :: 2.6',
         # 'Programming Language :: Python :: 2.7',
         'Programming Language :: Python :: 3',
-        'Programming Language :: Python :: 3.3',
-        'Programming Language :: Python :: 3.4',
-        'Programming Language :: Python :: 3.5',
+        'Programming Language :: Python :: 3.7',
+        'Programming Language :: Python :: 3.8',
+        'Programming Language :: Python :: 3.9',
+        'Programming Language :: Python :: 3.10',
+        'Programming Language :: Python :: 3.11',
         'Programming Language :: Python :: Implementation :: PyPy',
         'Topic :: Internet',
         'Topic :: Security :: Cryptography',
@@ -0,0 +1,59 @@
+import unittest
+
+from flask_fido_u2f.anomaly import CounterAnomalyDetector
+
+class CounterAnomalyDetectorTest(unittest.TestCase):
+    def setUp(self):
+        self.detector = CounterAnomalyDetector(window=3, max_jump=100, jump_factor=10, burst_interval=60, max_entries=2)
+
+    def kinds(self, key_handle, counter, now):
+        return [anomaly.kind for anomaly in self.detector.observe(key_handle, counter, now)]
+
+    def test_jump(self):
+        self.assertEqual(self.kinds('kh1', 1, 0), [])
+        self.assertEqual(self.kinds('kh1', 2, 1000), [])
+        self.assertEqual(self.kinds('kh1', 500, 2000), ['jump'])
+
+        anomaly = self.detector.observe('kh1', 5000, 3000)[0]
+        self.assertEqual((anomaly.key_handle, anomaly.counter, anomaly.delta), ('kh1', 5000, 4500))
+
+    def test_large_deltas_are_learned(self):
+        for i, counter in enumerate((0, 50, 100, 150)):
+            self.assertEqual(self.kinds('kh1', counter, i * 1000), [])
+
+        # Key shared with a busy site, jump is within usual deltas
+        self.assertEqual(self.kinds('kh1', 350, 5000), [])
+
+    def test_burst(self):
+        for i in range(3):
+            self.assertEqual(self.kinds('kh1', i + 1, i), [])
+
+        self.assertEqual(self.kinds('kh1', 4, 3), ['burst'])
+
+        # ----- Window slides past the burst ----- #
+        self.assertEqual(self.kinds('kh1', 5, 1000), [])
+
+    def test_lru_eviction(self):
+        self.detector.observe('kh1', 1, 0)
+        self.detector.observe('kh2', 1, 0)
+        self.detector.observe('kh1', 2, 1000)
+        self.detector.observe('kh3', 1, 0)
+
+        self.assertEqual(len(self.detector), 2)
+
+        self.assertEqual(self.kinds('kh1', 10000, 2000), ['jump'])
+
+        # kh2 was least recently used, so its next counter is a fresh start
+        self.assertEqual(self.kinds('kh2', 10000, 2000), [])
+
+    def test_users_kept_apart(self):
+        self.assertEqual(self.kinds('kh1', 1, 0), [])
+
+        # Key handle chosen by a device of another user does not touch the window
+        self.assertEqual(self.detector.observe('kh1', 1, 1000, user='mallory'), [])
+        self.assertEqual(self.detector.observe('kh1', 5000, 2000, user='mallory')[0].user, 'mallory')
+
+        self.assertEqual(self.kinds('kh1', 2, 3000), [])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,7 +1,7 @@
-import unittest, json
+import unittest, json, base64, time, threading, tempfile, shutil
 
-from flask import Flask, session
-from flask_fido_u2f import U2F
+from flask import Flask, session, g, request
+from flask_fido_u2f import U2F, U2FFailure, FailureReason
 
 from .soft_u2f_v2 import SoftU2FDevice
 
@@ -112,7 +112,8 @@ class APITest(unittest.TestCase):
 
         self.assertDictEqual(response_json, {
             'error': 'Invalid key handle!', 
-            'status': 'failed'
+            'status': 'failed',
+            'code': 'facet_mismatch'
         })
 
         # ----- 201 CREATED ----- #
@@ -248,7 +249,8 @@ class APITest(unittest.TestCase):
 
         self.assertDictEqual(response_json, {
             'error': 'Invalid signature!', 
-            'status': 'failed'
+            'status': 'failed',
+            'code': 'facet_mismatch'
         })
 
         # Good signature
@@ -278,6 +280,1090 @@ class APITest(unittest.TestCase):
 
         self.assertGreater(response_json['counter'], old_counter)
 
+        # ----- Usage statistics are saved with the counter ----- #
+        self.assertEqual(self.u2f_devices[0]['use_count'], 1)
+        self.assertIsInstance(self.u2f_devices[0]['last_used'], int)
+
+
+    def test_signature_replay(self):
+        """Tests that a consumed challenge can not be replayed from an old session"""
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess['u2f_enroll_authorized'] = True
+
+        enroll_response = self.client.get(self.enroll_route)
+        enroll_response_json = json.loads(enroll_response.get_data(as_text=True))
+
+        challenge = enroll_response_json['registerRequests'][0]
+        keyhandle = self.u2f_token.register(challenge, facet=self.app.config['U2F_APPID'])
+
+        self.client.post(self.enroll_route, data=json.dumps(keyhandle), headers={
+            'content-type': 'application/json'
+        })
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess['u2f_sign_required'] = True
+
+        response      = self.client.get(self.sign_route)
+        response_json = json.loads(response.get_data(as_text=True))
+
+        # Saving session, as it would be kept by client side cookie
+        with self.client as c:
+            with c.session_transaction() as sess:
+                old_session = dict(sess)
+
+        challenge = response_json['authenticateRequests'][0]
+        signature = self.u2f_token.getAssertion(challenge, facet=self.app.config['U2F_APPID'])
+
+        response = self.client.post(self.sign_route, data=json.dumps(signature), headers={
+            'content-type': 'application/json'
+        })
+
+        self.assertEqual(response.status_code, 201)
+
+        # ----- Replaying old session ----- #
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess.update(old_session)
+
+        signature = self.u2f_token.getAssertion(challenge, facet=self.app.config['U2F_APPID'])
+
+        response = self.client.post(self.sign_route, data=json.dumps(signature), headers={
+            'content-type': 'application/json'
+        })
+
+        self.assertEqual(response.status_code, 400)
+
+        # ----- Expired challenge ----- #
+        response      = self.client.get(self.sign_route)
+        response_json = json.loads(response.get_data(as_text=True))
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess['_u2f_challenge_expires_'] = 0
+
+        challenge = response_json['authenticateRequests'][0]
+        signature = self.u2f_token.getAssertion(challenge, facet=self.app.config['U2F_APPID'])
+
+        response = self.client.post(self.sign_route, data=json.dumps(signature), headers={
+            'content-type': 'application/json'
+        })
+
+        self.assertEqual(response.status_code, 400)
+
+
+    def test_legacy_session_challenge(self):
+        """Tests that request JSON kept in session by earlier versions, without expiration time, is accepted"""
+
+        from u2flib_server.jsapi import DeviceRegistration
+        from u2flib_server.u2f import start_authenticate
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess['u2f_enroll_authorized'] = True
+
+        response_json = json.loads(self.client.get(self.enroll_route).get_data(as_text=True))
+        keyhandle     = self.u2f_token.register(response_json['registerRequests'][0], facet=self.app.config['U2F_APPID'])
+        self.client.post(self.enroll_route, data=json.dumps(keyhandle), headers={'content-type': 'application/json'})
+
+        challenge = start_authenticate([DeviceRegistration.wrap(device) for device in self.u2f_devices])
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess['u2f_sign_required'] = True
+                sess['_u2f_challenge_']   = challenge.json
+
+        signature = self.u2f_token.getAssertion(challenge['authenticateRequests'][0], facet=self.app.config['U2F_APPID'])
+        response  = self.client.post(self.sign_route, data=json.dumps(signature), headers={'content-type': 'application/json'})
+
+        self.assertEqual(response.status_code, 201)
+
+        # ----- Legacy challenges are still consumed once ----- #
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess['u2f_sign_required'] = True
+                sess['_u2f_challenge_']   = challenge.json
+
+        response = self.client.post(self.sign_route, data=json.dumps(signature), headers={'content-type': 'application/json'})
+        self.assertEqual(response.status_code, 400)
+
+        # ----- Replay after the replay cache forgot it, past the cutoff ----- #
+        self.u2f.core.replay_cache.evict(time.time() + 3600)
+        self.assertEqual(len(self.u2f.core.replay_cache), 0)
+
+        self.app.config['U2F_LEGACY_CHALLENGE_CUTOFF'] = time.time() - 1
+        self.u2f.init_app(self.app)
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess['u2f_sign_required'] = True
+                sess['_u2f_challenge_']   = challenge.json
+
+        # Fresh signature of the old challenge, so that only its age can reject it
+        signature = self.u2f_token.getAssertion(challenge['authenticateRequests'][0], facet=self.app.config['U2F_APPID'])
+        response  = self.client.post(self.sign_route, data=json.dumps(signature), headers={'content-type': 'application/json'})
+
+        self.assertEqual(response.status_code, 400)
+
+
+    def test_missing_challenge(self):
+        """Tests POST without preceding GET"""
+
+        failures = []
+        reads    = []
+
+        @self.u2f.read
+        def read():
+            reads.append(True)
+            return self.u2f_devices
+
+        @self.u2f.enroll_on_fail
+        def enroll_on_fail(e):
+            failures.append(e)
+
+        @self.u2f.sign_on_fail
+        def sign_on_fail(e):
+            failures.append(e)
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess['u2f_enroll_authorized'] = True
+                sess['u2f_sign_required']     = True
+
+        for route in (self.enroll_route, self.sign_route):
+            response = self.client.post(route, data=json.dumps({}), headers={
+                'content-type': 'application/json'
+            })
+
+            self.assertEqual(response.status_code, 400)
+            response_json = json.loads(response.get_data(as_text=True))
+
+            self.assertDictEqual(response_json, {
+                'status' : 'failed',
+                'error'  : 'No pending challenge!',
+                'code'   : 'missing_challenge'
+            })
+
+        self.assertEqual(reads, [])
+        self.assertTrue(all(isinstance(e, U2FFailure) for e in failures))
+        self.assertEqual([e.reason for e in failures], [FailureReason.MISSING_CHALLENGE] * 2)
+
+        self.assertEqual(self.u2f.metrics.get('enroll.missing_challenge'), 1)
+        self.assertEqual(self.u2f.metrics.get('sign.missing_challenge'), 1)
+
+
+    def test_failure_reasons(self):
+        """Tests that sign failures are classified"""
+
+        failures = []
+
+        @self.u2f.sign_on_fail
+        def sign_on_fail(e):
+            failures.append(e)
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess['u2f_enroll_authorized'] = True
+                sess['u2f_sign_required']     = True
+
+        enroll_response = self.client.get(self.enroll_route)
+        enroll_response_json = json.loads(enroll_response.get_data(as_text=True))
+
+        challenge = enroll_response_json['registerRequests'][0]
+        keyhandle = self.u2f_token.register(challenge, facet=self.app.config['U2F_APPID'])
+
+        self.client.post(self.enroll_route, data=json.dumps(keyhandle), headers={
+            'content-type': 'application/json'
+        })
+
+        def websafe(data):
+            return base64.urlsafe_b64encode(data).decode('ascii').rstrip('=')
+
+        def unwebsafe(data):
+            return base64.urlsafe_b64decode(data + '=' * (-len(data) % 4))
+
+        def bad_challenge(challenge):
+            challenge = dict(challenge, challenge=websafe(b'0' * 32))
+            return self.u2f_token.getAssertion(challenge, facet=self.app.config['U2F_APPID'])
+
+        def unknown_key_handle(challenge):
+            signature = self.u2f_token.getAssertion(challenge, facet=self.app.config['U2F_APPID'])
+            return dict(signature, keyHandle=websafe(b'0' * 64))
+
+        def bad_signature(challenge):
+            signature = self.u2f_token.getAssertion(challenge, facet=self.app.config['U2F_APPID'])
+            data      = bytearray(unwebsafe(signature['signatureData']))
+            data[4]  ^= 0xff
+
+            return dict(signature, signatureData=websafe(bytes(data)))
+
+        def malformed_payload(challenge):
+            signature = self.u2f_token.getAssertion(challenge, facet=self.app.config['U2F_APPID'])
+            return dict(signature, clientData='!!!')
+
+        def counter_regression(challenge):
+            self.u2f_token.counter = 0
+            return self.u2f_token.getAssertion(challenge, facet=self.app.config['U2F_APPID'])
+
+        cases = [
+            (bad_challenge,      FailureReason.BAD_CHALLENGE),
+            (unknown_key_handle, FailureReason.UNKNOWN_KEY_HANDLE),
+            (bad_signature,      FailureReason.BAD_SIGNATURE),
+            (malformed_payload,  FailureReason.MALFORMED_PAYLOAD),
+            (counter_regression, FailureReason.COUNTER_REGRESSION)
+        ]
+
+        # Counter regression requires stored counter to be ahead of the token
+        self.u2f_devices[0]['counter'] = 10
+
+        for make_signature, reason in cases:
+            response      = self.client.get(self.sign_route)
+            response_json = json.loads(response.get_data(as_text=True))
+
+            signature = make_signature(response_json['authenticateRequests'][0])
+
+            response = self.client.post(self.sign_route, data=json.dumps(signature), headers={
+                'content-type': 'application/json'
+            })
+
+            self.assertEqual(response.status_code, 400)
+            response_json = json.loads(response.get_data(as_text=True))
+
+            self.assertEqual(response_json['code'], reason.value)
+            self.assertEqual(failures[-1].reason, reason)
+            self.assertEqual(self.u2f.metrics.get('sign.' + reason.value), 1)
+
+        self.assertEqual(len(failures), len(cases))
+
+
+    def test_storage_errors(self):
+        """Tests that storage errors are not counted as U2F failures"""
+
+        failures = []
+        down     = []
+
+        @self.u2f.read
+        def read():
+            if down:
+                raise ConnectionError('db down')
+
+            return self.u2f_devices
+
+        @self.u2f.sign_on_fail
+        def sign_on_fail(e):
+            failures.append(e)
+
+        self.u2f_devices = [{'keyHandle': 'kh1', 'appId': self.app.config['U2F_APPID'], 'publicKey': 'pk',
+                             'counter': 0, 'index': 0, 'version': 'U2F_V2'}]
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess['u2f_sign_required'] = True
+
+        response_json = json.loads(self.client.get(self.sign_route).get_data(as_text=True))
+        signature     = {'keyHandle': 'kh1', 'clientData': 'e30', 'signatureData': 'AA'}
+
+        down.append(True)
+        response = self.client.post(self.sign_route, data=json.dumps(signature), headers={'content-type': 'application/json'})
+
+        self.assertEqual(response.status_code, 500)
+        self.assertEqual(failures, [])
+        self.assertEqual(self.u2f.metrics.get('sign.malformed_payload'), 0)
+
+
+    def test_payload_read_before(self):
+        """Tests that bodies already read by other handlers, e.g. with get_json(), are still verified"""
+
+        @self.app.before_request
+        def read_body():
+            request.get_json(silent=True)
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess['u2f_enroll_authorized'] = True
+                sess['u2f_sign_required']     = True
+
+        response_json = json.loads(self.client.get(self.enroll_route).get_data(as_text=True))
+        keyhandle     = self.u2f_token.register(response_json['registerRequests'][0], facet=self.app.config['U2F_APPID'])
+        response      = self.client.post(self.enroll_route, data=json.dumps(keyhandle), headers={'content-type': 'application/json'})
+        self.assertEqual(response.status_code, 201)
+
+        response_json = json.loads(self.client.get(self.sign_route).get_data(as_text=True))
+        signature     = self.u2f_token.getAssertion(response_json['authenticateRequests'][0], facet=self.app.config['U2F_APPID'])
+        response      = self.client.post(self.sign_route, data=json.dumps(signature), headers={'content-type': 'application/json'})
+        self.assertEqual(response.status_code, 201)
+
+
+    def test_payload_too_large_only(self):
+        """Tests that only failures reading the body are reported as 413"""
+
+        def verify_signature(signature):
+            raise U2FFailure(FailureReason.BAD_CHALLENGE, 'Wrong challenge!')
+
+        self.u2f.verify_signature = verify_signature
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess['u2f_sign_required'] = True
+
+        response = self.client.post(self.sign_route, data=json.dumps({}), headers={'content-type': 'application/json'})
+        self.assertEqual(response.status_code, 500)
+
+
+    def test_payload_validation(self):
+        """Tests that malformed payloads are rejected before devices are read"""
+
+        reads = []
+
+        @self.u2f.read
+        def read():
+            reads.append(True)
+            return self.u2f_devices
+
+        self.app.config['U2F_MAX_PAYLOAD_SIZE'] = 1024
+        self.u2f.init_app(self.app)
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess['u2f_sign_required'] = True
+                sess['_u2f_challenge_']   = json.dumps({'authenticateRequests': []})
+
+        # ----- Body too large ----- #
+        response = self.client.post(self.sign_route, data=json.dumps({'keyHandle': 'A' * 2048}), headers={
+            'content-type': 'application/json'
+        })
+
+        self.assertEqual(response.status_code, 413)
+        response_json = json.loads(response.get_data(as_text=True))
+
+        self.assertEqual(response_json['code'], 'malformed_payload')
+
+        # ----- Field too long, not base64, missing, not JSON ----- #
+        payloads = [
+            json.dumps({'keyHandle': 'A' * 512, 'clientData': 'AAAA', 'signatureData': 'AAAA'}),
+            json.dumps({'keyHandle': 'AAAA', 'clientData': '{"typ"}', 'signatureData': 'AAAA'}),
+            json.dumps({'keyHandle': 'AAAA', 'clientData': 'AAAA'}),
+            json.dumps(['AAAA']),
+            'Not a JSON'
+        ]
+
+        for payload in payloads:
+            with self.client as c:
+                with c.session_transaction() as sess:
+                    sess['_u2f_challenge_'] = json.dumps({'authenticateRequests': []})
+
+            response = self.client.post(self.sign_route, data=payload, headers={
+                'content-type': 'application/json'
+            })
+
+            self.assertEqual(response.status_code, 400)
+            response_json = json.loads(response.get_data(as_text=True))
+
+            self.assertEqual(response_json['code'], 'malformed_payload')
+
+        self.assertEqual(reads, [])
+
+
+    def test_challenge_pool(self):
+        """Tests that enroll challenges are taken from the pool"""
+
+        self.app.config['U2F_CHALLENGE_POOL_SIZE'] = 8
+        self.u2f.init_app(self.app)
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess['u2f_enroll_authorized'] = True
+
+        self.client.get(self.enroll_route)
+
+        self.assertEqual(self.u2f.metrics.get('pool.refills'), 1)
+
+
+    def test_compact_challenges(self):
+        """Tests compact challenge format, and sizes of challenges and session"""
+
+        appid = self.app.config['U2F_APPID']
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess['u2f_enroll_authorized'] = True
+                sess['u2f_sign_required']     = True
+
+        # ----- Enroll and sign, with requests built as by u2f-api.js ----- #
+        self.app.config['U2F_COMPACT_CHALLENGES'] = True
+        self.u2f.init_app(self.app)
+
+        response_json = json.loads(self.client.get(self.enroll_route).get_data(as_text=True))
+        self.assertEqual(response_json['keyHandles'], [])
+
+        register_request = {
+            'appId'     : response_json['appId'],
+            'version'   : response_json['version'],
+            'challenge' : response_json['challenge']
+        }
+        response = self.client.post(self.enroll_route,
+            data=json.dumps(self.u2f_token.register(register_request, facet=appid)),
+            headers={'content-type': 'application/json'})
+
+        self.assertEqual(response.status_code, 201)
+
+        response_json = json.loads(self.client.get(self.sign_route).get_data(as_text=True))
+        self.assertEqual(response_json['keyHandles'], [self.u2f_devices[0]['keyHandle']])
+
+        sign_request = {
+            'appId'     : response_json['appId'],
+            'version'   : response_json['version'],
+            'challenge' : response_json['challenge'],
+            'keyHandle' : response_json['keyHandles'][0]
+        }
+        response = self.client.post(self.sign_route,
+            data=json.dumps(self.u2f_token.getAssertion(sign_request, facet=appid)),
+            headers={'content-type': 'application/json'})
+
+        self.assertEqual(response.status_code, 201)
+
+        # ----- Sizes with many devices ----- #
+        def sizes(count):
+            self.u2f_devices = [{
+                'keyHandle' : base64.urlsafe_b64encode(bytes([i]) * 64).decode('ascii').rstrip('='),
+                'appId'     : appid,
+                'publicKey' : 'B' * 87,
+                'counter'   : 0,
+                'index'     : i
+            } for i in range(count)]
+
+            with self.client as c:
+                with c.session_transaction() as sess:
+                    sess['u2f_sign_required'] = True
+
+            response = self.client.get(self.sign_route)
+            cookie   = response.headers['Set-Cookie'].split(';')[0]
+
+            return len(response.get_data()), len(cookie)
+
+        compact_size, compact_cookie = sizes(32)
+        small_size,   small_cookie   = sizes(1)
+
+        self.app.config['U2F_COMPACT_CHALLENGES'] = False
+        self.u2f.init_app(self.app)
+
+        full_size, full_cookie = sizes(32)
+
+        # Key handle, quotes and comma per device
+        self.assertLessEqual(compact_size - small_size, 31 * (86 + 3))
+        self.assertLess(compact_size * 2, full_size)
+
+        # Session keeps device set hash, not the devices. Cookie is compressed, so sizes vary slightly
+        self.assertLessEqual(compact_cookie, small_cookie + 32)
+        self.assertLessEqual(full_cookie, small_cookie + 32)
+
+
+    def test_read_coalescing(self):
+        """Tests that reads are shared, and writes read and invalidate on their own"""
+
+        self.app.config['U2F_READ_COALESCING'] = True
+        self.app.config['U2F_READ_FRESHNESS']  = 60
+        self.u2f.init_app(self.app)
+
+        reads = []
+
+        @self.u2f.read
+        def read():
+            reads.append(1)
+            return self.u2f_devices
+
+        @self.u2f.identity
+        def identity():
+            return 'alice'
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess['u2f_enroll_authorized']            = True
+                sess['u2f_sign_required']                = True
+                sess['u2f_device_management_authorized'] = True
+
+        response_json = json.loads(self.client.get(self.enroll_route).get_data(as_text=True))
+        keyhandle     = self.u2f_token.register(response_json['registerRequests'][0], facet=self.app.config['U2F_APPID'])
+
+        self.client.post(self.enroll_route, data=json.dumps(keyhandle), headers={'content-type': 'application/json'})
+        self.assertEqual(len(reads), 2)
+
+        self.client.get(self.devices_route)
+        response_json = json.loads(self.client.get(self.sign_route).get_data(as_text=True))
+        self.assertEqual(len(reads), 3)
+
+        signature = self.u2f_token.getAssertion(response_json['authenticateRequests'][0], facet=self.app.config['U2F_APPID'])
+        response  = self.client.post(self.sign_route, data=json.dumps(signature), headers={'content-type': 'application/json'})
+        self.assertEqual(response.status_code, 201)
+
+        # Shared read for verification, own read for the counter
+        self.assertEqual(len(reads), 4)
+
+        response_json = json.loads(self.client.get(self.devices_route).get_data(as_text=True))
+        self.assertEqual(response_json['devices'][0]['use_count'], 1)
+        self.assertEqual(len(reads), 5)
+
+
+    def test_events(self):
+        """Tests that enroll and sign outcomes are published to subscribers"""
+
+        self.app.config['U2F_EVENT_WORKERS'] = 1
+        self.u2f.init_app(self.app)
+
+        events  = []
+        batches = []
+
+        @self.u2f.subscribe('enroll.success', 'sign.success', 'sign.fail')
+        def on_event(event):
+            events.append(event)
+
+        @self.u2f.subscribe(batch=True)
+        def on_batch(batch):
+            batches.append(batch)
+
+        @self.u2f.identity
+        def identity():
+            return 'alice'
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess['u2f_enroll_authorized'] = True
+                sess['u2f_sign_required']     = True
+
+        response_json = json.loads(self.client.get(self.enroll_route).get_data(as_text=True))
+        keyhandle     = self.u2f_token.register(response_json['registerRequests'][0], facet=self.app.config['U2F_APPID'])
+        self.client.post(self.enroll_route, data=json.dumps(keyhandle), headers={'content-type': 'application/json'})
+
+        response_json = json.loads(self.client.get(self.sign_route).get_data(as_text=True))
+        signature     = self.u2f_token.getAssertion(response_json['authenticateRequests'][0], facet=self.app.config['U2F_APPID'])
+        self.client.post(self.sign_route, data=json.dumps(signature), headers={'content-type': 'application/json'})
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess['u2f_sign_required'] = True
+
+        self.client.get(self.sign_route)
+        self.client.post(self.sign_route, data=json.dumps(signature), headers={'content-type': 'application/json'})
+
+        self.u2f.events.stop()
+
+        self.assertEqual([event.kind for event in events], ['enroll.success', 'sign.success', 'sign.fail'])
+        self.assertEqual(set(event.user for event in events), {'alice'})
+        self.assertEqual(events[1].key_handle, self.u2f_devices[0]['keyHandle'])
+        self.assertEqual(events[1].counter, 1)
+        self.assertEqual(events[2].failure.reason, FailureReason.BAD_CHALLENGE)
+        self.assertEqual(sum(len(batch) for batch in batches), 3)
+
+
+    def test_storage_timeout_hooks_see_g(self):
+        """Tests that hooks run with a timeout see flask.g of the request"""
+
+        self.app.config['U2F_READ_TIMEOUT'] = 1
+        self.app.config['U2F_SAVE_TIMEOUT'] = 1
+        self.u2f.init_app(self.app)
+
+        devices = {'alice': []}
+
+        @self.app.before_request
+        def load_user():
+            g.user = 'alice'
+
+        @self.u2f.read
+        def read():
+            return devices[g.user]
+
+        @self.u2f.save
+        def save(u2fdata):
+            devices[g.user] = u2fdata
+
+        @self.u2f.identity
+        def identity():
+            return g.user
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess['u2f_enroll_authorized']            = True
+                sess['u2f_device_management_authorized'] = True
+
+        response_json = json.loads(self.client.get(self.enroll_route).get_data(as_text=True))
+        keyhandle     = self.u2f_token.register(response_json['registerRequests'][0], facet=self.app.config['U2F_APPID'])
+        response      = self.client.post(self.enroll_route, data=json.dumps(keyhandle), headers={'content-type': 'application/json'})
+        self.assertEqual(response.status_code, 201)
+
+        response = self.client.get(self.devices_route)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(json.loads(response.get_data(as_text=True))['devices']), 1)
+        self.assertEqual(self.u2f.metrics.get('storage.error'), 0)
+
+
+    def test_storage_outage(self):
+        """Tests hook timeouts, circuit breaker and stale reads for challenges"""
+
+        self.app.config['U2F_READ_TIMEOUT']       = 0.05
+        self.app.config['U2F_BREAKER_FAILURES']   = 3
+        self.app.config['U2F_STALE_READ_MAX_AGE'] = 60
+        self.u2f.init_app(self.app)
+
+        hang = threading.Event()
+        self.addCleanup(hang.set)
+
+        @self.u2f.read
+        def read():
+            if not hang.is_set():
+                threading.Event().wait(1)
+
+            return self.u2f_devices
+
+        @self.u2f.identity
+        def identity():
+            return session.get('user', 'alice')
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess['u2f_enroll_authorized']            = True
+                sess['u2f_sign_required']                = True
+                sess['u2f_device_management_authorized'] = True
+
+        hang.set()
+
+        response_json = json.loads(self.client.get(self.enroll_route).get_data(as_text=True))
+        keyhandle     = self.u2f_token.register(response_json['registerRequests'][0], facet=self.app.config['U2F_APPID'])
+        self.client.post(self.enroll_route, data=json.dumps(keyhandle), headers={'content-type': 'application/json'})
+        self.client.get(self.devices_route)
+
+        hang.clear()
+
+        # Challenges are served from the last read, other reads fail
+        response = self.client.get(self.sign_route)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(json.loads(response.get_data(as_text=True))['authenticateRequests']), 1)
+        self.assertEqual(self.u2f.metrics.get('storage.stale_read'), 1)
+
+        response = self.client.get(self.devices_route)
+        self.assertEqual(response.status_code, 503)
+        self.assertEqual(json.loads(response.get_data(as_text=True)), {
+            'status' : 'failed',
+            'error'  : 'Storage unavailable!'
+        })
+
+        response = self.client.get(self.sign_route)
+        self.assertEqual(response.status_code, 200)
+
+        # Circuit is open, requests fail without calling the hook
+        self.assertEqual(self.u2f.metrics.get('storage.timeout'), 3)
+        self.assertEqual(self.u2f.metrics.get('breaker.open'), 1)
+
+        start    = time.time()
+        response = self.client.get(self.devices_route)
+        self.assertEqual(response.status_code, 503)
+        self.assertLess(time.time() - start, 0.05)
+        self.assertEqual(self.u2f.metrics.get('breaker.rejected'), 1)
+
+        # Unknown users have nothing to serve
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess['user'] = 'bob'
+
+        self.assertEqual(self.client.get(self.sign_route).status_code, 503)
+
+
+    def test_invalidation(self):
+        """Tests that device removal in one process drops devices kept by another"""
+
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+
+        workers = []
+        for i in range(2):
+            app = Flask(__name__)
+            app.config.update(self.app.config)
+            app.config['U2F_READ_COALESCING']         = True
+            app.config['U2F_READ_FRESHNESS']          = 60
+            app.config['U2F_INVALIDATION_SOCKET_DIR'] = directory
+
+            u2f = U2F(app, enroll_route=self.enroll_route, sign_route=self.sign_route,
+                      devices_route=self.devices_route, facets_route=self.facets_route)
+            u2f.read(lambda: list(self.u2f_devices))
+            u2f.save(lambda devices: setattr(self, 'u2f_devices', devices))
+            u2f.identity(lambda: 'alice')
+            u2f.enroll_on_success(lambda: None)
+            u2f.sign_on_success(lambda: None)
+            self.addCleanup(u2f.invalidation.close)
+
+            client = app.test_client()
+            with client.session_transaction() as sess:
+                sess['u2f_device_management_authorized'] = True
+
+            workers.append((u2f, client))
+
+        self.u2f_devices = [{'keyHandle': 'kh1', 'index': 0}, {'keyHandle': 'kh2', 'index': 1}]
+
+        for u2f, client in workers:
+            response_json = json.loads(client.get(self.devices_route).get_data(as_text=True))
+            self.assertEqual(len(response_json['devices']), 2)
+
+        response = workers[0][1].delete(self.devices_route, data=json.dumps({'id': 'kh1'}),
+                                         headers={'content-type': 'application/json'})
+        self.assertEqual(response.status_code, 200)
+
+        deadline = time.time() + 2
+        while not workers[1][0].metrics.get('invalidation.received') and time.time() < deadline:
+            time.sleep(0.01)
+
+        response_json = json.loads(workers[1][1].get(self.devices_route).get_data(as_text=True))
+        self.assertEqual([device['id'] for device in response_json['devices']], ['kh2'])
+        self.assertEqual(workers[0][0].metrics.get('invalidation.sent'), 1)
+
+
+    def test_key_cache(self):
+        """Tests that counters of cached keys are saved without reading devices"""
+
+        self.app.config['U2F_ENGINE']         = 'native'
+        self.app.config['U2F_KEY_CACHE_SIZE'] = 64
+        self.u2f.init_app(self.app)
+
+        reads = []
+        saved = []
+
+        @self.u2f.read
+        def read():
+            reads.append(1)
+            return self.u2f_devices
+
+        @self.u2f.save_counters
+        def save_counters(batch):
+            saved.append(batch)
+
+            for device in self.u2f_devices:
+                if ('alice', device['keyHandle']) in batch:
+                    device['counter'] = batch[('alice', device['keyHandle'])]['counter']
+
+        @self.u2f.identity
+        def identity():
+            return 'alice'
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess['u2f_enroll_authorized']            = True
+                sess['u2f_device_management_authorized'] = True
+
+        response_json = json.loads(self.client.get(self.enroll_route).get_data(as_text=True))
+        keyhandle     = self.u2f_token.register(response_json['registerRequests'][0], facet=self.app.config['U2F_APPID'])
+        self.client.post(self.enroll_route, data=json.dumps(keyhandle), headers={'content-type': 'application/json'})
+
+        key_handle = self.u2f_devices[0]['keyHandle']
+
+        for i in range(2):
+            with self.client as c:
+                with c.session_transaction() as sess:
+                    sess['u2f_sign_required'] = True
+
+            del reads[:]
+
+            response_json = json.loads(self.client.get(self.sign_route).get_data(as_text=True))
+            signature     = self.u2f_token.getAssertion(response_json['authenticateRequests'][0], facet=self.app.config['U2F_APPID'])
+            response      = self.client.post(self.sign_route, data=json.dumps(signature), headers={'content-type': 'application/json'})
+
+            # Cold cache reads devices again, to compare the counter with a fresh one
+            self.assertEqual(response.status_code, 201)
+            self.assertEqual(len(reads), 3 if i == 0 else 2)
+            self.assertEqual(saved[-1][('alice', key_handle)]['counter'], i + 1)
+
+        self.assertEqual(self.u2f.key_cache.get(('alice', key_handle))[1], 2)
+
+        # Removed devices leave the cache
+        self.client.delete(self.devices_route, data=json.dumps({'id': key_handle}), headers={'content-type': 'application/json'})
+        self.assertIsNone(self.u2f.key_cache.get(('alice', key_handle)))
+
+
+    def test_key_cache_shared_key_handle(self):
+        """Tests that a device of another user with the same key handle does not sign for the user"""
+
+        self.app.config['U2F_ENGINE']         = 'native'
+        self.app.config['U2F_KEY_CACHE_SIZE'] = 64
+        self.u2f.init_app(self.app)
+
+        users   = {'alice': [], 'mallory': []}
+        current = ['mallory']
+
+        @self.u2f.read
+        def read():
+            return list(users[current[0]])
+
+        @self.u2f.save
+        def save(u2fdata):
+            users[current[0]] = u2fdata
+
+        @self.u2f.save_counters
+        def save_counters(batch):
+            for (user, key_handle), update in batch.items():
+                for device in users[user]:
+                    if device['keyHandle'] == key_handle:
+                        device['counter'] = update['counter']
+
+        @self.u2f.identity
+        def identity():
+            return current[0]
+
+        def enroll(token):
+            with self.client as c:
+                with c.session_transaction() as sess:
+                    sess['u2f_enroll_authorized'] = True
+
+            response_json = json.loads(self.client.get(self.enroll_route).get_data(as_text=True))
+            keyhandle     = token.register(response_json['registerRequests'][0], facet=self.app.config['U2F_APPID'])
+            self.client.post(self.enroll_route, data=json.dumps(keyhandle), headers={'content-type': 'application/json'})
+
+        def sign(token):
+            with self.client as c:
+                with c.session_transaction() as sess:
+                    sess['u2f_sign_required'] = True
+
+            response_json = json.loads(self.client.get(self.sign_route).get_data(as_text=True))
+            signature     = token.getAssertion(response_json['authenticateRequests'][0], facet=self.app.config['U2F_APPID'])
+            return self.client.post(self.sign_route, data=json.dumps(signature), headers={'content-type': 'application/json'})
+
+        mallory_token = SoftU2FDevice()
+        enroll(mallory_token)
+
+        current[0] = 'alice'
+        enroll(self.u2f_token)
+        key_handle = users['alice'][0]['keyHandle']
+
+        # Key handles are chosen by devices, mallory registers the one of alice with an own key
+        mallory_token.keys = {base64.urlsafe_b64decode(key_handle + '=' * (-len(key_handle) % 4)):
+                                  list(mallory_token.keys.values())[0]}
+        users['mallory'][0]['keyHandle'] = key_handle
+
+        current[0] = 'mallory'
+        self.assertEqual(sign(mallory_token).status_code, 201)
+
+        current[0] = 'alice'
+        self.assertEqual(sign(mallory_token).status_code, 400)
+        self.assertEqual(sign(self.u2f_token).status_code, 201)
+        self.assertEqual(users['alice'][0]['counter'], 1)
+
+
+    def test_counter_anomaly(self):
+        """Tests that counter jumps are passed to sign_on_anomaly"""
+
+        self.app.config['U2F_ANOMALY_DETECTION'] = True
+        self.app.config['U2F_ANOMALY_MAX_JUMP']  = 100
+        self.u2f.init_app(self.app)
+
+        anomalies = []
+
+        @self.u2f.sign_on_anomaly
+        def sign_on_anomaly(anomaly):
+            anomalies.append(anomaly)
+
+        @self.u2f.identity
+        def identity():
+            return 'alice'
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess['u2f_enroll_authorized'] = True
+
+        enroll_response = self.client.get(self.enroll_route)
+        enroll_response_json = json.loads(enroll_response.get_data(as_text=True))
+
+        challenge = enroll_response_json['registerRequests'][0]
+        keyhandle = self.u2f_token.register(challenge, facet=self.app.config['U2F_APPID'])
+
+        self.client.post(self.enroll_route, data=json.dumps(keyhandle), headers={
+            'content-type': 'application/json'
+        })
+
+        for counter in (1, 2, 5000):
+            self.u2f_token.counter = counter - 1
+
+            with self.client as c:
+                with c.session_transaction() as sess:
+                    sess['u2f_sign_required'] = True
+
+            response      = self.client.get(self.sign_route)
+            response_json = json.loads(response.get_data(as_text=True))
+
+            challenge = response_json['authenticateRequests'][0]
+            signature = self.u2f_token.getAssertion(challenge, facet=self.app.config['U2F_APPID'])
+
+            response = self.client.post(self.sign_route, data=json.dumps(signature), headers={
+                'content-type': 'application/json'
+            })
+
+            # Anomalies are flagged, signature is still accepted
+            self.assertEqual(response.status_code, 201)
+
+        self.assertEqual([anomaly.kind for anomaly in anomalies], ['jump'])
+        self.assertEqual(anomalies[0].delta, 4998)
+        self.assertEqual(anomalies[0].user, 'alice')
+        self.assertEqual(self.u2f.metrics.get('sign.anomaly.jump'), 1)
+
+
+    def test_counter_write_behind(self):
+        """Tests that counters are flushed in batches instead of saving devices"""
+
+        self.app.config['U2F_COUNTER_WRITE_BEHIND']   = True
+        self.app.config['U2F_COUNTER_FLUSH_INTERVAL'] = 60
+        self.u2f.init_app(self.app)
+
+        batches = []
+
+        @self.u2f.save_counters
+        def save_counters(batch):
+            batches.append(batch)
+
+        @self.u2f.identity
+        def identity():
+            return 'alice'
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess['u2f_enroll_authorized'] = True
+
+        enroll_response = self.client.get(self.enroll_route)
+        enroll_response_json = json.loads(enroll_response.get_data(as_text=True))
+
+        challenge = enroll_response_json['registerRequests'][0]
+        keyhandle = self.u2f_token.register(challenge, facet=self.app.config['U2F_APPID'])
+
+        self.client.post(self.enroll_route, data=json.dumps(keyhandle), headers={
+            'content-type': 'application/json'
+        })
+
+        saves = []
+
+        @self.u2f.save
+        def save(u2fdata):
+            saves.append(u2fdata)
+
+        for i in range(2):
+            with self.client as c:
+                with c.session_transaction() as sess:
+                    sess['u2f_sign_required'] = True
+
+            response      = self.client.get(self.sign_route)
+            response_json = json.loads(response.get_data(as_text=True))
+
+            challenge = response_json['authenticateRequests'][0]
+            signature = self.u2f_token.getAssertion(challenge, facet=self.app.config['U2F_APPID'])
+
+            response = self.client.post(self.sign_route, data=json.dumps(signature), headers={
+                'content-type': 'application/json'
+            })
+
+            self.assertEqual(response.status_code, 201)
+
+        # ----- Replaying lower counter while storage is stale ----- #
+        self.u2f_token.counter = 1
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess['u2f_sign_required'] = True
+
+        response      = self.client.get(self.sign_route)
+        response_json = json.loads(response.get_data(as_text=True))
+
+        challenge = response_json['authenticateRequests'][0]
+        signature = self.u2f_token.getAssertion(challenge, facet=self.app.config['U2F_APPID'])
+
+        response = self.client.post(self.sign_route, data=json.dumps(signature), headers={
+            'content-type': 'application/json'
+        })
+
+        self.assertEqual(response.status_code, 400)
+
+        self.assertEqual(saves, [])
+        self.assertEqual(self.u2f.flush_counters(), 1)
+        self.assertEqual(len(batches), 1)
+
+        update = batches[0][('alice', self.u2f_devices[0]['keyHandle'])]
+        self.assertEqual((update['counter'], update['uses']), (2, 2))
+        self.assertIsInstance(update['last_used'], int)
+
+
+    def test_stateless_challenges(self):
+        """Tests challenges carried by signed tokens instead of session"""
+
+        self.app.config['U2F_STATELESS_CHALLENGES'] = True
+        self.u2f.init_app(self.app)
+
+        self.user = 'alice'
+
+        @self.u2f.identity
+        def identity():
+            return self.user
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess['u2f_enroll_authorized'] = True
+                sess['u2f_sign_required']     = True
+
+        # ----- Enroll ----- #
+        enroll_response = self.client.get(self.enroll_route)
+        enroll_response_json = json.loads(enroll_response.get_data(as_text=True))
+
+        challenge = enroll_response_json['registerRequests'][0]
+        keyhandle = self.u2f_token.register(challenge, facet=self.app.config['U2F_APPID'])
+        keyhandle['challengeToken'] = enroll_response_json['challengeToken']
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                self.assertNotIn('_u2f_enroll_', sess)
+
+        response = self.client.post(self.enroll_route, data=json.dumps(keyhandle), headers={
+            'content-type': 'application/json'
+        })
+
+        self.assertEqual(response.status_code, 201)
+
+        # ----- Sign ----- #
+        response      = self.client.get(self.sign_route)
+        response_json = json.loads(response.get_data(as_text=True))
+
+        challenge = response_json['authenticateRequests'][0]
+        token     = response_json['challengeToken']
+
+        def post_signature(token):
+            signature = self.u2f_token.getAssertion(challenge, facet=self.app.config['U2F_APPID'])
+            signature['challengeToken'] = token
+
+            return self.client.post(self.sign_route, data=json.dumps(signature), headers={
+                'content-type': 'application/json'
+            })
+
+        # Token of another user
+        self.user = 'mallory'
+        response  = post_signature(token)
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(json.loads(response.get_data(as_text=True))['code'], 'bad_challenge')
+
+        # Tampered token
+        self.user = 'alice'
+        response  = post_signature(token[:-2] + 'AA')
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(json.loads(response.get_data(as_text=True))['code'], 'bad_challenge')
+
+        # Missing token
+        response  = post_signature(None)
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(json.loads(response.get_data(as_text=True))['code'], 'missing_challenge')
+
+        response = post_signature(token)
+        self.assertEqual(response.status_code, 201)
+
+        # ----- Replayed token ----- #
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess['u2f_sign_required'] = True
+
+        response = post_signature(token)
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(json.loads(response.get_data(as_text=True))['code'], 'bad_challenge')
+
 
     def test_facets(self):
         """Test U2F Facets"""
@@ -312,6 +1398,12 @@ class APITest(unittest.TestCase):
                 }]
         })
 
+        # ----- Facets updated without restart ----- #
+        self.u2f.core.facets.add('android:apk-key-hash:FD18FA800DD00C0D9D7724328B6')
+
+        response_json = json.loads(self.client.get(self.facets_route).get_data(as_text=True))
+        self.assertEqual(response_json['trustedFacets'][0]['ids'][-1], 'android:apk-key-hash:FD18FA800DD00C0D9D7724328B6')
+
 
     def test_device_management(self):
 
@@ -378,6 +1470,10 @@ class APITest(unittest.TestCase):
 
         self.assertTrue(all(type(device[key]) == device_model[key] for key in device_model.keys()))
 
+        # Never used for signing yet
+        self.assertIsNone(device['last_used'])
+        self.assertEqual(device['use_count'], 0)
+
         # ----- Delete Fail----- #
         
         device_to_delete_fail = {
@@ -413,6 +1509,80 @@ class APITest(unittest.TestCase):
         self.assertEqual([], self.u2f_devices)
 
 
+    def test_bulk_device_removal(self):
+        """Tests removing several devices with a single request"""
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess['u2f_enroll_authorized']            = True
+                sess['u2f_device_management_authorized'] = True
+
+        for i in range(3):
+            enroll_response = self.client.get(self.enroll_route)
+            enroll_response_json = json.loads(enroll_response.get_data(as_text=True))
+
+            challenge = enroll_response_json['registerRequests'][0]
+            keyhandle = self.u2f_token.register(challenge, facet=self.app.config['U2F_APPID'])
+
+            self.client.post(self.enroll_route, data=json.dumps(keyhandle), headers={
+                'content-type': 'application/json'
+            })
+
+        ids = [device['keyHandle'] for device in self.u2f_devices]
+        self.assertEqual(len(ids), 3)
+
+        # ----- Deleting list of ids ----- #
+        saves = []
+
+        @self.u2f.save
+        def save(u2fdata):
+            saves.append(u2fdata)
+            self.u2f_devices = u2fdata
+
+        response = self.client.delete(self.devices_route, data=json.dumps({
+            'ids' : [ids[0], 'NoExactlyValidID']
+        }), headers={ 'content-type': 'application/json' })
+
+        self.assertEqual(response.status_code, 200)
+        response_json = json.loads(response.get_data(as_text=True))
+
+        self.assertEqual(response_json['status'], 'ok')
+        self.assertListEqual(response_json['results'], [
+            { 'id': ids[0], 'status': 'ok' },
+            { 'id': 'NoExactlyValidID', 'status': 'failed', 'error': 'No device with such an id been found!' }
+        ])
+        self.assertEqual(len(saves), 1)
+        self.assertEqual([device['keyHandle'] for device in self.u2f_devices], ids[1:])
+
+        # ----- Nothing to delete ----- #
+        response = self.client.delete(self.devices_route, data=json.dumps({
+            'ids' : ['NoExactlyValidID']
+        }), headers={ 'content-type': 'application/json' })
+
+        self.assertEqual(response.status_code, 404)
+        self.assertEqual(len(saves), 1)
+
+        # ----- Deleting all except one ----- #
+        response = self.client.delete(self.devices_route, data=json.dumps({
+            'all_except' : ids[2]
+        }), headers={ 'content-type': 'application/json' })
+
+        self.assertEqual(response.status_code, 200)
+        response_json = json.loads(response.get_data(as_text=True))
+
+        self.assertListEqual(response_json['results'], [{ 'id': ids[1], 'status': 'ok' }])
+        self.assertEqual(len(saves), 2)
+        self.assertEqual([device['keyHandle'] for device in self.u2f_devices], ids[2:])
+
+        # ----- Keeping unknown device is refused ----- #
+        response = self.client.delete(self.devices_route, data=json.dumps({
+            'all_except' : 'NoExactlyValidID'
+        }), headers={ 'content-type': 'application/json' })
+
+        self.assertEqual(response.status_code, 404)
+        self.assertEqual(len(self.u2f_devices), 1)
+
+
     def test_has_registered_devices(self):
         self.assertFalse(self.u2f.has_registered_devices())
 
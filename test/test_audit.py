@@ -0,0 +1,145 @@
+import io
+import os
+import json
+import sqlite3
+import unittest
+import tempfile
+import contextlib
+
+from flask_fido_u2f import audit
+from flask_fido_u2f.stores import DeviceStore, SQLiteDeviceStore
+
+from .test_stores import make_device
+
+class ListDeviceStore(DeviceStore):
+    """Custom store, audited through --adapter"""
+
+    def __init__(self, devices):
+        self.devices = devices
+
+    def read(self, user):
+        return self.devices.get(user, [])
+
+    def save(self, user, devices):
+        self.devices[user] = devices
+
+    def save_counters(self, batch):
+        return set()
+
+    def shards(self, count):
+        return [(user,) for user in sorted(self.devices)]
+
+    def iter_devices(self, shard=None, batch_size=1000):
+        for user in shard or sorted(self.devices):
+            for device in self.devices[user]:
+                yield user, device
+
+def open_list_store(url=None):
+    return ListDeviceStore({
+        'alice' : [make_device('kh1', 0), make_device('kh2', 1, appId=url)],
+        'bob'   : [make_device('kh1', 0)]
+    })
+
+class AuditTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.path      = os.path.join(self.directory.name, 'u2f.sqlite')
+
+        store = SQLiteDeviceStore(self.path)
+
+        for i in range(50):
+            store.save('user{0:02d}'.format(i), [make_device('user{0:02d}-kh{1}'.format(i, k), k) for k in range(2)])
+
+        store.save('mallory', [make_device('user07-kh0', 0)])
+        store.save('restored', [make_device('restored-kh0', 0, counter=3, use_count=10, last_used=100)])
+        store.save('moved', [dict(make_device('moved-kh0', 0), appId='https://old.example.com')])
+
+        # ----- Rows inserted without idx, and gaps left by removals ----- #
+        store.save('inserted', [make_device('inserted-kh0', 0), make_device('inserted-kh1', 0)])
+        store.save('removed', [make_device('removed-kh0', 0), make_device('removed-kh2', 2)])
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def test_audit(self):
+        report = audit.audit(('sqlite:///' + self.path,), workers=2, shards=5, app_ids=['https://example.com'])
+
+        self.assertEqual(report['records'], 107)
+        self.assertEqual(report['users'], 55)
+        self.assertEqual(len(report['shards']), 5)
+        self.assertEqual(report['issues'], {
+            'duplicate_key_handle' : 1,
+            'counter_regression'   : 1,
+            'appid_mismatch'       : 1,
+            'bad_index'            : 1
+        })
+
+        self.assertEqual(report['examples']['duplicate_key_handle'],
+                         [{'keyHandle': 'user07-kh0', 'users': ['mallory', 'user07']}])
+        self.assertEqual(report['examples']['counter_regression'][0]['user'], 'restored')
+        self.assertEqual(report['examples']['appid_mismatch'][0]['user'], 'moved')
+        self.assertEqual(report['examples']['bad_index'][0]['keyHandle'], 'inserted-kh1')
+
+    def test_checks(self):
+        self.assertEqual(audit.check_device(make_device('kh1'), {'https://example.com'}), [])
+        self.assertEqual(audit.check_device({'keyHandle': 'kh1', 'counter': -1}, set()),
+                         ['counter_regression', 'bad_index'])
+
+        indexes = set()
+        self.assertEqual(audit.check_device(make_device('kh1', 0), set(), indexes), [])
+        self.assertEqual(audit.check_device(make_device('kh2', 2), set(), indexes), [])
+        self.assertEqual(audit.check_device(make_device('kh3', 2), set(), indexes), ['bad_index'])
+
+    def test_main(self):
+        output = io.StringIO()
+
+        with contextlib.redirect_stdout(output):
+            status = audit.main(['--store', 'sqlite:///' + self.path, '--workers', '1', '--json'])
+
+        self.assertEqual(status, 1)
+        self.assertEqual(json.loads(output.getvalue())['issues']['duplicate_key_handle'], 1)
+
+    def test_adapter(self):
+        report = audit.audit((None, 'u2f:', 'u2f_devices', 'test.test_audit:open_list_store'), workers=2)
+        self.assertEqual(report['records'], 3)
+        self.assertEqual(report['users'], 2)
+        self.assertEqual(report['examples']['duplicate_key_handle'], [{'keyHandle': 'kh1', 'users': ['alice', 'bob']}])
+
+        # ----- Store URL is passed to the factory ----- #
+        output = io.StringIO()
+
+        with contextlib.redirect_stdout(output):
+            status = audit.main(['--adapter', 'test.test_audit:open_list_store', '--store', 'https://old.example.com',
+                                 '--app-id', 'https://example.com', '--workers', '1', '--json'])
+
+        self.assertEqual(status, 1)
+        self.assertEqual(json.loads(output.getvalue())['issues']['appid_mismatch'], 1)
+
+    def test_read_only(self):
+        path = os.path.join(self.directory.name, 'old.sqlite')
+
+        # ----- Table of an older release, without usage statistics ----- #
+        with sqlite3.connect(path) as connection:
+            connection.execute('''CREATE TABLE u2f_devices (
+                user_id TEXT NOT NULL, key_handle TEXT NOT NULL, app_id TEXT NOT NULL,
+                public_key TEXT NOT NULL, counter INTEGER NOT NULL DEFAULT 0,
+                idx INTEGER NOT NULL DEFAULT 0, extra TEXT,
+                PRIMARY KEY (user_id, key_handle)) WITHOUT ROWID''')
+            connection.execute("INSERT INTO u2f_devices VALUES ('alice', 'kh1', 'https://example.com', 'BPublicKeykh1', 5, 0, NULL)")
+        connection.close()
+
+        with open(path, 'rb') as database:
+            before = database.read()
+
+        report = audit.audit(('sqlite:///' + path,), workers=1, shards=1, app_ids=['https://example.com'])
+        self.assertEqual(report['records'], 1)
+        self.assertEqual(sum(report['issues'].values()), 0)
+
+        # ----- Audited database is left as it was ----- #
+        with open(path, 'rb') as database:
+            self.assertEqual(database.read(), before)
+
+        self.assertFalse(os.path.exists(path + '-wal'))
+
+if __name__ == '__main__':
+    unittest.main()
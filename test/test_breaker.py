@@ -0,0 +1,140 @@
+import time
+import unittest
+import threading
+
+from flask_fido_u2f import StorageUnavailable
+from flask_fido_u2f.breaker import CircuitBreaker, StaleReads
+from flask_fido_u2f.metrics import Metrics
+
+class CircuitBreakerTest(unittest.TestCase):
+    def setUp(self):
+        self.metrics = Metrics()
+        self.breaker = CircuitBreaker(failures=2, reset_timeout=0.05, metrics=self.metrics)
+
+    def fail(self):
+        raise IOError('connection refused')
+
+    def test_opens_after_failures(self):
+        """Tests that consecutive failures open the circuit, and open circuit fails fast"""
+
+        calls = []
+
+        self.assertEqual(self.breaker.call(lambda: 'ok'), 'ok')
+
+        for i in range(2):
+            with self.assertRaises(StorageUnavailable) as context:
+                self.breaker.call(self.fail)
+
+            self.assertIsInstance(context.exception.cause, IOError)
+
+        self.assertEqual(self.breaker.state, CircuitBreaker.OPEN)
+        self.assertEqual(self.metrics.get('breaker.open'), 1)
+
+        with self.assertRaises(StorageUnavailable):
+            self.breaker.call(calls.append, 1)
+
+        self.assertEqual(calls, [])
+        self.assertEqual(self.metrics.get('breaker.rejected'), 1)
+        self.assertEqual(self.metrics.get('storage.error'), 2)
+
+    def test_success_resets_count(self):
+        """Tests that only consecutive failures open the circuit"""
+
+        for i in range(3):
+            with self.assertRaises(StorageUnavailable):
+                self.breaker.call(self.fail)
+
+            self.breaker.reset()
+            self.breaker.call(lambda: None)
+
+        self.assertEqual(self.breaker.state, CircuitBreaker.CLOSED)
+        self.assertEqual(self.metrics.get('breaker.opened'), 0)
+
+    def test_half_open(self):
+        """Tests that a single trial call closes the circuit, or opens it again"""
+
+        for i in range(2):
+            with self.assertRaises(StorageUnavailable):
+                self.breaker.call(self.fail)
+
+        time.sleep(0.06)
+
+        # Failed trial keeps it open for another reset_timeout
+        with self.assertRaises(StorageUnavailable):
+            self.breaker.call(self.fail)
+
+        self.assertEqual(self.breaker.state, CircuitBreaker.OPEN)
+
+        with self.assertRaises(StorageUnavailable):
+            self.breaker.call(lambda: 'ok')
+
+        time.sleep(0.06)
+
+        self.assertEqual(self.breaker.call(lambda: 'ok'), 'ok')
+        self.assertEqual(self.breaker.state, CircuitBreaker.CLOSED)
+        self.assertEqual(self.metrics.get('breaker.open'), 0)
+        self.assertEqual(self.metrics.get('breaker.opened'), 1)
+
+    def test_timeout(self):
+        """Tests that callers stop waiting for hung calls"""
+
+        release = threading.Event()
+        self.addCleanup(release.set)
+
+        start = time.time()
+        with self.assertRaises(StorageUnavailable):
+            self.breaker.call(release.wait, 5, timeout=0.05)
+
+        self.assertLess(time.time() - start, 1)
+        self.assertEqual(self.metrics.get('storage.timeout'), 1)
+        self.assertEqual(self.breaker.call(lambda value: value * 2, 21, timeout=1), 42)
+
+    def test_timeout_cancels_queued_calls(self):
+        """Tests that calls still queued when their caller times out never run"""
+
+        breaker = CircuitBreaker(failures=0, max_workers=1)
+        release = threading.Event()
+        self.addCleanup(release.set)
+
+        saved = []
+
+        # The only pool thread is busy, so the save stays queued
+        with self.assertRaises(StorageUnavailable):
+            breaker.call(release.wait, 5, timeout=0.05)
+
+        with self.assertRaises(StorageUnavailable):
+            breaker.call(saved.append, 'old devices', timeout=0.05)
+
+        release.set()
+        self.assertEqual(breaker.call(lambda: 'done', timeout=1), 'done')
+        self.assertEqual(saved, [])
+
+class StaleReadsTest(unittest.TestCase):
+    def test_stale_reads(self):
+        """Tests that stale reads are copies, expire, are forgotten and bounded"""
+
+        stale   = StaleReads(max_age=0.05, max_entries=2)
+        devices = [{'keyHandle': 'kh1', 'counter': 1}]
+
+        stale.put('alice', devices)
+        devices[0]['counter'] = 2
+
+        self.assertEqual(stale.get('alice'), [{'keyHandle': 'kh1', 'counter': 1}])
+
+        stale.get('alice')[0]['counter'] = 3
+        self.assertEqual(stale.get('alice')[0]['counter'], 1)
+
+        stale.forget('alice')
+        self.assertIsNone(stale.get('alice'))
+
+        for user in ('alice', 'bob', 'carol'):
+            stale.put(user, devices)
+
+        self.assertEqual(len(stale), 2)
+        self.assertIsNone(stale.get('alice'))
+
+        time.sleep(0.06)
+        self.assertIsNone(stale.get('bob'))
+
+if __name__ == '__main__':
+    unittest.main()
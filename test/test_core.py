@@ -0,0 +1,75 @@
+import unittest, json, time
+
+from flask_fido_u2f import U2FCore, U2FFailure, FailureReason
+
+from .soft_u2f_v2 import SoftU2FDevice
+
+class U2FCoreTest(unittest.TestCase):
+    """Drives the engine without Flask application or request context"""
+
+    def setUp(self):
+        self.core  = U2FCore('https://example.com')
+        self.token = SoftU2FDevice()
+
+    def enroll(self, devices):
+        request  = self.core.start_enroll(devices)
+        response = self.token.register(request['registerRequests'][0], facet='https://example.com')
+
+        device = self.core.complete_enroll(request.json, response, devices)
+        devices.append(device)
+
+        return device
+
+    def test_enroll_and_sign(self):
+        devices = []
+
+        first  = self.enroll(devices)
+        second = self.enroll(devices)
+
+        self.assertEqual((first['counter'], first['index']), (0, 0))
+        self.assertEqual(second['index'], 1)
+
+        request   = self.core.start_sign(devices)
+        signature = self.token.getAssertion(request['authenticateRequests'][1], facet='https://example.com')
+
+        device, counter, touch = self.core.complete_sign(request.json, signature, devices)
+
+        self.assertEqual(device['keyHandle'], second['keyHandle'])
+        self.assertEqual(counter, self.token.counter)
+
+        # ----- Challenge can only be used once ----- #
+        with self.assertRaises(U2FFailure) as cm:
+            self.core.complete_sign(request.json, signature, devices)
+
+        self.assertEqual(cm.exception.reason, FailureReason.BAD_CHALLENGE)
+
+    def test_failures(self):
+        devices = []
+        self.enroll(devices)
+
+        request   = self.core.start_sign(devices)
+        signature = self.token.getAssertion(request['authenticateRequests'][0], facet='https://example.com')
+
+        cases = [
+            (dict(signature, keyHandle='unknown'), None,             FailureReason.UNKNOWN_KEY_HANDLE),
+            ({'keyHandle': 'kh'},                  None,             FailureReason.MALFORMED_PAYLOAD),
+            (signature,                            time.time() - 1,  FailureReason.BAD_CHALLENGE)
+        ]
+
+        for response, expires, reason in cases:
+            with self.assertRaises(U2FFailure) as cm:
+                self.core.complete_sign(request.json, response, devices, expires)
+
+            self.assertEqual(cm.exception.reason, reason)
+
+    def test_build_challenge(self):
+        devices = []
+        self.enroll(devices)
+
+        request = self.core.start_sign(devices)
+        rebuilt = self.core.build_challenge('sign', request['authenticateRequests'][0]['challenge'], devices)
+
+        self.assertEqual(json.loads(rebuilt)['authenticateRequests'], json.loads(request.json)['authenticateRequests'])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,71 @@
+import unittest
+
+from flask_fido_u2f.counters import CounterWriteBehind
+from flask_fido_u2f.metrics import Metrics
+
+class CounterWriteBehindTest(unittest.TestCase):
+    def setUp(self):
+        self.batches = []
+        self.metrics = Metrics()
+        self.writer  = CounterWriteBehind(self.batches.append, interval=60, max_batch=100, metrics=self.metrics)
+
+    def tearDown(self):
+        self.writer.stop()
+
+    def test_coalescing(self):
+        self.assertTrue(self.writer.advance('kh1', 0, 1))
+        self.assertTrue(self.writer.advance('kh1', 0, 2))
+        self.assertTrue(self.writer.advance('kh2', 5, 6))
+
+        self.assertEqual(self.writer.pending(), 2)
+        self.assertEqual(self.writer.flush(), 2)
+
+        self.assertEqual(self.batches, [{
+            'kh1': {'counter': 2, 'uses': 2},
+            'kh2': {'counter': 6, 'uses': 1}
+        }])
+        self.assertEqual(self.metrics.get('counters.flushed'), 2)
+        self.assertEqual(self.writer.flush(), 0)
+
+    def test_clone_detection_with_stale_storage(self):
+        self.assertTrue(self.writer.advance('kh1', 0, 5))
+        self.writer.flush()
+
+        # Storage has not caught up yet, cache stays authoritative
+        self.assertFalse(self.writer.advance('kh1', 0, 5))
+        self.assertFalse(self.writer.advance('kh1', 0, 3))
+        self.assertTrue(self.writer.advance('kh1', 0, 6))
+
+    def test_flush_failure_is_retried(self):
+        batches = []
+
+        def failing_flush(batch):
+            if not batches:
+                batches.append(None)
+                raise IOError('Storage is down')
+
+            batches.append(batch)
+
+        writer = CounterWriteBehind(failing_flush, interval=60, metrics=self.metrics)
+        writer.advance('kh1', 0, 1)
+
+        with self.assertRaises(IOError):
+            writer.flush()
+
+        self.assertEqual(writer.pending(), 1)
+        self.assertEqual(self.metrics.get('counters.flush_errors'), 1)
+
+        # ----- Uses of the failed batch are kept ----- #
+        writer.advance('kh1', 0, 2, last_used=10)
+        writer.flush()
+
+        self.assertEqual(batches[1:], [{'kh1': {'counter': 2, 'last_used': 10, 'uses': 2}}])
+
+    def test_stop_drains(self):
+        self.writer.advance('kh1', 0, 1)
+        self.writer.stop()
+
+        self.assertEqual(self.batches, [{'kh1': {'counter': 1, 'uses': 1}}])
+
+if __name__ == '__main__':
+    unittest.main()
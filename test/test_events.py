@@ -0,0 +1,147 @@
+import os
+import json
+import time
+import shutil
+import tempfile
+import unittest
+import threading
+
+from flask_fido_u2f import U2FEvent, EventBus, FileAuditSink
+from flask_fido_u2f.metrics import Metrics
+
+class EventBusTest(unittest.TestCase):
+    def setUp(self):
+        self.metrics = Metrics()
+        self.release = threading.Event()
+        self.events  = []
+
+    def blocking(self, event):
+        self.release.wait(5)
+        self.events.append(event)
+
+    def test_synchronous(self):
+        """Tests that without workers events are delivered by publish()"""
+
+        bus = EventBus(workers=0, metrics=self.metrics)
+        bus.subscribe(self.events.append, ['sign.success'])
+
+        bus.publish(U2FEvent('sign.success', user='alice'))
+        bus.publish(U2FEvent('sign.fail', user='alice'))
+
+        self.assertEqual([event.kind for event in self.events], ['sign.success'])
+        self.assertIsNotNone(self.events[0].time)
+
+    def test_background_batches(self):
+        """Tests that workers deliver events off the publishing thread, in batches"""
+
+        batches = []
+        threads = set()
+
+        def sink(events):
+            threads.add(threading.current_thread().name)
+            batches.append(len(events))
+
+        bus = EventBus(workers=1, max_batch=10, metrics=self.metrics)
+        bus.subscribe(self.blocking)
+        bus.subscribe(sink, batch=True)
+
+        # First event holds the worker, the rest queue up
+        for i in range(25):
+            bus.publish(U2FEvent('sign.success', counter=i))
+
+        self.assertLess(len(self.events), 25)
+
+        self.release.set()
+        bus.stop()
+
+        self.assertEqual([event.counter for event in self.events], list(range(25)))
+        self.assertEqual(sum(batches), 25)
+        self.assertLessEqual(max(batches), 10)
+        self.assertNotIn(threading.current_thread().name, threads)
+        self.assertEqual(self.metrics.get('events.delivered'), 25)
+
+    def test_overflow(self):
+        """Tests overflow policies of a full queue"""
+
+        for overflow, delivered, dropped in (('sync', list(range(6)), 0), ('drop_newest', [0, 1, 2, 3], 2),
+                                             ('drop_oldest', [0, 3, 4, 5], 2)):
+            self.metrics = Metrics()
+            self.release = threading.Event()
+            self.events  = []
+
+            bus = EventBus(workers=1, max_queue=3, overflow=overflow, metrics=self.metrics)
+            bus.subscribe(self.blocking)
+
+            bus.publish(U2FEvent('sign.success', counter=0))
+            time.sleep(0.05)
+
+            for i in range(1, 6):
+                # Synchronous delivery does not wait for the held worker
+                if i == 4 and overflow == 'sync':
+                    self.release.set()
+
+                bus.publish(U2FEvent('sign.success', counter=i))
+
+            self.release.set()
+            bus.stop()
+
+            self.assertEqual(sorted(event.counter for event in self.events), delivered, overflow)
+            self.assertEqual(self.metrics.get('events.dropped'), dropped, overflow)
+
+        with self.assertRaises(ValueError):
+            EventBus(overflow='ignore')
+
+    def test_subscriber_errors(self):
+        """Tests that a failing subscriber does not affect others"""
+
+        def failing(event):
+            raise RuntimeError('sink is down')
+
+        bus = EventBus(workers=0, metrics=self.metrics)
+        bus.subscribe(failing)
+        bus.subscribe(self.events.append)
+
+        bus.publish(U2FEvent('enroll.success'))
+
+        self.assertEqual(len(self.events), 1)
+        self.assertEqual(self.metrics.get('events.errors'), 1)
+
+    def test_stop(self):
+        """Tests that stop() delivers queued events, and later ones synchronously"""
+
+        bus = EventBus(workers=2)
+        bus.subscribe(self.events.append)
+
+        for i in range(100):
+            bus.publish(U2FEvent('sign.success', counter=i))
+
+        bus.stop()
+        self.assertEqual(len(self.events), 100)
+
+        bus.publish(U2FEvent('sign.success'))
+        self.assertEqual(len(self.events), 101)
+
+    def test_file_audit_sink(self):
+        """Tests that FileAuditSink appends events as JSON lines"""
+
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        path      = os.path.join(directory, 'audit.jsonl')
+
+        bus = EventBus(workers=1)
+        bus.subscribe(FileAuditSink(path), batch=True)
+
+        for i in range(3):
+            bus.publish(U2FEvent('sign.success', user='alice', key_handle='kh', counter=i, time=1.0))
+
+        bus.stop()
+
+        with open(path) as source:
+            records = [json.loads(line) for line in source]
+
+        self.assertEqual([record['counter'] for record in records], [0, 1, 2])
+        self.assertEqual(records[0], {'kind': 'sign.success', 'user': 'alice', 'time': 1.0,
+                                      'remote_addr': None, 'key_handle': 'kh', 'counter': 0})
+
+if __name__ == '__main__':
+    unittest.main()
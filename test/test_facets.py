@@ -0,0 +1,71 @@
+import unittest
+import threading
+
+from flask_fido_u2f import FacetIndex
+
+class FacetIndexTest(unittest.TestCase):
+    def setUp(self):
+        self.index = FacetIndex([
+            'https://example.com',
+            'https://Secure.Example.com:8443/',
+            'android:apk-key-hash:FD18FA800DD00C0D9D7724328B6',
+            'ios:bundle-id:com.example.SecurityKey'
+        ])
+
+    def test_origins(self):
+        self.assertIn('https://example.com', self.index)
+        self.assertIn('https://EXAMPLE.com:443', self.index)
+        self.assertIn('https://secure.example.com:8443', self.index)
+
+        self.assertNotIn('http://example.com', self.index)
+        self.assertNotIn('https://example.com:8443', self.index)
+        self.assertNotIn('https://secure.example.com', self.index)
+        self.assertNotIn('https://example.com.evil.com', self.index)
+        self.assertNotIn('https://user@example.com', self.index)
+        self.assertNotIn('https://example.com/path', self.index)
+        self.assertNotIn('https://example.com:bad', self.index)
+        self.assertNotIn(None, self.index)
+        self.assertNotIn('', self.index)
+
+    def test_platform_ids(self):
+        self.assertIn('android:apk-key-hash:FD18FA800DD00C0D9D7724328B6', self.index)
+        self.assertIn('ios:bundle-id:com.example.SecurityKey', self.index)
+
+        # Hashes and bundle ids are case sensitive
+        self.assertNotIn('android:apk-key-hash:fd18fa800dd00c0d9d7724328b6', self.index)
+        self.assertNotIn('ios:bundle-id:com.example', self.index)
+
+    def test_updates(self):
+        self.index.add('https://new.example.com')
+        self.assertIn('https://new.example.com', self.index)
+
+        self.index.remove('https://example.com')
+        self.assertNotIn('https://example.com', self.index)
+
+        with self.assertRaises(KeyError):
+            self.index.remove('https://example.com')
+
+        self.index.replace(['ios:bundle-id:com.example.Other'])
+        self.assertEqual(list(self.index), ['ios:bundle-id:com.example.Other'])
+        self.assertNotIn('https://new.example.com', self.index)
+
+    def test_order(self):
+        self.index.add('https://example.com')
+        self.assertEqual(len(self.index), 4)
+        self.assertEqual(list(self.index)[0], 'https://example.com')
+
+    def test_concurrent_updates(self):
+        facets  = ['https://tenant{0}.example.com'.format(i) for i in range(200)]
+        threads = [threading.Thread(target=self.index.add, args=(facet,)) for facet in facets]
+
+        for thread in threads:
+            thread.start()
+
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(len(self.index), 204)
+        self.assertTrue(all(facet in self.index for facet in facets))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,65 @@
+import os
+import unittest
+import threading
+import multiprocessing
+
+from flask_fido_u2f.forksafe import PerProcess, start_daemon
+
+def ensure_in_child(started, queue):
+    queue.put((started.ensure(), started.started()))
+
+class PerProcessTest(unittest.TestCase):
+    def test_once_per_process(self):
+        calls   = []
+        started = PerProcess(lambda: calls.append(os.getpid()))
+
+        self.assertFalse(started.started())
+
+        threads = [threading.Thread(target=started.ensure) for i in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(calls, [os.getpid()])
+        self.assertTrue(started.started())
+        self.assertFalse(started.ensure())
+
+    def test_failed_start_is_retried(self):
+        calls = []
+
+        def start():
+            calls.append(1)
+            if len(calls) == 1:
+                raise OSError('Socket in use')
+
+        started = PerProcess(start)
+
+        self.assertRaises(OSError, started.ensure)
+        self.assertFalse(started.started())
+        self.assertTrue(started.ensure())
+
+    @unittest.skipIf(not hasattr(os, 'fork'), 'fork is not available')
+    def test_forked_workers_start_their_own(self):
+        started = PerProcess(lambda: None)
+        started.ensure()
+
+        context = multiprocessing.get_context('fork')
+        queue   = context.Queue()
+        worker  = context.Process(target=ensure_in_child, args=(started, queue))
+        worker.start()
+        worker.join()
+
+        self.assertEqual(queue.get(timeout=5), (True, True))
+
+    def test_start_daemon(self):
+        done   = threading.Event()
+        thread = start_daemon(done.set, 'u2f-test')
+
+        thread.join()
+        self.assertTrue(done.is_set())
+        self.assertTrue(thread.daemon)
+        self.assertEqual(thread.name, 'u2f-test')
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,43 @@
+import os, sys, json
+import unittest
+import subprocess
+
+# Seconds importing flask_fido_u2f may take on top of Flask itself
+IMPORT_BUDGET = 0.1
+
+MEASURE = """
+import sys, json, time
+import flask
+
+start = time.perf_counter()
+import flask_fido_u2f
+elapsed = time.perf_counter() - start
+
+print(json.dumps({
+    'elapsed' : elapsed,
+    'modules' : [name for name in ('u2flib_server', 'cryptography') if name in sys.modules]
+}))
+"""
+
+class ImportTest(unittest.TestCase):
+    def measure(self):
+        root   = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+        output = subprocess.check_output([sys.executable, '-c', MEASURE], cwd=root)
+
+        return json.loads(output.decode('utf-8'))
+
+    def test_import_is_lazy(self):
+        """Tests that importing the extension does not load u2flib and cryptography"""
+
+        self.assertEqual(self.measure()['modules'], [])
+
+    def test_import_budget(self):
+        """Tests that importing the extension fits IMPORT_BUDGET"""
+
+        # Best of three, to smooth out cold disk cache
+        elapsed = min(self.measure()['elapsed'] for i in range(3))
+
+        self.assertLess(elapsed, IMPORT_BUDGET)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -90,5 +90,30 @@ class InjectionAndConfigTest(unittest.TestCase):
         # All injected, should be fine now
         self.assertTrue(self.u2f.verify_integrity())
 
+    def test_key_cache_requires_save_counters(self):
+        self.app.config['U2F_APPID']          = 'https://example.com'
+        self.app.config['U2F_KEY_CACHE_SIZE'] = 64
+        self.u2f.init_app(self.app)
+
+        self.u2f.read(lambda: [])
+        self.u2f.save(lambda devices: None)
+        self.u2f.enroll_on_success(lambda: None)
+        self.u2f.sign_on_success(lambda: None)
+
+        with self.assertRaises(Exception) as cm:
+            self.u2f.verify_integrity()
+
+        self.assertIn('@u2f.save_counters', str(cm.exception))
+
+        self.u2f.save_counters(lambda batch: set())
+
+        with self.assertRaises(Exception) as cm:
+            self.u2f.verify_integrity()
+
+        self.assertIn('@u2f.identity', str(cm.exception))
+
+        self.u2f.identity(lambda: 'alice')
+        self.assertTrue(self.u2f.verify_integrity())
+
 if __name__ == '__main__':
     unittest.main()
\ No newline at end of file
@@ -0,0 +1,121 @@
+import os
+import time
+import shutil
+import socket
+import tempfile
+import unittest
+
+from flask_fido_u2f import InvalidationChannel, UnixSocketInvalidationChannel, RedisInvalidationChannel
+from flask_fido_u2f.metrics import Metrics
+
+try:
+    import fakeredis
+except ImportError:
+    fakeredis = None
+
+def wait_for(condition, timeout=2.0):
+    deadline = time.time() + timeout
+    while not condition() and time.time() < deadline:
+        time.sleep(0.01)
+
+class ChannelTestMixin(object):
+    def test_broadcast(self):
+        """Tests that invalidations reach other channels, and not the sender"""
+
+        received = {}
+        channels = [self.channel() for i in range(3)]
+
+        for index, channel in enumerate(channels):
+            self.addCleanup(channel.close)
+            channel.subscribe(lambda user, key_handles, index=index: received.setdefault(index, []).append(
+                (user, key_handles)))
+            channel.ensure_started()
+
+        channels[0].publish('alice', ['kh1', 'kh2'])
+
+        wait_for(lambda: len(received) == 2)
+
+        self.assertEqual(received, {1: [('alice', ['kh1', 'kh2'])], 2: [('alice', ['kh1', 'kh2'])]})
+        self.assertEqual(channels[0].metrics.get('invalidation.sent'), 1)
+        self.assertEqual(channels[1].metrics.get('invalidation.received'), 1)
+
+    def test_subscriber_errors(self):
+        """Tests that failing subscribers do not stop the channel"""
+
+        received = []
+        sender   = self.channel()
+        listener = self.channel()
+
+        for channel in (sender, listener):
+            self.addCleanup(channel.close)
+
+        def failing(user, key_handles):
+            raise RuntimeError('cache is gone')
+
+        listener.subscribe(failing)
+        listener.subscribe(lambda user, key_handles: received.append(user))
+        listener.ensure_started()
+
+        sender.publish('alice')
+        sender.publish(42)
+
+        wait_for(lambda: len(received) == 2)
+
+        self.assertEqual(received, ['alice', 42])
+        self.assertEqual(listener.metrics.get('invalidation.errors'), 2)
+
+    def test_unserializable_user(self):
+        """Tests that users which are not JSON serializable are counted, not raised"""
+
+        sender = self.channel()
+        self.addCleanup(sender.close)
+
+        sender.publish(object())
+
+        self.assertEqual(sender.metrics.get('invalidation.errors'), 1)
+        self.assertEqual(sender.metrics.get('invalidation.sent'), 0)
+
+class UnixSocketChannelTest(ChannelTestMixin, unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+
+    def channel(self):
+        return UnixSocketInvalidationChannel(self.directory, metrics=Metrics())
+
+    def test_transport_interface(self):
+        class SendOnly(InvalidationChannel):
+            def send(self, data):
+                pass
+
+        # ----- Transports must implement listen() and send() ----- #
+        self.assertRaises(TypeError, InvalidationChannel)
+        self.assertRaises(TypeError, SendOnly)
+
+    def test_dead_peers(self):
+        """Tests that sockets of closed channels are removed"""
+
+        sender = self.channel()
+        self.addCleanup(sender.close)
+
+        # Socket file of a process that exited without closing it
+        dead = os.path.join(self.directory, 'u2f-0-0.sock')
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        sock.bind(dead)
+        sock.close()
+
+        sender.publish('alice')
+
+        self.assertFalse(os.path.exists(dead))
+        self.assertEqual(len(os.listdir(self.directory)), 1)
+
+@unittest.skipIf(fakeredis is None, 'fakeredis is not installed')
+class RedisChannelTest(ChannelTestMixin, unittest.TestCase):
+    def setUp(self):
+        self.redis = fakeredis.FakeStrictRedis()
+
+    def channel(self):
+        return RedisInvalidationChannel(self.redis, metrics=Metrics())
+
+if __name__ == '__main__':
+    unittest.main()
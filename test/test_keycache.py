@@ -0,0 +1,79 @@
+import os
+import unittest
+import tempfile
+import multiprocessing
+
+from flask_fido_u2f.metrics import Metrics
+from flask_fido_u2f.keycache import SharedKeyCache, SLOT
+
+POINT = b'\x04' + bytes(range(64))
+
+class SharedKeyCacheTest(unittest.TestCase):
+    def test_entries(self):
+        metrics = Metrics()
+        cache   = SharedKeyCache(slots=64, metrics=metrics)
+
+        self.assertIsNone(cache.get('kh1'))
+
+        cache.put('kh1', POINT, 5)
+        self.assertEqual(cache.get('kh1'), (POINT, 5))
+
+        self.assertFalse(cache.advance('kh1', 5))
+        self.assertTrue(cache.advance('kh1', 6))
+        self.assertEqual(cache.get('kh1'), (POINT, 6))
+
+        cache.discard('kh1')
+        self.assertIsNone(cache.get('kh1'))
+
+        self.assertEqual(metrics.get('keycache.hit'), 4)
+        self.assertEqual(metrics.get('keycache.miss'), 2)
+
+    def test_keyed_by_user(self):
+        cache = SharedKeyCache(slots=64)
+
+        cache.put(('alice', 'kh1'), POINT, 5)
+        self.assertEqual(cache.get(('alice', 'kh1')), (POINT, 5))
+        self.assertIsNone(cache.get(('mallory', 'kh1')))
+        self.assertIsNone(cache.get('kh1'))
+
+    def test_bounded(self):
+        cache = SharedKeyCache(slots=8)
+
+        for i in range(1000):
+            cache.put('kh{0}'.format(i), POINT, i)
+
+        self.assertEqual(cache.get('kh999'), (POINT, 999))
+        self.assertLessEqual(sum(cache.get('kh{0}'.format(i)) is not None for i in range(1000)), 8)
+
+    @unittest.skipIf(not hasattr(os, 'fork'), 'fork is not available')
+    def test_shared_with_forked_workers(self):
+        cache = SharedKeyCache(slots=64)
+
+        worker = multiprocessing.get_context('fork').Process(target=cache.put, args=('kh1', POINT, 7))
+        worker.start()
+        worker.join()
+
+        self.assertEqual(cache.get('kh1'), (POINT, 7))
+
+    def test_file_backed(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path   = os.path.join(directory, 'keys')
+            first  = SharedKeyCache(slots=64, path=path)
+            second = SharedKeyCache(slots=64, path=path)
+
+            first.put('kh1', POINT, 1)
+            self.assertEqual(second.get('kh1'), (POINT, 1))
+            self.assertEqual(os.path.getsize(path), 64 * SLOT)
+
+            # Torn or corrupted entries are misses
+            with open(path, 'r+b') as backing:
+                data = backing.read()
+                offset = data.index(POINT)
+
+                backing.seek(offset)
+                backing.write(b'\x05')
+
+            self.assertIsNone(second.get('kh1'))
+
+if __name__ == '__main__':
+    unittest.main()
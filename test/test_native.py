@@ -0,0 +1,90 @@
+import unittest, json
+
+from flask_fido_u2f import U2FCore, U2FFailure, FailureReason
+from flask_fido_u2f.core import websafe_encode, websafe_decode
+from flask_fido_u2f.native import parse_registration, parse_authentication
+
+from .soft_u2f_v2 import SoftU2FDevice
+
+class NativeEngineTest(unittest.TestCase):
+    """Checks native engine against u2flib on SoftU2FDevice messages"""
+
+    def setUp(self):
+        self.cores = [U2FCore('https://example.com', engine=engine) for engine in U2FCore.ENGINES]
+        self.token = SoftU2FDevice()
+
+    def registration(self):
+        request  = self.cores[0].start_enroll([])
+        response = self.token.register(request['registerRequests'][0], facet='https://example.com')
+
+        return request.json, response
+
+    def signature(self, devices, index=0):
+        request  = self.cores[0].start_sign(devices)
+        response = self.token.getAssertion(request['authenticateRequests'][index], facet='https://example.com')
+
+        return request.json, response
+
+    def test_same_results(self):
+        request, response = self.registration()
+        devices = [core.complete_enroll(request, response, []) for core in self.cores]
+
+        self.assertEqual(dict(devices[0]), devices[1])
+
+        for i in range(3):
+            request, response = self.signature(devices[:1])
+            results = [core.complete_sign(request, response, devices[:1])[1:] for core in self.cores]
+
+            self.assertEqual(results[0], results[1])
+            self.assertEqual(results[1][0], self.token.counter)
+
+    def test_parsing(self):
+        request, response = self.registration()
+        data = websafe_decode(response['registrationData'])
+
+        public_key, key_handle, certificate, signature = parse_registration(data)
+
+        self.assertEqual(len(public_key), 65)
+        self.assertEqual(bytes(key_handle), list(self.token.keys)[0])
+        self.assertEqual(len(certificate) + len(signature), len(data) - 1 - 65 - 1 - len(key_handle))
+
+        self.assertEqual(parse_authentication(b'\x01\x00\x00\x01\x00sig')[:2], (1, 256))
+
+        for truncated in (b'', b'\x05', data[:70], data[:1 + 65 + 1 + len(key_handle) + 8]):
+            with self.assertRaises(ValueError):
+                parse_registration(truncated)
+
+        with self.assertRaises(ValueError):
+            parse_authentication(b'\x01\x00\x00\x00')
+
+    def test_same_failures(self):
+        request, response = self.registration()
+        device = self.cores[0].complete_enroll(request, response, [])
+
+        request, response = self.signature([device])
+
+        # Counter changed after signing
+        data     = bytearray(websafe_decode(response['signatureData']))
+        data[4] ^= 1
+        tampered = dict(response, signatureData=websafe_encode(bytes(data)))
+
+        short = dict(response, signatureData=websafe_encode(b'\x01\x00\x00'))
+
+        for payload, reason in ((tampered, FailureReason.BAD_SIGNATURE), (short, FailureReason.MALFORMED_PAYLOAD)):
+            for core in self.cores:
+                request = core.build_challenge('sign', json.loads(request)['authenticateRequests'][0]['challenge'], [device])
+
+                # Fresh replay cache per attempt, so that only the payload is wrong
+                core.replay_cache = type(core.replay_cache)()
+
+                with self.assertRaises(U2FFailure) as cm:
+                    core.complete_sign(request, payload, [device])
+
+                self.assertEqual(cm.exception.reason, reason, core.engine)
+
+    def test_unknown_engine(self):
+        with self.assertRaises(ValueError):
+            U2FCore('https://example.com', engine='openssl')
+
+if __name__ == '__main__':
+    unittest.main()
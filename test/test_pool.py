@@ -0,0 +1,32 @@
+import unittest
+
+from flask_fido_u2f.metrics import Metrics
+from flask_fido_u2f.pool import ChallengePool
+
+class ChallengePoolTest(unittest.TestCase):
+    def test_take(self):
+        pool = ChallengePool(size=64, refill_threshold=16)
+
+        challenges = [pool.take() for i in range(256)]
+
+        self.assertTrue(all(len(challenge) == 32 for challenge in challenges))
+        self.assertEqual(len(set(challenges)), len(challenges))
+
+    def test_exhaustion(self):
+        metrics = Metrics()
+        pool    = ChallengePool(size=2, refill_threshold=0, metrics=metrics)
+
+        pool.take()
+        pool.take()
+
+        self.assertEqual(len(pool), 0)
+        self.assertEqual(metrics.get('pool.exhausted'), 0)
+
+        self.assertEqual(len(pool.take()), 32)
+        self.assertEqual(metrics.get('pool.exhausted'), 1)
+
+        self.assertEqual(pool.refill(), 2)
+        self.assertEqual(len(pool), 2)
+
+if __name__ == '__main__':
+    unittest.main()
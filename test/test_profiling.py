@@ -0,0 +1,101 @@
+import unittest, os, time, tempfile
+
+from flask import Flask
+from flask_fido_u2f import U2F
+from flask_fido_u2f.metrics import Metrics
+from flask_fido_u2f.profiling import SamplingProfiler
+
+def slow_call():
+    time.sleep(0.05)
+
+class SamplingProfilerTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.metrics   = Metrics()
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def profiles(self):
+        return sorted(os.listdir(self.directory.name))
+
+    def test_slow_requests(self):
+        profiler = SamplingProfiler(self.directory.name, threshold=0.02, interval=0.001, metrics=self.metrics)
+
+        with profiler.profile('fast'):
+            pass
+
+        with profiler.profile('slow'):
+            slow_call()
+
+        profiles = self.profiles()
+        self.assertEqual(len(profiles), 1)
+        self.assertTrue(profiles[0].startswith('slow-') and profiles[0].endswith('.folded'))
+        self.assertEqual(self.metrics.get('profile.dumps'), 1)
+
+        with open(os.path.join(self.directory.name, profiles[0])) as folded:
+            lines = folded.read().splitlines()
+
+        # Collapsed stacks: root first, sample count last
+        stack, count = lines[0].rsplit(' ', 1)
+        self.assertIn('test_profiling.py:test_slow_requests;test_profiling.py:slow_call', stack)
+        self.assertGreater(int(count), 0)
+
+    def test_sample_rate(self):
+        profiler = SamplingProfiler(self.directory.name, threshold=10, sample_rate=1.0, interval=0.001)
+
+        with profiler.profile('sampled'):
+            slow_call()
+
+        self.assertEqual(len(self.profiles()), 1)
+
+    def test_max_dumps(self):
+        profiler = SamplingProfiler(self.directory.name, threshold=0, interval=0.001,
+                                    max_dumps=2, dump_interval=0.5, metrics=self.metrics)
+
+        for i in range(4):
+            with profiler.profile('slow'):
+                slow_call()
+
+        self.assertEqual(len(self.profiles()), 2)
+        self.assertEqual(self.metrics.get('profile.dropped'), 2)
+
+        # ----- Next interval writes again ----- #
+        time.sleep(0.5)
+
+        with profiler.profile('slow'):
+            slow_call()
+
+        self.assertEqual(len(self.profiles()), 3)
+
+    def test_views(self):
+        app = Flask(__name__)
+        app.config['SECRET_KEY']            = 'DjInNB3l9GBZq2D9IsbBuHpOiLI5H1iBdqJR24VPHdj'
+        app.config['U2F_APPID']             = 'https://example.com'
+        app.config['U2F_PROFILE_DIR']       = self.directory.name
+        app.config['U2F_PROFILE_THRESHOLD'] = 0.02
+        app.config['U2F_PROFILE_INTERVAL']  = 0.001
+
+        u2f    = U2F(app)
+        client = app.test_client()
+
+        @u2f.read
+        def read():
+            slow_call()
+            return []
+
+        u2f.save(lambda devices: None)
+        u2f.enroll_on_success(lambda: None)
+        u2f.sign_on_success(lambda: None)
+
+        with client.session_transaction() as sess:
+            sess['u2f_enroll_authorized'] = True
+
+        self.assertEqual(client.get('/u2f/enroll').status_code, 200)
+
+        profiles = self.profiles()
+        self.assertEqual(len(profiles), 1)
+        self.assertTrue(profiles[0].startswith('enroll.get-'))
+
+if __name__ == '__main__':
+    unittest.main()
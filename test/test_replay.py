@@ -0,0 +1,50 @@
+import time
+import unittest
+
+from flask_fido_u2f import ReplayCache, MemoryReplayCache, RedisReplayCache
+
+try:
+    import fakeredis
+except ImportError:
+    fakeredis = None
+
+class ReplayCacheTest(unittest.TestCase):
+    def test_memory_replay_cache(self):
+        cache = MemoryReplayCache(bucket_width=10)
+
+        self.assertTrue(cache.consume('{"challenge": "first"}', 60))
+        self.assertTrue(cache.consume('{"challenge": "second"}', 60))
+
+        # ----- Replayed challenges are rejected ----- #
+        self.assertFalse(cache.consume('{"challenge": "first"}', 60))
+        self.assertFalse(cache.consume(b'{"challenge": "second"}', 60))
+        self.assertEqual(len(cache), 2)
+
+        # ----- Expired buckets are evicted ----- #
+        cache.evict(time.time() + 100)
+
+        self.assertEqual(len(cache), 0)
+        self.assertTrue(cache.consume('{"challenge": "first"}', 60))
+
+    @unittest.skipIf(fakeredis is None, 'fakeredis is not installed')
+    def test_redis_replay_cache(self):
+        client = fakeredis.FakeRedis()
+        cache  = RedisReplayCache(client, prefix='u2f:')
+
+        self.assertTrue(cache.consume('{"challenge": "first"}', 60))
+        self.assertFalse(cache.consume('{"challenge": "first"}', 60))
+
+        # ----- Shared by caches of other workers ----- #
+        self.assertFalse(RedisReplayCache(client, prefix='u2f:').consume('{"challenge": "first"}', 60))
+
+        key = cache.replay_key(cache.digest('{"challenge": "first"}'))
+        self.assertTrue(0 < client.ttl(key) <= 60)
+
+    def test_backend_interface(self):
+        with self.assertRaises(TypeError):
+            ReplayCache()
+
+        self.assertEqual(len(MemoryReplayCache().digest('challenge')), 8)
+
+if __name__ == '__main__':
+    unittest.main()
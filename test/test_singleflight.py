@@ -0,0 +1,117 @@
+import time
+import unittest
+import threading
+
+from flask_fido_u2f.metrics import Metrics
+from flask_fido_u2f.singleflight import SingleFlight
+
+class SingleFlightTest(unittest.TestCase):
+    def setUp(self):
+        self.calls   = 0
+        self.release = threading.Event()
+
+    def read(self):
+        self.calls += 1
+        self.release.wait(5)
+
+        return [{'counter': self.calls}]
+
+    def run_concurrently(self, flight, count, key='alice'):
+        results = []
+        threads = [threading.Thread(target=lambda: results.append(flight.do(key, self.read)))
+                   for i in range(count)]
+
+        for thread in threads:
+            thread.start()
+
+        # Followers wait on the leader, which is blocked in read()
+        time.sleep(0.05)
+        self.release.set()
+
+        for thread in threads:
+            thread.join()
+
+        return results
+
+    def test_in_flight(self):
+        metrics = Metrics()
+        flight  = SingleFlight(copy=lambda devices: [dict(device) for device in devices], metrics=metrics)
+
+        results = self.run_concurrently(flight, 8)
+
+        self.assertEqual(self.calls, 1)
+        self.assertEqual(metrics.get('read.coalesced'), 7)
+        self.assertTrue(all(result == [{'counter': 1}] for result in results))
+
+        # Every caller gets its own copy
+        results[0][0]['counter'] = 5
+        self.assertEqual(results[1][0]['counter'], 1)
+
+        # Finished reads are not shared without window
+        self.assertEqual(len(flight), 0)
+        flight.do('alice', self.read)
+        self.assertEqual(self.calls, 2)
+
+    def test_window(self):
+        flight = SingleFlight(window=60)
+        self.release.set()
+
+        flight.do('alice', self.read)
+        flight.do('alice', self.read)
+        self.assertEqual(self.calls, 1)
+
+        flight.do('bob', self.read)
+        self.assertEqual(self.calls, 2)
+
+        flight.forget('alice')
+        self.assertEqual(flight.do('alice', self.read), [{'counter': 3}])
+
+        flight.window = 0
+        flight.do('alice', self.read)
+        self.assertEqual(self.calls, 4)
+
+    def test_forget_in_flight(self):
+        flight = SingleFlight(window=60)
+
+        thread = threading.Thread(target=flight.do, args=('alice', self.read))
+        thread.start()
+        time.sleep(0.05)
+
+        # Write while read is in flight, its result must not be kept
+        flight.forget('alice')
+        self.release.set()
+        thread.join()
+
+        flight.do('alice', self.read)
+        self.assertEqual(self.calls, 2)
+
+    def test_errors(self):
+        flight = SingleFlight(window=60)
+
+        def fail():
+            self.calls += 1
+            raise IOError('Storage is down')
+
+        with self.assertRaises(IOError):
+            flight.do('alice', fail)
+
+        # Errors are not kept
+        with self.assertRaises(IOError):
+            flight.do('alice', fail)
+
+        self.assertEqual(self.calls, 2)
+
+    def test_max_entries(self):
+        flight = SingleFlight(window=60, max_entries=2)
+        self.release.set()
+
+        for user in ('alice', 'bob', 'carol'):
+            flight.do(user, self.read)
+
+        self.assertEqual(len(flight), 2)
+
+        flight.do('alice', self.read)
+        self.assertEqual(self.calls, 4)
+
+if __name__ == '__main__':
+    unittest.main()
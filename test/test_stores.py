@@ -0,0 +1,393 @@
+import unittest, json, os, sqlite3, tempfile
+
+from flask import Flask
+from flask_fido_u2f import U2F
+from flask_fido_u2f.stores import DeviceStore, SQLiteDeviceStore, SQLAlchemyDeviceStore, RedisDeviceStore
+
+from .soft_u2f_v2 import SoftU2FDevice
+
+try:
+    import sqlalchemy
+except ImportError:
+    sqlalchemy = None
+
+try:
+    import fakeredis
+except ImportError:
+    fakeredis = None
+
+def make_device(key_handle, index=0, counter=0, **extra):
+    device = {
+        'keyHandle' : key_handle,
+        'appId'     : 'https://example.com',
+        'publicKey' : 'BPublicKey' + key_handle,
+        'counter'   : counter,
+        'index'     : index
+    }
+    device.update(extra)
+
+    return device
+
+class StoreTestMixin(object):
+    def test_read_save(self):
+        self.assertEqual(self.store.read('alice'), [])
+
+        devices = [make_device('kh1', 0), make_device('kh2', 1, nickname='Backup')]
+        self.store.save('alice', devices)
+
+        self.assertEqual(self.store.read('alice'), devices)
+        self.assertEqual(self.store.read('bob'), [])
+
+        # ----- Removed devices are deleted ----- #
+        self.store.save('alice', devices[1:])
+        self.assertEqual(self.store.read('alice'), devices[1:])
+
+    def test_counters(self):
+        self.store.save('alice', [make_device('kh1', counter=5)])
+
+        self.assertEqual(self.store.save_counters({('alice', 'kh1'): {'counter': 6}}), set())
+        self.assertEqual(self.store.read('alice')[0]['counter'], 6)
+
+        # ----- Counters never go backwards ----- #
+        self.assertEqual(self.store.save_counters({('alice', 'kh1'): {'counter': 6}, ('alice', 'kh2'): {'counter': 1}}),
+                         {('alice', 'kh1'), ('alice', 'kh2')})
+
+        self.store.save('alice', [make_device('kh1', counter=2)])
+        self.assertEqual(self.store.read('alice')[0]['counter'], 6)
+
+    def test_counters_per_user(self):
+        self.store.save('alice', [make_device('kh1', counter=5)])
+        self.store.save('mallory', [make_device('kh1', counter=0)])
+
+        # ----- Same key handle of another user is not touched ----- #
+        self.assertEqual(self.store.save_counters({('mallory', 'kh1'): {'counter': 2 ** 31, 'last_used': 100, 'uses': 1}}),
+                         set())
+
+        self.assertEqual(self.store.read('alice'), [make_device('kh1', counter=5)])
+        self.assertEqual(self.store.read('mallory'), [make_device('kh1', counter=2 ** 31, last_used=100, use_count=1)])
+
+        self.assertEqual(self.store.save_counters({('bob', 'kh1'): {'counter': 6}}), {('bob', 'kh1')})
+
+        # ----- Removing devices of another user keeps counters ----- #
+        self.store.save('mallory', [])
+        self.assertEqual(self.store.read('alice'), [make_device('kh1', counter=5)])
+
+    def test_usage_statistics(self):
+        self.store.save('alice', [make_device('kh1')])
+
+        self.store.save_counters({('alice', 'kh1'): {'counter': 1, 'last_used': 100, 'uses': 1}})
+        self.store.save_counters({('alice', 'kh1'): {'counter': 3, 'last_used': 200, 'uses': 2}})
+
+        self.assertEqual(self.store.read('alice'), [make_device('kh1', counter=3, last_used=200, use_count=3)])
+
+        # ----- Saving stale devices keeps statistics ----- #
+        self.store.save('alice', [make_device('kh1', nickname='Main')])
+        self.assertEqual(self.store.read('alice'), [make_device('kh1', counter=3, last_used=200, use_count=3, nickname='Main')])
+
+    def test_iter_devices(self):
+        users = ['user{0:02d}'.format(i) for i in range(20)]
+
+        for i, user in enumerate(users):
+            self.store.save(user, [make_device('{0}-kh{1}'.format(user, k), k) for k in range(i % 3 + 1)])
+
+        expected = sorted((user, device['keyHandle']) for user in users for device in self.store.read(user))
+        self.assertEqual(sorted((user, device['keyHandle']) for user, device in self.store.iter_devices()), expected)
+
+        # Shards split devices by user, without overlap
+        found = []
+        for shard in self.store.shards(4):
+            devices = list(self.store.iter_devices(shard, batch_size=3))
+            found.extend((user, device['keyHandle']) for user, device in devices)
+
+            for user, device in devices:
+                self.assertIn(device, self.store.read(user))
+
+        self.assertEqual(sorted(found), expected)
+
+    def test_use_store(self):
+        app = Flask(__name__)
+        app.config['SECRET_KEY'] = 'DjInNB3l9GBZq2D9IsbBuHpOiLI5H1iBdqJR24VPHdj'
+        app.config['U2F_APPID']  = 'https://example.com'
+
+        u2f    = U2F(app)
+        client = app.test_client()
+        token  = SoftU2FDevice()
+
+        u2f.use_store(self.store)
+
+        with self.assertRaises(Exception) as cm:
+            u2f.verify_integrity()
+
+        self.assertIn('@u2f.identity', str(cm.exception))
+
+        u2f.identity(lambda: 'alice')
+        u2f.enroll_on_success(lambda: None)
+        u2f.sign_on_success(lambda: None)
+
+        with client.session_transaction() as sess:
+            sess['u2f_enroll_authorized'] = True
+            sess['u2f_sign_required']     = True
+
+        response  = json.loads(client.get('/u2f/enroll').get_data(as_text=True))
+        keyhandle = token.register(response['registerRequests'][0], facet='https://example.com')
+
+        response = client.post('/u2f/enroll', data=json.dumps(keyhandle), headers={ 'content-type': 'application/json' })
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(len(self.store.read('alice')), 1)
+
+        response  = json.loads(client.get('/u2f/sign').get_data(as_text=True))
+        signature = token.getAssertion(response['authenticateRequests'][0], facet='https://example.com')
+
+        response = client.post('/u2f/sign', data=json.dumps(signature), headers={ 'content-type': 'application/json' })
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(self.store.read('alice')[0]['counter'], token.counter)
+
+class SQLiteDeviceStoreTest(StoreTestMixin, unittest.TestCase):
+    def setUp(self):
+        self.store = SQLiteDeviceStore(':memory:')
+
+    def test_sqlite_version(self):
+        version = sqlite3.sqlite_version_info
+        self.addCleanup(setattr, sqlite3, 'sqlite_version_info', version)
+
+        # ----- Upserts need SQLite 3.24 ----- #
+        sqlite3.sqlite_version_info = (3, 23, 1)
+        self.assertRaises(RuntimeError, SQLiteDeviceStore, ':memory:')
+
+    def test_store_interface(self):
+        class ReadOnly(DeviceStore):
+            def read(self, user):
+                return []
+
+        # ----- Stores must implement read(), save() and save_counters() ----- #
+        self.assertRaises(TypeError, DeviceStore)
+        self.assertRaises(TypeError, ReadOnly)
+
+    def test_file_database(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path  = os.path.join(directory, 'u2f.sqlite')
+            store = SQLiteDeviceStore(path)
+            store.save('alice', [make_device('kh1')])
+
+            self.assertEqual(SQLiteDeviceStore(path).read('alice'), [make_device('kh1')])
+
+    def test_migration(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'u2f.sqlite')
+
+            with sqlite3.connect(path) as connection:
+                connection.execute('''CREATE TABLE u2f_devices (
+                    user_id TEXT NOT NULL, key_handle TEXT NOT NULL, app_id TEXT NOT NULL,
+                    public_key TEXT NOT NULL, counter INTEGER NOT NULL DEFAULT 0,
+                    idx INTEGER NOT NULL DEFAULT 0, extra TEXT,
+                    PRIMARY KEY (user_id, key_handle)) WITHOUT ROWID''')
+                connection.execute("INSERT INTO u2f_devices VALUES ('alice', 'kh1', 'https://example.com', 'BPublicKeykh1', 5, 0, NULL)")
+
+            store = SQLiteDeviceStore(path)
+            self.assertEqual(store.read('alice'), [make_device('kh1', counter=5)])
+
+            store.save_counters({('alice', 'kh1'): {'counter': 6, 'last_used': 100, 'uses': 1}})
+            self.assertEqual(store.read('alice'), [make_device('kh1', counter=6, last_used=100, use_count=1)])
+
+@unittest.skipIf(sqlalchemy is None, 'SQLAlchemy is not installed')
+class SQLAlchemyDeviceStoreTest(StoreTestMixin, unittest.TestCase):
+    def setUp(self):
+        self.store = SQLAlchemyDeviceStore('sqlite://')
+
+    def test_read_only(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'u2f.sqlite')
+
+            with sqlite3.connect(path) as connection:
+                connection.execute('''CREATE TABLE u2f_devices (
+                    user_id TEXT NOT NULL, key_handle TEXT NOT NULL, app_id TEXT NOT NULL,
+                    public_key TEXT NOT NULL, counter INTEGER NOT NULL DEFAULT 0,
+                    idx INTEGER NOT NULL DEFAULT 0, extra TEXT,
+                    PRIMARY KEY (user_id, key_handle))''')
+                connection.execute("INSERT INTO u2f_devices VALUES ('alice', 'kh1', 'https://example.com', 'BPublicKeykh1', 5, 0, NULL)")
+            connection.close()
+
+            store = SQLAlchemyDeviceStore('sqlite:///' + path, read_only=True)
+            self.assertEqual(store.read('alice'), [make_device('kh1', counter=5)])
+            self.assertEqual(list(store.iter_devices()), [('alice', make_device('kh1', counter=5))])
+
+            # ----- Table is not migrated ----- #
+            columns = [column['name'] for column in sqlalchemy.inspect(store.engine).get_columns('u2f_devices')]
+            self.assertNotIn('use_count', columns)
+
+@unittest.skipIf(fakeredis is None, 'fakeredis is not installed')
+class RedisDeviceStoreTest(StoreTestMixin, unittest.TestCase):
+    def setUp(self):
+        self.redis = fakeredis.FakeStrictRedis()
+        self.store = RedisDeviceStore(self.redis)
+
+    def test_challenges(self):
+        self.store.save('alice', [make_device('kh1', counter=3)])
+
+        devices = self.store.issue_challenge('alice', 'sign', 'c1', 300)
+        self.assertEqual(devices, [make_device('kh1', counter=3)])
+        self.assertLessEqual(self.redis.ttl('u2f:challenge:sign:alice'), 300)
+
+        # ----- Challenge can only be consumed once ----- #
+        self.assertEqual(self.store.consume_challenge('alice', 'sign'), ('c1', devices))
+        self.assertEqual(self.store.consume_challenge('alice', 'sign'), (None, devices))
+        self.assertEqual(self.store.consume_challenge('alice', 'enroll'), (None, devices))
+
+        # ----- Sessions keep their own challenges ----- #
+        self.store.issue_challenge('alice', 'sign', 'c2', 300, 'n2')
+        self.store.issue_challenge('alice', 'sign', 'c3', 300, 'n3')
+
+        self.assertEqual(self.store.consume_challenge('alice', 'sign', 'n2'), ('c2', devices))
+        self.assertEqual(self.store.consume_challenge('alice', 'sign', 'n3'), ('c3', devices))
+
+    def test_shards_by_cursor(self):
+        for i in range(20):
+            self.store.save('user{0:02d}'.format(i), [make_device('user{0:02d}-kh0'.format(i))])
+
+        scans = []
+        scan  = self.redis.scan
+
+        def counted_scan(*args, **kwargs):
+            scans.append(1)
+            return scan(*args, **kwargs)
+
+        self.redis.scan       = counted_scan
+        self.store.SCAN_COUNT = 2
+
+        # ----- Shards hold cursors, not user ids ----- #
+        shards = self.store.shards(4)
+        self.assertEqual(len(shards), 4)
+        self.assertTrue(all(len(shard) == 3 and all(isinstance(value, int) for value in shard) for shard in shards))
+
+        walked = len(scans)
+        users  = [user for shard in shards for user, device in self.store.iter_devices(shard)]
+        self.assertEqual(sorted(users), ['user{0:02d}'.format(i) for i in range(20)])
+
+        # ----- Workers walk the key space once between them ----- #
+        self.assertEqual(len(scans), walked * 2)
+
+    def test_store_challenges(self):
+        app = Flask(__name__)
+        app.config['SECRET_KEY'] = 'DjInNB3l9GBZq2D9IsbBuHpOiLI5H1iBdqJR24VPHdj'
+        app.config['U2F_APPID']  = 'https://example.com'
+
+        u2f    = U2F(app)
+        client = app.test_client()
+        token  = SoftU2FDevice()
+
+        u2f.use_store(self.store)
+        u2f.identity(lambda: 'alice')
+        u2f.enroll_on_success(lambda: None)
+        u2f.sign_on_success(lambda: None)
+
+        with client.session_transaction() as sess:
+            sess['u2f_enroll_authorized'] = True
+
+        response  = json.loads(client.get('/u2f/enroll').get_data(as_text=True))
+        keyhandle = token.register(response['registerRequests'][0], facet='https://example.com')
+
+        # ----- Challenge is kept in Redis, not in session ----- #
+        with client.session_transaction() as sess:
+            self.assertNotIn('_u2f_enroll_', sess)
+            nonce = sess['_u2f_nonce_']
+
+        self.assertTrue(self.redis.exists('u2f:challenge:enroll:alice:' + nonce))
+
+        response = client.post('/u2f/enroll', data=json.dumps(keyhandle), headers={ 'content-type': 'application/json' })
+        self.assertEqual(response.status_code, 201)
+
+        with client.session_transaction() as sess:
+            sess['u2f_sign_required'] = True
+
+        response  = json.loads(client.get('/u2f/sign').get_data(as_text=True))
+        signature = token.getAssertion(response['authenticateRequests'][0], facet='https://example.com')
+
+        # ----- Devices consumed with the challenge are not read again ----- #
+        reads = []
+        read  = self.store.read
+
+        def counted_read(user):
+            reads.append(user)
+            return read(user)
+
+        self.store.read = counted_read
+
+        response = client.post('/u2f/sign', data=json.dumps(signature), headers={ 'content-type': 'application/json' })
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(reads, [])
+        self.assertEqual(read('alice')[0]['counter'], 1)
+
+        # ----- Replayed signature finds no pending challenge ----- #
+        with client.session_transaction() as sess:
+            sess['u2f_sign_required'] = True
+
+        response = client.post('/u2f/sign', data=json.dumps(signature), headers={ 'content-type': 'application/json' })
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(json.loads(response.get_data(as_text=True))['code'], 'missing_challenge')
+
+    def test_store_challenges_concurrent_sessions(self):
+        app = Flask(__name__)
+        app.config['SECRET_KEY'] = 'DjInNB3l9GBZq2D9IsbBuHpOiLI5H1iBdqJR24VPHdj'
+        app.config['U2F_APPID']  = 'https://example.com'
+
+        u2f   = U2F(app)
+        token = SoftU2FDevice()
+
+        u2f.use_store(self.store)
+        u2f.identity(lambda: 'alice')
+        u2f.enroll_on_success(lambda: None)
+        u2f.sign_on_success(lambda: None)
+
+        first, second = app.test_client(), app.test_client()
+
+        with first.session_transaction() as sess:
+            sess['u2f_enroll_authorized'] = True
+
+        response  = json.loads(first.get('/u2f/enroll').get_data(as_text=True))
+        keyhandle = token.register(response['registerRequests'][0], facet='https://example.com')
+        first.post('/u2f/enroll', data=json.dumps(keyhandle), headers={ 'content-type': 'application/json' })
+
+        # ----- Logins of the same user in two browsers do not overwrite each other ----- #
+        signatures = []
+        for client in (first, second):
+            with client.session_transaction() as sess:
+                sess['u2f_sign_required'] = True
+
+            response = json.loads(client.get('/u2f/sign').get_data(as_text=True))
+            signatures.append(token.getAssertion(response['authenticateRequests'][0], facet='https://example.com'))
+
+        for client, signature in zip((first, second), signatures):
+            response = client.post('/u2f/sign', data=json.dumps(signature), headers={ 'content-type': 'application/json' })
+            self.assertEqual(response.status_code, 201)
+
+    def test_store_challenges_outage(self):
+        app = Flask(__name__)
+        app.config['SECRET_KEY']           = 'DjInNB3l9GBZq2D9IsbBuHpOiLI5H1iBdqJR24VPHdj'
+        app.config['U2F_APPID']            = 'https://example.com'
+        app.config['U2F_READ_TIMEOUT']     = 1
+        app.config['U2F_BREAKER_FAILURES'] = 1
+
+        u2f    = U2F(app)
+        client = app.test_client()
+
+        u2f.use_store(self.store)
+        u2f.identity(lambda: 'alice')
+        u2f.enroll_on_success(lambda: None)
+        u2f.sign_on_success(lambda: None)
+
+        def consume_challenge(user, kind, nonce=None):
+            raise ConnectionError('Redis is down')
+
+        self.store.consume_challenge = consume_challenge
+
+        with client.session_transaction() as sess:
+            sess['u2f_sign_required'] = True
+
+        # ----- Challenges are consumed through the circuit breaker ----- #
+        response = client.post('/u2f/sign', data=json.dumps({}), headers={ 'content-type': 'application/json' })
+        self.assertEqual(response.status_code, 503)
+        self.assertEqual(u2f.metrics.get('storage.error'), 1)
+        self.assertEqual(u2f.metrics.get('breaker.opened'), 1)
+
+if __name__ == '__main__':
+    unittest.main()